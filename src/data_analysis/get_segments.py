@@ -1,6 +1,89 @@
 from typing import List, Tuple
 
-from grid_processing_utils import distance
+import numpy as np
+
+
+def get_segment_boundaries(
+    key_centers: List[Tuple[int, int]],
+    x_coords: List[int],
+    y_coords: List[int],
+    ) -> np.ndarray:
+    """
+    Vectorized "SEGMENTS" algorithm (see get_segments).
+
+    Distances from all the points to all the key centers of the word
+    are computed at once. For each pair of consecutive distinct keys 
+    the condition of a point staying in the current segment 
+    (it approaches the current key or it's closer to the current key 
+    than to the next one) doesn't depend on where the segment started,
+    so the first point that breaks it is found with array operations
+    and only a loop over the keys of the word remains.
+
+    Returns:
+    --------
+    Array `boundaries` of shape (n_segments + 1,): the i-th segment 
+    consists of the points with indices boundaries[i]: boundaries[i+1].
+    """
+    if len(x_coords) != len(y_coords):
+        raise ValueError("x_coords and y_coords must have equal length")
+    
+    if len(x_coords) < 4:
+        raise ValueError("At least 4 points required for segmentation")
+    
+    n_all_points = len(x_coords)
+
+    key_centers = np.asarray(key_centers, dtype=np.float64).reshape(-1, 2)
+    is_transition = (key_centers[:-1] != key_centers[1:]).any(axis=1)
+    if not is_transition.any():
+        # The word had of only one unique charracter.
+        return np.array([0, n_all_points])
+    transition_idxs = np.flatnonzero(is_transition)
+
+    # Trim first/last two points as per algorithm
+    X = np.asarray(x_coords[2:-2], dtype=np.float64)
+    Y = np.asarray(y_coords[2:-2], dtype=np.float64)
+    n_points = len(X)
+
+    # (n_keys, n_points)
+    dists = np.sqrt((X[None, :] - key_centers[:, 0:1])**2 
+                    + (Y[None, :] - key_centers[:, 1:2])**2)
+    
+    dists_to_current = dists[transition_idxs]
+    dists_to_next = dists[transition_idxs + 1]
+    # stays[k, p] tells whether the point p continues the k-th segment 
+    # given that the point p-1 belongs to it. The first point of 
+    # a segment is always accepted (previous distance is infinite).
+    stays = np.ones_like(dists_to_current, dtype=bool)
+    stays[:, 1:] = (dists_to_current[:, 1:] < dists_to_current[:, :-1]) \
+        | (dists_to_current[:, 1:] < dists_to_next[:, 1:])
+    
+    # first_break[k, p] is the smallest q >= p such that not stays[k, q].
+    # The extra column makes the lookup of p = n_points valid.
+    break_idxs = np.where(stays, n_points, np.arange(n_points))
+    first_break = np.empty((len(transition_idxs), n_points + 1), dtype=np.int64)
+    first_break[:, n_points] = n_points
+    first_break[:, :n_points] = np.minimum.accumulate(break_idxs[:, ::-1], axis=1)[:, ::-1]
+
+    boundaries = np.empty(len(transition_idxs) + 2, dtype=np.int64)
+    boundaries[0] = 0
+    start = 0
+    for k in range(len(transition_idxs)):
+        if start < n_points:
+            start = first_break[k, start + 1]
+        boundaries[k + 1] = start + 2
+    boundaries[-1] = n_all_points
+    return boundaries
+
+
+def get_segment_lengths(
+    key_centers: List[Tuple[int, int]],
+    x_coords: List[int],
+    y_coords: List[int],
+    ) -> np.ndarray:
+    """
+    Returns the number of points in each segment (see get_segments).
+    """
+    return np.diff(get_segment_boundaries(key_centers, x_coords, y_coords))
 
 
 def get_segments(
@@ -36,56 +119,9 @@ def get_segments(
 
     Returns:
         List of segments, each being a list of (x,y) coordinate tuples.
+        Use get_segment_boundaries or get_segment_lengths 
+        if the points themselves are not needed.
     """
-    if len(x_coords) != len(y_coords):
-        raise ValueError("x_coords and y_coords must have equal length")
-    
-    if len(x_coords) < 4:
-        raise ValueError("At least 4 points required for segmentation")
-
-    segments = []
-
-    # Trim first/last two points as per algorithm
-    points = list(zip(x_coords[2:-2], y_coords[2:-2]))
-    point_index = 0  # Track current position in points list
-
-    # Collect segments (except for last segment)
-    for current_key, next_key in zip(key_centers[:-1], key_centers[1:]):
-        if current_key == next_key:
-            continue  # Skip duplicate keys
-
-        segment = []
-        previous_dist_to_current = float('inf')
-        current_x, current_y = current_key
-        next_x, next_y = next_key
-
-        # Collect points moving toward current key
-        while point_index < len(points):
-            px, py = points[point_index]
-            dist_to_current = distance(px, py, current_x, current_y)
-            dist_to_next = distance(px, py, next_x, next_y)
-
-            if dist_to_current < previous_dist_to_current or dist_to_current < dist_to_next:
-                segment.append(points[point_index])
-                previous_dist_to_current = dist_to_current
-                point_index += 1  # Move to next point
-            else:
-                break
-
-        segments.append(segment)
-
-    if not segments:  
-        # The word had of only one unique charracter.
-        # Example: 'ее' which is a way to type 'её'.
-        segments.append(list(zip(x_coords, y_coords)))
-        return segments
-
-    # Reattach trimmed edge points
-    first_two_points = list(zip(x_coords[:2], y_coords[:2]))
-    segments[0] = first_two_points + segments[0]
-
-    last_two_points = list(zip(x_coords[-2:], y_coords[-2:]))
-    remaining_points = points[point_index:]  # Unprocessed points
-    segments.append(remaining_points + last_two_points)
-
-    return segments
+    boundaries = get_segment_boundaries(key_centers, x_coords, y_coords).tolist()
+    points = list(zip(x_coords, y_coords))
+    return [points[start: end] for start, end in zip(boundaries[:-1], boundaries[1:])]
@@ -0,0 +1,28 @@
+"""
+Helpers for processing line-based (jsonl) files in parallel chunks.
+"""
+
+from typing import List, Tuple
+import os
+
+
+def get_byte_range_chunks(path: str, n_chunks: int) -> List[Tuple[int, int]]:
+    """
+    Splits a file into at most `n_chunks` byte ranges [start, end)
+    of roughly equal size. Each range starts at the beginning of a line.
+    """
+    file_size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, n_chunks):
+            pos = file_size * i // n_chunks
+            if pos <= boundaries[-1]:
+                continue
+            # Move to the beginning of the next line.
+            f.seek(pos - 1)
+            f.readline()
+            pos = f.tell()
+            if boundaries[-1] < pos < file_size:
+                boundaries.append(pos)
+    boundaries.append(file_size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
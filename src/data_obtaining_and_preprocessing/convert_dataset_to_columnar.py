@@ -0,0 +1,123 @@
+"""
+Converts a NeuroSwipe jsonl dataset (with grid_name property)
+to the columnar binary layout read by dataset.CurveDatasetColumnar.
+
+The conversion is done once; afterwards the dataset
+is opened via np.memmap without any parsing.
+"""
+
+from typing import Dict, Optional
+import os
+import json
+import array
+import argparse
+
+import numpy as np
+from tqdm import tqdm
+
+from dataset import (
+    _get_data_from_json_line,
+    COLUMNAR_DATASET_DTYPES,
+    COLUMNAR_DATASET_META_FILENAME
+)
+
+
+# array.array typecodes of native integers by item size.
+ARRAY_TYPECODES = {
+    2: 'h',
+    4: 'i',
+    8: 'q',
+}
+
+
+def convert_dataset_to_columnar(data_path: str,
+                                out_dir: str,
+                                total: Optional[int] = None,
+                                flush_every: int = 100_000) -> int:
+    """
+    Arguments:
+    ----------
+    data_path: str
+        Path to the dataset in jsonl format.
+    out_dir: str
+        Directory where columns and meta.json are saved.
+    total: Optional[int]
+        Number of dataset elements. Is used only for progress bar.
+    flush_every: int
+        Columns are accumulated in memory and appended
+        to the files every `flush_every` swipes.
+
+    Returns:
+    --------
+    Number of swipes in the dataset.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+
+    buffers = {name: array.array(ARRAY_TYPECODES[dtype.itemsize])
+               for name, dtype in COLUMNAR_DATASET_DTYPES.items()}
+    files = {name: open(os.path.join(out_dir, f'{name}.bin'), 'wb')
+             for name in COLUMNAR_DATASET_DTYPES}
+    grid_name_to_id: Dict[str, int] = {}
+    word_to_id: Dict[str, int] = {}
+
+    def flush() -> None:
+        for name, buffer in buffers.items():
+            # Buffers have native byte order and .bin files are little-endian.
+            dtype = COLUMNAR_DATASET_DTYPES[name]
+            files[name].write(
+                np.frombuffer(buffer, dtype=dtype.newbyteorder('=')).astype(dtype).tobytes())
+            del buffer[:]
+
+    n_swipes = 0
+    n_points = 0
+    buffers['offsets'].append(0)
+
+    try:
+        with open(data_path, encoding='utf-8') as f:
+            for line in tqdm(f, total=total):
+                X, Y, T, grid_name, tgt_word = _get_data_from_json_line(line)
+                buffers['x'].extend(X)
+                buffers['y'].extend(Y)
+                buffers['t'].extend(T)
+                n_points += len(X)
+                buffers['offsets'].append(n_points)
+                buffers['grid_name_ids'].append(
+                    grid_name_to_id.setdefault(grid_name, len(grid_name_to_id)))
+                buffers['word_ids'].append(
+                    -1 if tgt_word is None
+                    else word_to_id.setdefault(tgt_word, len(word_to_id)))
+                n_swipes += 1
+                if n_swipes % flush_every == 0:
+                    flush()
+            flush()
+    finally:
+        for file in files.values():
+            file.close()
+
+    meta = {
+        'n_swipes': n_swipes,
+        'grid_names': list(grid_name_to_id),
+        'words': list(word_to_id),
+    }
+    with open(os.path.join(out_dir, COLUMNAR_DATASET_META_FILENAME),
+              'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+    return n_swipes
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_path', type=str, required=True)
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--total', type=int, default=None)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    convert_dataset_to_columnar(args.dataset_path, args.output_dir, args.total)
+
+
+if __name__ == "__main__":
+    main()
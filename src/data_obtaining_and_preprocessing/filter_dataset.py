@@ -1,12 +1,20 @@
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 import json
 import os
+import shutil
+import tempfile
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
+
+from data_obtaining_and_preprocessing.chunking import get_byte_range_chunks
 from data_obtaining_and_preprocessing.swipe_validity import (
     monotoniacally_increases, 
     points_not_too_far, 
-    over_two_points_in_each_segment
+    over_two_points_in_each_segment,
+    get_key_centers_array,
+    get_swipes_error_masks
 )
 from grid_processing_utils import (
     get_label_to_key_map,
@@ -17,14 +25,166 @@ from grid_processing_utils import (
 from tqdm import tqdm
 
 
+ERROR_TYPES = (
+    'non_monotonic_timestamps',
+    'points_too_far',
+    'insufficient_points_in_segment',
+)
+
+
+def get_line_errors(line_data: dict, max_dist: int, 
+                    grids: Optional[Dict[str, dict]],
+                    grid_name_to_key_centers: Optional[Dict[str, np.ndarray]] = None
+                    ) -> List[str]:
+    """
+    Returns a list of error types (see ERROR_TYPES) of a dataset element.
+
+    Arguments:
+    ----------
+    grid_name_to_key_centers: Optional[Dict[str, np.ndarray]]
+        Precomputed key centers of grids (see get_key_centers_array).
+        Is used only if grids is not None.
+    """
+    c = line_data['curve']
+    x, y, t = c['x'], c['y'], c['t']
+    key_centers = None
+    if grids is not None:
+        kb_keys = grids[c['grid_name']]['keys']
+        if grid_name_to_key_centers is not None:
+            key_centers = grid_name_to_key_centers[c['grid_name']]
+    else:
+        kb_keys = c['grid']['keys']
+
+    # Check each condition separately
+    monotonic_ok = monotoniacally_increases(t)
+    points_ok = points_not_too_far(x, y, kb_keys, max_dist, key_centers)
+    segments_ok = over_two_points_in_each_segment(
+        line_data['word'], 
+        x, y,
+        get_label_to_key_map(kb_keys),
+        absent_chars_on_keyboard=('-',))
+    
+    errors = []
+    if not monotonic_ok:
+        errors.append('non_monotonic_timestamps')
+    if not points_ok:
+        errors.append('points_too_far')
+    if not segments_ok:
+        errors.append('insufficient_points_in_segment')
+    return errors
+
+
+def _has_insufficient_points_in_segment(line_data: dict, kb_keys: List[dict]) -> bool:
+    c = line_data['curve']
+    return not over_two_points_in_each_segment(
+        line_data['word'], 
+        c['x'], c['y'],
+        get_label_to_key_map(kb_keys),
+        absent_chars_on_keyboard=('-',))
+
+
+def get_lines_errors(lines_data: List[dict], max_dist: int,
+                     grids: Dict[str, dict],
+                     grid_name_to_key_centers: Dict[str, np.ndarray]
+                     ) -> List[List[str]]:
+    """
+    Same as [get_line_errors(line_data, ...) for line_data in lines_data]
+    for curves with a grid_name attribute, but timestamps and distances 
+    to keys are checked for all swipes of a grid at once 
+    (see swipe_validity.get_swipes_error_masks).
+    """
+    lines_errors = [[] for _ in lines_data]
+    grid_name_to_line_idxs = {}
+    for i, line_data in enumerate(lines_data):
+        grid_name_to_line_idxs.setdefault(line_data['curve']['grid_name'], []).append(i)
+
+    for grid_name, line_idxs in grid_name_to_line_idxs.items():
+        curves = [lines_data[i]['curve'] for i in line_idxs]
+        offsets = np.concatenate([[0], np.cumsum([len(c['x']) for c in curves])])
+        X, Y, T = (np.array([v for c in curves for v in c[coord]], dtype=np.int64)
+                   for coord in ('x', 'y', 't'))
+        error_masks = get_swipes_error_masks(
+            X, Y, T, offsets, grid_name_to_key_centers[grid_name], max_dist)
+        kb_keys = grids[grid_name]['keys']
+        for j, i in enumerate(line_idxs):
+            for error_type in ('non_monotonic_timestamps', 'points_too_far'):
+                if error_masks[error_type][j]:
+                    lines_errors[i].append(error_type)
+            if _has_insufficient_points_in_segment(lines_data[i], kb_keys):
+                lines_errors[i].append('insufficient_points_in_segment')
+    return lines_errors
+
+
+def _filter_chunk(dataset_path: str, start: int, end: int, 
+                  out_path: str, max_dist: int, 
+                  grids: Optional[Dict[str, dict]],
+                  batch_size: int = 1024
+                  ) -> Tuple[int, Dict[str, List[int]]]:
+    """
+    Writes valid lines of the byte range [start, end) of the dataset
+    to `out_path`. If grids are given, lines are checked in batches
+    of `batch_size` (see `get_lines_errors`).
+
+    Returns:
+    --------
+    Number of lines in the chunk and error logs 
+    with line indexes relative to the chunk start.
+    """
+    error_logs = {error_type: [] for error_type in ERROR_TYPES}
+    grid_name_to_key_centers = None
+    if grids is not None:
+        grid_name_to_key_centers = {grid_name: get_key_centers_array(grid['keys'])
+                                    for grid_name, grid in grids.items()}
+    n_lines = 0
+    with open(dataset_path, 'rb') as f, open(out_path, 'wb') as out_f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            lines = []
+            while pos < end and len(lines) < batch_size:
+                line = f.readline()
+                if not line:
+                    break
+                pos += len(line)
+                lines.append(line)
+            if not lines:
+                break
+
+            lines_data = [json.loads(line) for line in lines]
+            if grids is not None:
+                lines_errors = get_lines_errors(
+                    lines_data, max_dist, grids, grid_name_to_key_centers)
+            else:
+                lines_errors = [get_line_errors(line_data, max_dist, grids) 
+                                for line_data in lines_data]
+
+            for line, errors in zip(lines, lines_errors):
+                for error_type in errors:
+                    error_logs[error_type].append(n_lines)
+                if not errors:
+                    out_f.write(line)
+                n_lines += 1
+    return n_lines, error_logs
+
+
+def _filter_chunk_star(args) -> Tuple[int, Dict[str, List[int]]]:
+    return _filter_chunk(*args)
+
+
 def create_dataset_without_errors(dataset_path: str,
                                   out_path: str,
                                   max_dist: int,
                                   grids: Dict[str, dict] = None,
-                                  total: Optional[int] = None) -> Dict[str, List[int]]:
+                                  num_workers: int = 1,
+                                  log_dir: Optional[str] = None) -> Dict[str, List[int]]:
     """
     Creates a version of a given dataset with invalid data filtered out.
 
+    The dataset is split into byte ranges that are filtered by a pool 
+    of `num_workers` processes. Valid lines of each range are written 
+    to a temporary file and the files are concatenated in order, 
+    so the output has the same order as the input.
+
     Arguments:
     ----------
     grids: str
@@ -37,6 +197,12 @@ def create_dataset_without_errors(dataset_path: str,
         Else
             Curves have grid_name attribute and don't have 
             grid attribute
+    num_workers: int
+        Number of worker processes. If 1, everything
+        is done in the main process.
+    log_dir: Optional[str]
+        If provided, indexes of lines with each error type are
+        written to `{log_dir}/{error_type}.txt` as chunks are merged.
 
     Returns:
     --------
@@ -45,48 +211,54 @@ def create_dataset_without_errors(dataset_path: str,
     """
     is_inplace = (os.path.abspath(dataset_path) == os.path.abspath(out_path))
     temp_out_path = out_path + '.tmp' if is_inplace else out_path
-    
-    error_logs = {
-        'non_monotonic_timestamps': [],
-        'points_too_far': [],
-        'insufficient_points_in_segment': []
-    }
-    
-    with open(dataset_path, encoding="utf-8") as f:
-        for i, line in tqdm(enumerate(f), total=total):
-            line_data = json.loads(line)
 
-            c = line_data['curve']
-            x, y, t = c['x'], c['y'], c['t']
-            if grids is not None:
-                kb_keys = grids[c['grid_name']]['keys']
-            else:
-                kb_keys = c['grid']['keys']
-
-            # Check each condition separately
-            monotonic_ok = monotoniacally_increases(t)
-            points_ok = points_not_too_far(x, y, kb_keys, max_dist)
-            segments_ok = over_two_points_in_each_segment(
-                line_data['word'], 
-                x, y,
-                get_label_to_key_map(kb_keys),
-                absent_chars_on_keyboard=('-',))
-            
-            # Log errors
-            if not monotonic_ok:
-                error_logs['non_monotonic_timestamps'].append(i)
-            if not points_ok:
-                error_logs['points_too_far'].append(i)
-            if not segments_ok:
-                error_logs['insufficient_points_in_segment'].append(i)
-
-            has_error = not (monotonic_ok and points_ok and segments_ok)
+    # Several chunks per worker make the load balanced.
+    n_chunks = max(num_workers, 1) * 8
+    chunks = get_byte_range_chunks(dataset_path, n_chunks)
+
+    error_logs = {error_type: [] for error_type in ERROR_TYPES}
+
+    chunks_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(out_path)))
+    log_files = {}
+    try:
+        if log_dir is not None:
+            os.makedirs(log_dir, exist_ok=True)
+            log_files = {error_type: open(os.path.join(log_dir, f"{error_type}.txt"), 
+                                          'w', encoding='utf-8')
+                         for error_type in ERROR_TYPES}
+
+        tasks = [(dataset_path, start, end, os.path.join(chunks_dir, f"{i}.jsonl"), 
+                  max_dist, grids)
+                 for i, (start, end) in enumerate(chunks)]
+        
+        executor = ProcessPoolExecutor(num_workers) if num_workers > 1 else None
+        try:
+            results = executor.map(_filter_chunk_star, tasks) if executor is not None \
+                else map(_filter_chunk_star, tasks)
             
-            if has_error:
-                continue
+            n_lines_before_chunk = 0
+            with open(temp_out_path, 'wb') as out_f:
+                # Results are yielded in the order of chunks.
+                for task, (n_lines, chunk_error_logs) in tqdm(
+                        zip(tasks, results), total=len(tasks)):
+                    chunk_out_path = task[3]
+                    with open(chunk_out_path, 'rb') as chunk_f:
+                        shutil.copyfileobj(chunk_f, out_f)
+                    os.remove(chunk_out_path)
 
-            with open(temp_out_path, 'a', encoding="utf-8") as out_f:
-                out_f.write(line)
+                    for error_type, idxs in chunk_error_logs.items():
+                        idxs = [n_lines_before_chunk + idx for idx in idxs]
+                        error_logs[error_type].extend(idxs)
+                        if error_type in log_files:
+                            log_files[error_type].writelines(f"{idx}\n" for idx in idxs)
+                    n_lines_before_chunk += n_lines
+        finally:
+            if executor is not None:
+                executor.shutdown()
+    finally:
+        for log_file in log_files.values():
+            log_file.close()
+        shutil.rmtree(chunks_dir, ignore_errors=True)
     
     if is_inplace:
         os.replace(temp_out_path, out_path)
@@ -99,6 +271,7 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument('--grids_path', type=str, required=True)
     parser.add_argument('--output_path', type=str, required=True)
     parser.add_argument('--log_dir', type=str, required=True)
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count())
     return parser.parse_args()
 
 def main():
@@ -115,23 +288,14 @@ def main():
         *get_kb_key_center(label2key['ц']['hitbox'])
     )
 
-    FULL_TRAIN_DATASET_LENGTH = 6_000_000
-
-    error_logs = create_dataset_without_errors(
+    create_dataset_without_errors(
         dataset_path=args.dataset_path,
         out_path=args.output_path,
         max_dist=max_dist,
         grids=grids,
-        total=FULL_TRAIN_DATASET_LENGTH  
+        num_workers=args.num_workers,
+        log_dir=args.log_dir
     )
 
-
-    os.makedirs(args.log_dir, exist_ok=True)
-    for error_type, indexes in error_logs.items():
-        log_file = os.path.join(args.log_dir, f"{error_type}.txt")
-        with open(log_file, 'w', encoding='utf-8') as f:
-            for idx in indexes:
-                f.write(f"{idx}\n")
-
 if __name__ == "__main__":
     main()
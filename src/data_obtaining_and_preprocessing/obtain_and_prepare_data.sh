@@ -2,7 +2,7 @@
 
 python data_obtaining_and_preprocessing/download_original_data.py
 
-python data_obtaining_and_preprocessing/separate_grid.py \
+python -m data_obtaining_and_preprocessing.separate_grid \
     --input_dir ../data/data_original \
     --output_dir ../data/data_preprocessed
 
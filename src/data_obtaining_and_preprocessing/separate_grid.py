@@ -1,10 +1,54 @@
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 import os
 import json
+import shutil
+import hashlib
+import tempfile
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 
 from tqdm import tqdm
 
+from data_obtaining_and_preprocessing.chunking import get_byte_range_chunks
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_loads(line: bytes) -> dict:
+    if orjson is not None:
+        return orjson.loads(line)
+    return json.loads(line)
+
+
+def _json_dumps(obj: dict, sort_keys: bool = False) -> bytes:
+    """
+    Compact json with non-ascii characters kept as is 
+    (same as json.dumps(obj, ensure_ascii=False, separators=(',', ':'))).
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), 
+                      sort_keys=sort_keys).encode('utf-8')
+
+
+def get_grid_hash(grid: dict) -> str:
+    """
+    Hash of a grid that doesn't depend on the order of keys in json.
+    """
+    return hashlib.blake2b(_json_dumps(grid, sort_keys=True), digest_size=16).hexdigest()
+
+
+def add_grid(grid_name_to_hash_and_grid: Dict[str, Tuple[str, dict]], 
+             grid_hash: str, grid: dict) -> None:
+    grid_name = grid['grid_name']
+    if grid_name not in grid_name_to_hash_and_grid:
+        grid_name_to_hash_and_grid[grid_name] = (grid_hash, grid)
+    elif grid_name_to_hash_and_grid[grid_name][0] != grid_hash:
+        raise ValueError(f"Different grids have the same name '{grid_name}'")
+
 
 def get_grid_name_to_grid(data_path: str,
                           total: Optional[int] = None
@@ -18,28 +62,102 @@ def get_grid_name_to_grid(data_path: str,
     return grid_name_to_grid
 
 
+def _separate_grid_in_chunk(data_path: str, start: int, end: int, out_path: str
+                            ) -> Dict[str, dict]:
+    """
+    Writes the lines of the byte range [start, end) of the dataset
+    with grids replaced by grid names to `out_path`.
+
+    Returns:
+    --------
+    Dict with hashes of the grids found in the chunk as keys 
+    and the grids as values.
+    """
+    grid_hash_to_grid = {}
+    # Serialized grid -> its hash. The same grid is serialized 
+    # the same way in the whole dataset, so it's hashed once.
+    grid_json_to_hash = {}
+    with open(data_path, 'rb') as f, open(out_path, 'wb') as out_f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            
+            line_data = _json_loads(line)
+            curve = line_data['curve']
+            grid = curve.pop('grid')
+            curve['grid_name'] = grid['grid_name']
+
+            grid_json = _json_dumps(grid)
+            if grid_json not in grid_json_to_hash:
+                grid_hash = get_grid_hash(grid)
+                grid_json_to_hash[grid_json] = grid_hash
+                grid_hash_to_grid[grid_hash] = grid
+
+            out_f.write(_json_dumps(line_data))
+            out_f.write(b'\n')
+    return grid_hash_to_grid
+
+
+def _separate_grid_in_chunk_star(args) -> Dict[str, dict]:
+    return _separate_grid_in_chunk(*args)
+
+
 def separate_grid(data_path: str,
                   out_path: str,
-                  total: Optional[int]  = None) -> None:                                             
-    if os.path.exists(out_path):
-        print(f"Warning {out_path} already exists. Skipping.")
-        return
-    
-    with open(data_path, 'r', encoding="utf-8") as f, open(out_path, 'w', encoding="utf-8") as out_f:
-        for line in tqdm(f, total = total):
-            line_data = json.loads(line)
+                  total: Optional[int]  = None,
+                  num_workers: int = 1) -> Optional[Dict[str, dict]]:
+    """
+    Replaces the `grid` property of each curve with `grid_name`.
 
-            g_name = line_data['curve']['grid']['grid_name']
+    The dataset is split into byte ranges that are processed by a pool 
+    of `num_workers` processes. The results are concatenated in order.
 
-            line_data['curve']['grid_name'] = g_name
+    Arguments:
+    ----------
+    total: Optional[int]
+        Is not used anymore: progress is reported in chunks.
+        Kept for backward compatibility.
 
-            del line_data['curve']['grid']
+    Returns:
+    --------
+    Dict with grid names as keys and grids as values 
+    or None if out_path already exists.
+    """
+    if os.path.exists(out_path):
+        print(f"Warning {out_path} already exists. Skipping.")
+        return None
+    
+    chunks = get_byte_range_chunks(data_path, max(num_workers, 1) * 8)
+    chunks_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(out_path)))
+    tasks = [(data_path, start, end, os.path.join(chunks_dir, f"{i}.jsonl"))
+             for i, (start, end) in enumerate(chunks)]
+    grid_name_to_hash_and_grid = {}
+    
+    executor = ProcessPoolExecutor(num_workers) if num_workers > 1 else None
+    try:
+        results = executor.map(_separate_grid_in_chunk_star, tasks) if executor is not None \
+            else map(_separate_grid_in_chunk_star, tasks)
+        with open(out_path + '.tmp', 'wb') as out_f:
+            # Results are yielded in the order of chunks.
+            for task, grid_hash_to_grid in tqdm(zip(tasks, results), total=len(tasks)):
+                chunk_out_path = task[3]
+                with open(chunk_out_path, 'rb') as chunk_f:
+                    shutil.copyfileobj(chunk_f, out_f)
+                os.remove(chunk_out_path)
+                for grid_hash, grid in grid_hash_to_grid.items():
+                    add_grid(grid_name_to_hash_and_grid, grid_hash, grid)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        shutil.rmtree(chunks_dir, ignore_errors=True)
+    
+    os.replace(out_path + '.tmp', out_path)
 
-            json.dump(line_data,
-                        out_f,
-                        ensure_ascii=False,
-                        separators=(',', ':'))
-            out_f.write('\n')
+    return {grid_name: grid for grid_name, (_, grid) in grid_name_to_hash_and_grid.items()}
 
 
 
@@ -75,23 +193,41 @@ def separate_grid_primitive(data_path: str,
 
 def create_all_datasets_with_separated_grid(data_paths: List[str],
                                             out_paths: List[str],
-                                            totals: List[Optional[int]]
-                                            ) -> None:
+                                            totals: List[Optional[int]],
+                                            num_workers: int = 1
+                                            ) -> Dict[str, dict]:
+    """
+    Returns:
+    --------
+    Dict with grid names as keys and grids as values
+    collected from all the datasets.
+    """
     assert len(data_paths) == len(out_paths) == len(totals)
 
+    grid_name_to_hash_and_grid = {}
     for data_path, out_path, total in zip(data_paths, out_paths, totals):
         # сделать функцию, генерирующую новую версию одного файла и запустить цикл
-        separate_grid(
+        grid_name_to_grid = separate_grid(
             data_path,
             out_path,
-            total
+            total,
+            num_workers
         )
+        if grid_name_to_grid is None:
+            # The file was converted before, the grids are collected 
+            # from the original file.
+            grid_name_to_grid = get_grid_name_to_grid(data_path, total)
+        for grid in grid_name_to_grid.values():
+            add_grid(grid_name_to_hash_and_grid, get_grid_hash(grid), grid)
+
+    return {grid_name: grid for grid_name, (_, grid) in grid_name_to_hash_and_grid.items()}
     
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description='Separate grid information from dataset files.')
     parser.add_argument('--input_dir', type=str, required=True, help='Input directory containing original dataset files.')
     parser.add_argument('--output_dir', type=str, required=True, help='Output directory for processed files.')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(), help='Number of worker processes.')
     args = parser.parse_args()
     return args
     
@@ -104,13 +240,9 @@ def main():
     out_paths = [os.path.join(args.output_dir, f_name) for f_name in f_names]
     totals = [6_000_000, 10_000, 10_000]
     
-    create_all_datasets_with_separated_grid(data_paths, out_paths, totals)
-    
-    # Collect grids from all data files
-    grid_name_to_grid = {}
-    for data_path in data_paths:
-        current_grids = get_grid_name_to_grid(data_path, total=None)
-        grid_name_to_grid.update(current_grids)
+    # Grids are collected from all data files while they are converted
+    grid_name_to_grid = create_all_datasets_with_separated_grid(
+        data_paths, out_paths, totals, args.num_workers)
     
     grid_name_to_grid_path = os.path.join(args.output_dir, "gridname_to_grid.json")
     with open(grid_name_to_grid_path, 'w', encoding='utf-8') as f:
@@ -118,4 +250,4 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
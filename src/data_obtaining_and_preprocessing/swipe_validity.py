@@ -1,31 +1,113 @@
-from typing import List, Tuple
+from typing import List, Tuple, Dict, Optional, Sequence
 
-from data_analysis.get_segments import get_segments
-from grid_processing_utils import get_kb_key_center, distance, get_key_centers
+import numpy as np
+
+from data_analysis.get_segments import get_segments, get_segment_lengths
+from grid_processing_utils import get_kb_key_center, get_key_centers
+
+
+def get_key_centers_array(kb_keys: List[dict]) -> np.ndarray:
+    """
+    Returns an array of shape (n_keys, 2) with centers of all the keys.
+    Is meant to be computed once per grid.
+    """
+    return np.array([get_kb_key_center(key['hitbox']) for key in kb_keys],
+                    dtype=np.float64).reshape(-1, 2)
+
+
+def get_non_monotonic_mask(time: Sequence[int]) -> np.ndarray:
+    """
+    Returns a boolean mask of shape (len(time),) that is True for 
+    timestamps that are not greater than the previous one.
+    """
+    time = np.asarray(time, dtype=np.int64)
+    mask = np.zeros(len(time), dtype=bool)
+    mask[1:] = time[1:] <= time[:-1]
+    return mask
+
+
+def get_points_too_far_mask(x_list: Sequence[int],
+                            y_list: Sequence[int],
+                            key_centers: np.ndarray,
+                            max_dist: float) -> np.ndarray:
+    """
+    Returns a boolean mask that is True for points whose distance 
+    to every key center is at least `max_dist`.
+
+    Arguments:
+    ----------
+    key_centers: np.ndarray
+        Array of shape (n_keys, 2) (see get_key_centers_array).
+    """
+    X = np.asarray(x_list, dtype=np.float64)
+    Y = np.asarray(y_list, dtype=np.float64)
+    dists = np.sqrt((X[:, None] - key_centers[None, :, 0])**2 
+                    + (Y[:, None] - key_centers[None, :, 1])**2)
+    return ~(dists < max_dist).any(axis=1)
 
 
 def monotoniacally_increases(time: List[int]) -> bool:
-    for i, t in enumerate(time[1:], 1):
-        if t <= time[i-1]:
-            return False
-    return True
+    return not get_non_monotonic_mask(time).any()
 
 
 def points_not_too_far(x_list: List[int],
                        y_list: List[int],
                        kb_keys: dict,
-                       max_dist: int) -> bool:
-    for x, y in zip(x_list, y_list):
-        not_too_far = False
-        for key in kb_keys:
-            key_x, key_y = get_kb_key_center(key['hitbox'])
-            dist = distance(x, y, key_x, key_y)
-            if dist < max_dist:
-                not_too_far = True
-                break
-        if not not_too_far:
-            return False
-    return True  
+                       max_dist: int,
+                       key_centers: Optional[np.ndarray] = None) -> bool:
+    """
+    Arguments:
+    ----------
+    key_centers: Optional[np.ndarray]
+        Precomputed get_key_centers_array(kb_keys).
+    """
+    if key_centers is None:
+        key_centers = get_key_centers_array(kb_keys)
+    return not get_points_too_far_mask(x_list, y_list, key_centers, max_dist).any()
+
+
+def _reduce_by_swipe(point_mask: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Given a mask of all points of packed swipes returns 
+    a mask that is True for swipes with at least one True point.
+    """
+    cumulative_counts = np.concatenate([[0], np.cumsum(point_mask, dtype=np.int64)])
+    return cumulative_counts[offsets[1:]] > cumulative_counts[offsets[:-1]]
+
+
+def get_swipes_error_masks(X: np.ndarray, 
+                           Y: np.ndarray, 
+                           T: np.ndarray, 
+                           offsets: np.ndarray,
+                           key_centers: np.ndarray,
+                           max_dist: float) -> Dict[str, np.ndarray]:
+    """
+    Checks a batch of packed swipes of the same grid at once.
+
+    Arguments:
+    ----------
+    X, Y, T: np.ndarray
+        Concatenated coordinates and timestamps of all the swipes.
+    offsets: np.ndarray
+        Array of shape (n_swipes + 1,): the i-th swipe is 
+        X[offsets[i]: offsets[i+1]].
+    key_centers: np.ndarray
+        Array of shape (n_keys, 2) (see get_key_centers_array).
+
+    Returns:
+    --------
+    Dict with error types ('non_monotonic_timestamps', 'points_too_far') 
+    as keys and boolean masks of shape (n_swipes,) as values.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    non_monotonic = get_non_monotonic_mask(T)
+    # The first point of a swipe is not compared to the previous swipe.
+    non_monotonic[offsets[:-1][offsets[:-1] < len(non_monotonic)]] = False
+    return {
+        'non_monotonic_timestamps': _reduce_by_swipe(non_monotonic, offsets),
+        'points_too_far': _reduce_by_swipe(
+            get_points_too_far_mask(X, Y, key_centers, max_dist), offsets),
+    }
 
 
 def n_segments_is_correct(tgt_word, segments):
@@ -59,12 +141,10 @@ def over_two_points_in_each_segment(tgt_word: str,
     threshold_len = 2
 
     key_centers = get_key_centers(tgt_word, label2key, absent_chars_on_keyboard)
-    segments = get_segments(key_centers, x, y)
+    segment_lengths = get_segment_lengths(key_centers, x, y)
 
-    if not n_segments_is_correct(tgt_word, segments):
+    if not n_segments_is_correct(tgt_word, segment_lengths):
+        segments = get_segments(key_centers, x, y)
         print(f"Warning: n_segments = {len(segments)} for {tgt_word} and {segments}")
     
-    for segment in segments:
-        if len(segment) < threshold_len:
-            return False
-    return True
+    return bool((segment_lengths >= threshold_len).all())
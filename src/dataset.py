@@ -1,13 +1,16 @@
+import os
 import json
-from typing import Optional, List, Tuple, Callable
+from typing import Optional, List, Tuple, Callable, Iterator
 import array
+import random
 from multiprocessing import Pool
 
 
+import numpy as np
 import torch
-from torch.utils.data import Dataset
+import torch.distributed as dist
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
 from tqdm import tqdm
-from torch.nn.utils.rnn import pad_sequence
 
 
 RawDatasetEl = Tuple[array.array, array.array, 
@@ -186,6 +189,233 @@ class CurveDatasetWithMultiProcInit(CurveDataset):
 
 
 
+# Columnar binary dataset layout (see 
+# data_obtaining_and_preprocessing/convert_dataset_to_columnar.py).
+# Every `.bin` file is a raw little-endian array.
+# * x.bin, y.bin, t.bin - concatenated coordinates of all swipes (int16)
+# * offsets.bin - swipe i occupies [offsets[i], offsets[i+1]) (int64)
+# * grid_name_ids.bin - index in meta['grid_names'] (int16)
+# * word_ids.bin - index in meta['words'] or -1 if there is no word (int32)
+# * meta.json - {"n_swipes": int, "grid_names": List[str], "words": List[str]}
+COLUMNAR_DATASET_DTYPES = {
+    'x': np.dtype('<i2'),
+    'y': np.dtype('<i2'),
+    't': np.dtype('<i2'),
+    'offsets': np.dtype('<i8'),
+    'grid_name_ids': np.dtype('<i2'),
+    'word_ids': np.dtype('<i4'),
+}
+COLUMNAR_DATASET_META_FILENAME = 'meta.json'
+
+
+class CurveDatasetColumnar(Dataset):
+    """
+    CurveDataset counterpart that reads a dataset converted to 
+    the columnar binary layout. It's not a CurveDataset subclass:
+    there is no data_list, only the indexing interface is shared. 
+    
+    All columns are opened with np.memmap: there is no parsing, 
+    the startup is almost instant and DataLoader workers share 
+    the page cache instead of copying the data.
+
+    curve_dataset_obj[i] is a tuple (X, Y, T, grid_name, tgt_word)
+    of the same types as in CurveDataset (RawDatasetEl) and
+    `get_item_transform` is applied to it if provided.
+    There is no `init_transform`: precomputing features for 
+    the whole dataset would defeat the purpose of this class.
+    """
+
+    def __init__(self,
+                 data_dir: str,
+                 store_gnames: bool,
+                 get_item_transform: Optional[Callable] = None):
+        """
+        Arguments:
+        ----------
+        data_dir: str
+            Directory created by convert_dataset_to_columnar.py
+        store_gnames: bool
+            If True, stores grid names in self.grid_name_list.
+        get_item_transform: Optional[Callable]
+            A function that takes raw data (X, Y, T, grid_name, tgt_word)
+            and returns (model_input, target).
+        """
+        self.data_dir = data_dir
+        self.transform = get_item_transform
+
+        with open(os.path.join(data_dir, COLUMNAR_DATASET_META_FILENAME), 
+                  encoding='utf-8') as f:
+            meta = json.load(f)
+        self.n_swipes = meta['n_swipes']
+        self.grid_names = meta['grid_names']
+        self.words = meta['words']
+
+        self._columns = None
+
+        if store_gnames:
+            grid_name_ids = self.columns['grid_name_ids']
+            self.grid_name_list = [self.grid_names[i] for i in grid_name_ids.tolist()]
+
+    @property
+    def columns(self) -> dict:
+        # Memory maps are opened lazily so that after pickling 
+        # (ex. for DataLoader workers with spawn start method)
+        # each process maps the files instead of receiving a copy.
+        if self._columns is None:
+            self._columns = {
+                name: np.memmap(os.path.join(self.data_dir, f'{name}.bin'), 
+                                dtype=dtype, mode='r')
+                for name, dtype in COLUMNAR_DATASET_DTYPES.items()
+            }
+        return self._columns
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_columns'] = None
+        return state
+
+    def __len__(self):
+        return self.n_swipes
+
+    @staticmethod
+    def _to_array(column_slice: np.ndarray) -> array.array:
+        # Feature extractors expect python ints when iterating 
+        # over coordinates (int16 numpy scalars may overflow).
+        arr = array.array('h')
+        arr.frombytes(column_slice.astype(np.int16).tobytes())
+        return arr
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self.n_swipes
+        if not 0 <= idx < self.n_swipes:
+            raise IndexError(f"Index {idx} is out of range")
+        columns = self.columns
+        start, end = columns['offsets'][idx: idx + 2]
+        word_id = columns['word_ids'][idx]
+        X, Y, T = (self._to_array(columns[name][start: end]) for name in 'xyt')
+        sample = (X, Y, T,
+                  self.grid_names[columns['grid_name_ids'][idx]],
+                  self.words[word_id] if word_id >= 0 else None)
+        if self.transform:
+            sample = self.transform(sample)
+        return sample
+
+
+class CurveDatasetStreaming(IterableDataset):
+    """
+    IterableDataset counterpart of CurveDataset that reads 
+    the data lazily instead of materializing it in memory.
+
+    Supports jsonl datasets and directories created by 
+    convert_dataset_to_columnar.py (see CurveDatasetColumnar).
+
+    Dataset elements are sharded across DataLoader workers and 
+    distributed ranks: element i goes to shard i % n_shards,
+    where shard id is `rank * n_workers + worker_id`. Elements of 
+    other shards are skipped without parsing. `init_transform` and 
+    `get_item_transform` are applied on the fly. 
+
+    If `shuffle_buffer_size` > 0, elements are shuffled with a bounded
+    buffer: each new element replaces a random one from the buffer 
+    and the replaced one is yielded. Call `set_epoch` before each epoch 
+    to get a different order.
+    """
+
+    def __init__(self,
+                 data_path: str,
+                 init_transform: Optional[Callable] = None,
+                 get_item_transform: Optional[Callable] = None,
+                 shuffle_buffer_size: int = 0,
+                 seed: int = 0,
+                 rank: Optional[int] = None,
+                 world_size: Optional[int] = None):
+        """
+        Arguments:
+        ----------
+        data_path: str
+            Path to a jsonl dataset (see CurveDataset) or to 
+            a directory with a dataset in columnar format.
+        init_transform: Optional[Callable]
+            A function that takes raw data (X, Y, T, grid_name, tgt_word)
+            and returns semi-extracted features.
+        get_item_transform: Optional[Callable]
+            A function that takes semi-extracted features and returns 
+            (model_input, target).
+        shuffle_buffer_size: int
+            Size of the shuffle buffer. 0 means no shuffling.
+        seed: int
+            Seed of the shuffle buffer random generator.
+        rank: Optional[int]
+        world_size: Optional[int]
+            If not provided, are taken from torch.distributed 
+            if it's initialized, otherwise a single process is assumed.
+        """
+        self.data_path = data_path
+        self.init_transform = init_transform
+        self.get_item_transform = get_item_transform
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def _get_shard(self) -> Tuple[int, int]:
+        """
+        Returns (shard_id, n_shards) of the current process.
+        """
+        rank, world_size = self.rank, self.world_size
+        if rank is None or world_size is None:
+            is_distributed = dist.is_available() and dist.is_initialized()
+            rank = dist.get_rank() if is_distributed else 0
+            world_size = dist.get_world_size() if is_distributed else 1
+        
+        worker_info = get_worker_info()
+        worker_id, n_workers = (0, 1) if worker_info is None \
+            else (worker_info.id, worker_info.num_workers)
+        
+        return rank * n_workers + worker_id, world_size * n_workers
+
+    def _iter_raw(self, shard_id: int, n_shards: int) -> Iterator[RawDatasetEl]:
+        if os.path.isdir(self.data_path):
+            dataset = CurveDatasetColumnar(self.data_path, store_gnames=False)
+            for i in range(shard_id, len(dataset), n_shards):
+                yield dataset[i]
+            return
+        
+        with open(self.data_path, "r", encoding="utf-8") as json_file:
+            for i, line in enumerate(json_file):
+                if i % n_shards == shard_id:
+                    yield _get_data_from_json_line(line)
+
+    def _shuffle(self, iterable, rng: random.Random) -> Iterator:
+        buffer = []
+        for el in iterable:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(el)
+                continue
+            idx = rng.randrange(self.shuffle_buffer_size)
+            buffer[idx], el = el, buffer[idx]
+            yield el
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        shard_id, n_shards = self._get_shard()
+        samples = self._iter_raw(shard_id, n_shards)
+        if self.init_transform is not None:
+            samples = map(self.init_transform, samples)
+        if self.shuffle_buffer_size > 0:
+            rng = random.Random(hash((self.seed, self.epoch, shard_id)))
+            samples = self._shuffle(samples, rng)
+        if self.get_item_transform is not None:
+            samples = map(self.get_item_transform, samples)
+        return samples
+
+
 class CurveDatasetSubset:
     def __init__(self, dataset: CurveDataset, grid_name: str):
         assert hasattr(dataset, 'grid_name_list'), \
@@ -211,12 +441,235 @@ class CurveDatasetSubset:
 
 
 
+def get_sample_lengths(sample) -> Tuple[int, Optional[int]]:
+    """
+    Returns (swipe_len, word_len) of a dataset element that is either 
+    raw data (X, Y, T, grid_name, tgt_word) or transformed data 
+    ((encoder_in, decoder_in), decoder_out). word_len is None
+    if there is no target word.
+    """
+    if len(sample) == 5:
+        X, _, _, _, tgt_word = sample
+        return len(X), None if tgt_word is None else len(tgt_word)
+    (encoder_in, decoder_in), _ = sample
+    encoder_in_el = encoder_in if isinstance(encoder_in, torch.Tensor) else encoder_in[0]
+    return len(encoder_in_el), None if decoder_in is None else len(decoder_in)
+
+
+def get_swipe_and_word_lengths(dataset) -> Tuple[List[int], Optional[List[int]]]:
+    """
+    Returns swipe lengths and word lengths (None if there are no 
+    target words) of all dataset elements. Supports CurveDataset, 
+    CurveDatasetColumnar, CurveDatasetSubset, datasets with their own
+    `get_swipe_and_word_lengths` method (ex. CachedFeaturesDataset)
+    and any dataset whose elements are accepted by `get_sample_lengths`.
+    """
+    if isinstance(dataset, CurveDatasetSubset):
+        swipe_lens, word_lens = get_swipe_and_word_lengths(dataset.dataset)
+        swipe_lens = [swipe_lens[i] for i in dataset.grid_idxs]
+        if word_lens is not None:
+            word_lens = [word_lens[i] for i in dataset.grid_idxs]
+        return swipe_lens, word_lens
+
+    if isinstance(dataset, CurveDatasetColumnar):
+        columns = dataset.columns
+        swipe_lens = np.diff(columns['offsets']).tolist()
+        word_ids = columns['word_ids'].tolist()
+        if len(word_ids) == 0 or word_ids[0] < 0:
+            return swipe_lens, None
+        return swipe_lens, [len(dataset.words[word_id]) for word_id in word_ids]
+
+    if hasattr(dataset, 'get_swipe_and_word_lengths'):
+        return dataset.get_swipe_and_word_lengths()
+
+    # Samples are taken from data_list to avoid get_item_transform.
+    samples = getattr(dataset, 'data_list', None)
+    if samples is None:
+        samples = (dataset[i] for i in range(len(dataset)))
+    swipe_lens, word_lens = [], []
+    for sample in samples:
+        swipe_len, word_len = get_sample_lengths(sample)
+        swipe_lens.append(swipe_len)
+        word_lens.append(word_len)
+    if len(word_lens) == 0 or word_lens[0] is None:
+        word_lens = None
+    return swipe_lens, word_lens
+
+
+def get_padding_ratio(lengths: List[int], batches: List[List[int]]) -> float:
+    """
+    Returns the fraction of padding among all the elements 
+    of padded batches.
+    """
+    n_padded = sum(len(batch) * max(lengths[i] for i in batch) for batch in batches)
+    if n_padded == 0:
+        return 0.0
+    return 1 - sum(lengths[i] for batch in batches for i in batch) / n_padded
+
+
+class LengthBucketedBatchSampler(Sampler):
+    """
+    Batch sampler that groups dataset elements with similar 
+    swipe lengths (and optionally word lengths) to reduce padding.
+
+    If `shuffle` is False, the elements are sorted by length and 
+    batches with the longest swipes go first (so that the memory peak
+    happens at the start). 
+    
+    If `shuffle` is True, the elements are split into buckets of 
+    swipes with the same `swipe_len // bucket_width` (and 
+    `word_len // word_bucket_width` if word lengths are given),
+    the elements are shuffled within buckets and the resulting 
+    batches are shuffled. Call `set_epoch` before each epoch
+    to get a different order.
+
+    A batch is limited by `batch_size` elements and/or by `max_tokens`:
+    the padded size of the batch (batch_len * max_swipe_len) 
+    doesn't exceed `max_tokens` unless a single swipe is longer.
+    """
+
+    def __init__(self,
+                 swipe_lengths: List[int],
+                 batch_size: Optional[int] = None,
+                 max_tokens: Optional[int] = None,
+                 word_lengths: Optional[List[int]] = None,
+                 shuffle: bool = True,
+                 bucket_width: int = 8,
+                 word_bucket_width: int = 2,
+                 drop_last: bool = False,
+                 seed: int = 0):
+        """
+        Arguments:
+        ----------
+        swipe_lengths: List[int]
+            Swipe lengths of all dataset elements 
+            (see get_swipe_and_word_lengths).
+        batch_size: Optional[int]
+            Maximum number of elements in a batch.
+        max_tokens: Optional[int]
+            Maximum padded size of a batch.
+        word_lengths: Optional[List[int]]
+            If provided, elements are also grouped by word lengths.
+        shuffle: bool
+            Whether to shuffle elements within buckets and batches.
+        bucket_width: int
+            Range of swipe lengths of a bucket (used only if shuffle is True).
+        word_bucket_width: int
+            Range of word lengths of a bucket (used only if shuffle is True).
+        drop_last: bool
+            If True, batches with less than `batch_size` elements
+            are dropped (only when `max_tokens` is None).
+        seed: int
+        """
+        assert batch_size is not None or max_tokens is not None, \
+            "batch_size or max_tokens must be provided"
+        if word_lengths is not None:
+            assert len(word_lengths) == len(swipe_lengths)
+        self.swipe_lengths = list(swipe_lengths)
+        self.word_lengths = None if word_lengths is None else list(word_lengths)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.bucket_width = bucket_width
+        self.word_bucket_width = word_bucket_width
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self._batches = None
+
+    @classmethod
+    def from_dataset(cls, dataset, use_word_lengths: bool = False, **kwargs
+                     ) -> 'LengthBucketedBatchSampler':
+        swipe_lengths, word_lengths = get_swipe_and_word_lengths(dataset)
+        return cls(swipe_lengths, word_lengths=word_lengths if use_word_lengths else None,
+                   **kwargs)
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+        self._batches = None
+
+    def _get_key(self, idx: int) -> Tuple[int, int]:
+        word_len = 0 if self.word_lengths is None else self.word_lengths[idx]
+        return self.swipe_lengths[idx], word_len
+
+    def _split_into_batches(self, idxs: List[int]) -> List[List[int]]:
+        batches = []
+        batch = []
+        batch_max_len = 0
+        for idx in idxs:
+            max_len = max(batch_max_len, self.swipe_lengths[idx])
+            is_full = (self.batch_size is not None and len(batch) >= self.batch_size) \
+                or (self.max_tokens is not None and (len(batch) + 1) * max_len > self.max_tokens)
+            if batch and is_full:
+                batches.append(batch)
+                batch = []
+                max_len = self.swipe_lengths[idx]
+            batch.append(idx)
+            batch_max_len = max_len
+        if batch:
+            batches.append(batch)
+        if self.drop_last and self.max_tokens is None:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        return batches
+
+    def _create_batches(self) -> List[List[int]]:
+        idxs = range(len(self.swipe_lengths))
+        if not self.shuffle:
+            return self._split_into_batches(
+                sorted(idxs, key=self._get_key, reverse=True))
+
+        rng = random.Random(hash((self.seed, self.epoch)))
+        buckets = {}
+        for idx in idxs:
+            swipe_len, word_len = self._get_key(idx)
+            bucket_key = (swipe_len // self.bucket_width, word_len // self.word_bucket_width)
+            buckets.setdefault(bucket_key, []).append(idx)
+        batches = []
+        for bucket_key in sorted(buckets):
+            bucket = buckets[bucket_key]
+            rng.shuffle(bucket)
+            batches.extend(self._split_into_batches(bucket))
+        rng.shuffle(batches)
+        return batches
+
+    @property
+    def batches(self) -> List[List[int]]:
+        if self._batches is None:
+            self._batches = self._create_batches()
+        return self._batches
+
+    def get_padding_ratio(self) -> float:
+        """
+        Returns the fraction of swipe padding in the batches of the current epoch.
+        """
+        return get_padding_ratio(self.swipe_lengths, self.batches)
+
+    def __iter__(self) -> Iterator[List[int]]:
+        return iter(self.batches)
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+
 class CollateFnV2:
     def __init__(self, batch_first: bool, word_pad_idx: int, 
-                 swipe_pad_idx: int = 0) -> None:
+                 swipe_pad_idx: int = 0, pin_memory: bool = False) -> None:
+        """
+        Arguments:
+        ----------
+        batch_first: bool
+            If True, padded sequences have shape (batch_size, seq_len, ...),
+            otherwise (seq_len, batch_size, ...).
+        word_pad_idx: int
+        swipe_pad_idx: int
+        pin_memory: bool
+            If True and CUDA is available, padded tensors are 
+            allocated in pinned memory (faster host to device copy).
+        """
         self.word_pad_idx = word_pad_idx
         self.batch_first = batch_first
         self.swipe_pad_idx = swipe_pad_idx
+        self.pin_memory = pin_memory and torch.cuda.is_available()
 
     def _assert_encoder_in_type_and_shape(self, encoder_in_example):
         assert len(encoder_in_example) == 2
@@ -233,6 +686,39 @@ class CollateFnV2:
             return False
         else:
             raise ValueError(f"Unknown type of encoder input {type(batch[0][0])}")
+
+    def _get_flat_idxs(self, lens: torch.Tensor, max_len: int) -> torch.Tensor:
+        """
+        Returns the indices of all the elements of concatenated 
+        sequences with lengths `lens` in the flattened padded tensor.
+        """
+        batch_idxs = torch.repeat_interleave(torch.arange(len(lens)), lens)
+        seq_starts = torch.cumsum(lens, 0) - lens
+        position_idxs = torch.arange(len(batch_idxs)) - seq_starts[batch_idxs]
+        if self.batch_first:
+            return batch_idxs * max_len + position_idxs
+        return position_idxs * len(lens) + batch_idxs
+
+    def _pad(self, seqs: List[torch.Tensor], max_len: int,
+             flat_idxs: torch.Tensor, padding_value: int) -> torch.Tensor:
+        """
+        pad_sequence counterpart that allocates the output once 
+        and copies all the sequences with a single index_copy_.
+        """
+        batch_size = len(seqs)
+        trailing_shape = seqs[0].shape[1:]
+        shape = (batch_size, max_len) if self.batch_first else (max_len, batch_size)
+        padded = torch.empty(shape + trailing_shape, dtype=seqs[0].dtype, 
+                             pin_memory=self.pin_memory)
+        padded.fill_(padding_value)
+        padded.view((-1,) + trailing_shape).index_copy_(0, flat_idxs, torch.cat(seqs))
+        return padded
+
+    @staticmethod
+    def _get_pad_mask(lens: torch.Tensor, max_len: int) -> torch.Tensor:
+        # (batch_size, max_len) with True on positions 
+        # greater or equal to the length of the corresponding sequence.
+        return torch.arange(max_len).unsqueeze(0) >= lens.unsqueeze(1)
     
     def __call__(self, batch: list):
         """
@@ -263,55 +749,46 @@ class CollateFnV2:
                 - dec_in: (chars_seq_len - 1, batch_size)
                 - swipe_pad_mask: (batch_size, curve_len)
                 - word_pad_mask: (batch_size, chars_seq_len - 1, )
+                dec_in and word_pad_mask are None if the batch 
+                has no target words.
+            2. decoder_out (None if the batch has no target words)
         """
         is_encoder_input_tuple = self._is_encoder_input_tuple(batch)
-        dec_in_no_pad = []
-        dec_out_no_pad = []
-
-        encoder_in_no_pad = ([], []) if is_encoder_input_tuple else []
-
-        for row in batch:
-            x_smpl, decoder_out_smpl = row
-            encoder_in_smpl, decoder_in_smpl = x_smpl
-            if is_encoder_input_tuple:
-                for i in range(2):
-                    encoder_in_no_pad[i].append(encoder_in_smpl[i])
-            else:
-                encoder_in_no_pad.append(encoder_in_smpl)
-
-            dec_in_no_pad.append(decoder_in_smpl)
-            dec_out_no_pad.append(decoder_out_smpl)
 
+        encoder_in_no_pad = [x_smpl[0] for x_smpl, _ in batch]
         if is_encoder_input_tuple:
-            encoder_in = tuple(pad_sequence(encoder_in_no_pad_i, batch_first=self.batch_first, 
-                                       padding_value=self.swipe_pad_idx)
-                          for encoder_in_no_pad_i in encoder_in_no_pad)
+            encoder_in_no_pad = list(zip(*encoder_in_no_pad))
         else:
-            encoder_in = pad_sequence(encoder_in_no_pad, batch_first=self.batch_first,
-                                      padding_value=self.swipe_pad_idx)
-
-        dec_out = pad_sequence(dec_out_no_pad, batch_first=self.batch_first,
-                                        padding_value=self.word_pad_idx)
-        
-        dec_in = pad_sequence(dec_in_no_pad, batch_first=self.batch_first,
-                                        padding_value=self.word_pad_idx)
-        
-        word_pad_mask = dec_in == self.word_pad_idx
-        if not self.batch_first:
-            word_pad_mask = word_pad_mask.T  # word_pad_mask is always batch first
-
-        encoder_in_el = encoder_in[0] if is_encoder_input_tuple else encoder_in
-        max_curve_len = encoder_in_el.shape[1] if self.batch_first else encoder_in_el.shape[0]
-        encoder_in_no_pad_el = encoder_in_no_pad[0] if is_encoder_input_tuple else encoder_in_no_pad
-        encoder_lens = torch.tensor([len(x) for x in encoder_in_no_pad_el])
-
-        # Берем матрицу c len(encoder_lens) строками вида
-        # [0, 1, ... , max_curve_len - 1].  Каждый элемент i-ой строки
-        # сравниваем с длиной i-ой траектории.  Получится матрица, где True
-        # только на позициях, больших, чем длина соответствующей траектории.
-        # (batch_size, max_curve_len)
-        encoder_pad_mask = torch.arange(max_curve_len).expand(
-            len(encoder_lens), max_curve_len) >= encoder_lens.unsqueeze(1)
+            encoder_in_no_pad = [encoder_in_no_pad]
+
+        # All parts of encoder input have the same length.
+        encoder_lens = torch.tensor([len(x) for x in encoder_in_no_pad[0]])
+        max_curve_len = int(encoder_lens.max())
+        encoder_flat_idxs = self._get_flat_idxs(encoder_lens, max_curve_len)
+
+        encoder_in = tuple(
+            self._pad(seqs, max_curve_len, encoder_flat_idxs, self.swipe_pad_idx)
+            for seqs in encoder_in_no_pad)
+        if not is_encoder_input_tuple:
+            encoder_in = encoder_in[0]
+
+        encoder_pad_mask = self._get_pad_mask(encoder_lens, max_curve_len)
+
+        # Datasets without target words (ex. test set) have
+        # decoder_in and decoder_out equal to None.
+        dec_in, dec_out, word_pad_mask = None, None, None
+        if batch[0][0][1] is not None:
+            dec_in_no_pad = [x_smpl[1] for x_smpl, _ in batch]
+            dec_out_no_pad = [dec_out_smpl for _, dec_out_smpl in batch]
+            word_lens = torch.tensor([len(x) for x in dec_in_no_pad])
+            max_word_len = int(word_lens.max())
+            word_flat_idxs = self._get_flat_idxs(word_lens, max_word_len)
+            dec_in = self._pad(dec_in_no_pad, max_word_len, 
+                               word_flat_idxs, self.word_pad_idx)
+            dec_out = self._pad(dec_out_no_pad, max_word_len, 
+                                word_flat_idxs, self.word_pad_idx)
+            # word_pad_mask is always batch first
+            word_pad_mask = self._get_pad_mask(word_lens, max_word_len)
         
         transformer_in = (encoder_in, dec_in, encoder_pad_mask, word_pad_mask)
         
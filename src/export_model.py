@@ -0,0 +1,347 @@
+"""
+Exports v3 models (see MODEL_GETTERS_DICT) as two standalone TorchScript graphs:
+
+* encoder: (x_pad_mask, *encoder_in) -> memory_kv
+    memory_kv is of shape (curve_len, batch_size, 2 * n_layers * d_model):
+    cross-attention keys and values of every decoder layer
+    concatenated along the last dimension. They are computed once
+    per swipe, so the decoder never projects the memory again.
+* decoder_step: (y, self_attn_keys, self_attn_values, memory_kv, memory_pad_mask)
+    -> (logits, self_attn_keys, self_attn_values)
+    Same as EncoderDecoderTransformerLike.decode_incremental.
+    y is the whole prefix (chars_seq_len, n_rows), self-attention
+    keys and values are of shape (n_layers, n_rows, n_heads, chars_seq_len - 1, head_dim),
+    memory_kv and memory_pad_mask are given for every row.
+
+`ExportedModel` wraps the graphs with the interface of
+EncoderDecoderTransformerLike needed by word generators with
+`use_kv_cache=True`, so greedy and beam search of word_generators_v2
+run on exported graphs as is. The graphs are loaded
+without the model code, the training stack and the weights checkpoint.
+
+Usage example:
+python src/export_model.py --model-name v3_nearest_only_transformer_bigger \
+    --weights-path ./weights.pt --n-coord-feats 0 --out-dir ./exported \
+    --voc-path ./data/data_preprocessed/voc.txt
+"""
+
+from typing import List, Tuple, Dict, Optional, Union, Callable
+import os
+import json
+import argparse
+import warnings
+
+import torch
+import torch.nn as nn
+from torch import Tensor
+
+from model import (MODEL_GETTERS_DICT, EncoderDecoderTransformerLike,
+                   DecoderCache, _split_heads, _merge_heads)
+
+
+EXPORT_META_FILENAME = 'meta.json'
+
+N_KEYS = 37
+
+
+def get_example_encoder_in(model_name: str, n_coord_feats: int,
+                           curve_len: int = 16, batch_size: Optional[int] = 2
+                           ) -> Union[Tensor, Tuple[Tensor, Tensor]]:
+    """
+    Returns a random encoder input of a v3 model of shape 
+    (curve_len, batch_size, ...): dimension 1 is the batch dimension.
+    If `batch_size` is None, the batch dimension is omitted (a single swipe).
+    """
+    if batch_size is None:
+        encoder_in = get_example_encoder_in(model_name, n_coord_feats, curve_len, 1)
+        if isinstance(encoder_in, Tensor):
+            return encoder_in.squeeze(1)
+        return tuple(el.squeeze(1) for el in encoder_in)
+
+    kb_tokens = torch.randint(0, N_KEYS, (curve_len, batch_size))
+    if model_name == 'v3_nearest_only_transformer_bigger':
+        return kb_tokens
+    traj_feats = torch.randn(curve_len, batch_size, n_coord_feats)
+    if model_name == 'v3_nearest_and_traj_transformer_bigger':
+        return traj_feats, kb_tokens
+    if model_name == 'v3_weighted_and_traj_transformer_bigger':
+        return traj_feats, torch.rand(curve_len, batch_size, N_KEYS)
+    if model_name == 'v3_trainable_gaussian_weights_and_traj_transformer_bigger':
+        return traj_feats, torch.rand(curve_len, batch_size, 2)
+    raise ValueError(f"Export of {model_name} is not supported")
+
+
+def _as_tuple(encoder_in: Union[Tensor, Tuple[Tensor, Tensor]]) -> Tuple[Tensor, ...]:
+    return (encoder_in,) if isinstance(encoder_in, Tensor) else tuple(encoder_in)
+
+
+def _pack_memory_kv(memory_keys: List[Tensor], memory_values: List[Tensor]) -> Tensor:
+    # (batch_size, n_heads, curve_len, head_dim) for every layer ->
+    # (curve_len, batch_size, 2 * n_layers * d_model)
+    return torch.cat([_merge_heads(el) for kv in zip(memory_keys, memory_values)
+                      for el in kv], dim=-1)
+
+
+def _unpack_memory_kv(memory_kv: Tensor, n_layers: int, n_heads: int
+                      ) -> Tuple[List[Tensor], List[Tensor]]:
+    memory_kv = [_split_heads(el, n_heads) for el in memory_kv.chunk(2 * n_layers, dim=-1)]
+    return memory_kv[0::2], memory_kv[1::2]
+
+
+class EncoderGraph(nn.Module):
+    def __init__(self, model: EncoderDecoderTransformerLike) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, x_pad_mask: Tensor, *encoder_in: Tensor) -> Tensor:
+        x = encoder_in[0] if len(encoder_in) == 1 else encoder_in
+        encoded = self.model.encode(x, x_pad_mask)
+        cache = self.model.init_decoder_cache(encoded, x_pad_mask)
+        return _pack_memory_kv(cache.memory_keys, cache.memory_values)
+
+
+class DecoderStepGraph(nn.Module):
+    def __init__(self, model: EncoderDecoderTransformerLike) -> None:
+        super().__init__()
+        self.model = model
+        self.n_layers = len(model.decoder.layers)
+        self.n_heads = model.decoder.layers[0].multihead_attn.num_heads
+
+    def forward(self, y: Tensor, self_attn_keys: Tensor, self_attn_values: Tensor,
+                memory_kv: Tensor, memory_pad_mask: Tensor
+                ) -> Tuple[Tensor, Tensor, Tensor]:
+        memory_keys, memory_values = _unpack_memory_kv(
+            memory_kv, self.n_layers, self.n_heads)
+        cache = DecoderCache(
+            self_attn_keys=list(self_attn_keys.unbind(0)),
+            self_attn_values=list(self_attn_values.unbind(0)),
+            memory_keys=memory_keys, memory_values=memory_values,
+            memory_attn_mask=~memory_pad_mask[:, None, None, :])
+        logits, cache = self.model.decode_incremental(y, cache)
+        return (logits, torch.stack(cache.self_attn_keys),
+                torch.stack(cache.self_attn_values))
+
+
+def _get_example_graph_inputs(model: EncoderDecoderTransformerLike,
+                              encoder_in: Union[Tensor, Tuple[Tensor, Tensor]]
+                              ) -> Tuple[tuple, tuple]:
+    encoder_in = _as_tuple(encoder_in)
+    curve_len, batch_size = encoder_in[0].shape[:2]
+    x_pad_mask = torch.zeros(batch_size, curve_len, dtype=torch.bool)
+    x_pad_mask[0, -1] = True
+    encoder_inputs = (x_pad_mask, *encoder_in)
+    with torch.inference_mode():
+        memory_kv = EncoderGraph(model)(*encoder_inputs)
+
+    # The prefix has two tokens, so the traced graph concatenates
+    # the past keys and values (the first step passes empty ones).
+    n_layers = len(model.decoder.layers)
+    n_heads = model.decoder.layers[0].multihead_attn.num_heads
+    head_dim = memory_kv.size(-1) // (2 * n_layers * n_heads)
+    y = torch.randint(0, N_KEYS - 2, (2, batch_size))
+    past_kv_shape = (n_layers, batch_size, n_heads, 1, head_dim)
+    decoder_inputs = (y, torch.randn(past_kv_shape), torch.randn(past_kv_shape),
+                      memory_kv, x_pad_mask)
+    return encoder_inputs, decoder_inputs
+
+
+def _export_torchscript(graph: nn.Module, example_inputs: tuple, path: str) -> None:
+    # Python conditions on shapes (ex. in decode_incremental)
+    # are expected to be frozen, so tracer warnings are muted.
+    with torch.inference_mode(), warnings.catch_warnings():
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        traced = torch.jit.trace(graph, example_inputs, check_trace=False)
+    traced = torch.jit.freeze(traced.eval())
+    traced.save(path)
+
+
+def export_model(model: EncoderDecoderTransformerLike, model_name: str,
+                 n_coord_feats: int, out_dir: str) -> None:
+    """
+    Saves encoder and decoder_step graphs and a meta.json to `out_dir`.
+
+    Arguments:
+    ----------
+    model: EncoderDecoderTransformerLike
+        A v3 model on cpu in eval mode.
+    """
+    assert not model.training, "The model should be in eval mode"
+    os.makedirs(out_dir, exist_ok=True)
+
+    encoder_in = get_example_encoder_in(model_name, n_coord_feats)
+    n_encoder_inputs = len(_as_tuple(encoder_in))
+    encoder_inputs, decoder_inputs = _get_example_graph_inputs(model, encoder_in)
+    encoder_path = os.path.join(out_dir, 'encoder.pt')
+    decoder_step_path = os.path.join(out_dir, 'decoder_step.pt')
+
+    _export_torchscript(EncoderGraph(model), encoder_inputs, encoder_path)
+    _export_torchscript(DecoderStepGraph(model), decoder_inputs, decoder_step_path)
+
+    decoder_layer = model.decoder.layers[0]
+    meta = {
+        'model_name': model_name,
+        'n_coord_feats': n_coord_feats,
+        'format': 'torchscript',
+        'n_encoder_inputs': n_encoder_inputs,
+        'n_layers': len(model.decoder.layers),
+        'n_heads': decoder_layer.multihead_attn.num_heads,
+        'd_model': decoder_layer.multihead_attn.embed_dim,
+        'encoder_path': os.path.basename(encoder_path),
+        'decoder_step_path': os.path.basename(decoder_step_path),
+    }
+    with open(os.path.join(out_dir, EXPORT_META_FILENAME), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+
+
+class ExportedModel:
+    """
+    Exported encoder and decoder_step graphs with the interface of
+    EncoderDecoderTransformerLike used by word generators:
+    `encode`, `init_decoder_cache` and `decode_incremental`.
+    Generators must be created with `use_kv_cache=True`.
+
+    `encode` returns memory_kv (see the module docstring)
+    instead of the encoder output.
+    """
+    def __init__(self, encoder: Callable, decoder_step: Callable,
+                 n_layers: int, n_heads: int, d_model: int) -> None:
+        self.encoder = encoder
+        self.decoder_step = decoder_step
+        self.n_layers = n_layers
+        self.n_heads = n_heads
+        self.d_model = d_model
+
+    @classmethod
+    def load(cls, export_dir: str) -> 'ExportedModel':
+        with open(os.path.join(export_dir, EXPORT_META_FILENAME), encoding='utf-8') as f:
+            meta = json.load(f)
+        assert meta['format'] == 'torchscript', f"Unknown export format {meta['format']}"
+        return cls(torch.jit.load(os.path.join(export_dir, meta['encoder_path'])),
+                   torch.jit.load(os.path.join(export_dir, meta['decoder_step_path'])),
+                   meta['n_layers'], meta['n_heads'], meta['d_model'])
+
+    def to(self, device) -> 'ExportedModel':
+        assert torch.device(device).type == 'cpu', "Exported graphs run on cpu"
+        return self
+
+    def encode(self, x, x_pad_mask: Optional[Tensor]) -> Tensor:
+        x = _as_tuple(x)
+        if x_pad_mask is None:
+            curve_len, batch_size = x[0].shape[:2]
+            x_pad_mask = torch.zeros(batch_size, curve_len, dtype=torch.bool)
+        return self.encoder(x_pad_mask.bool(), *x)
+
+    def init_decoder_cache(self, x_encoded: Tensor,
+                           memory_key_padding_mask: Optional[Tensor] = None,
+                           rows_per_memory: int = 1) -> DecoderCache:
+        """
+        Same as EncoderDecoderTransformerLike.init_decoder_cache.
+        The memory is repeated for every row since decoder_step
+        graph expects one memory per row.
+        """
+        curve_len, batch_size, _ = x_encoded.shape
+        if memory_key_padding_mask is None:
+            memory_key_padding_mask = torch.zeros(batch_size, curve_len, dtype=torch.bool)
+        memory_kv = x_encoded.repeat_interleave(rows_per_memory, dim=1)
+        memory_pad_mask = memory_key_padding_mask.bool().repeat_interleave(rows_per_memory, dim=0)
+
+        n_rows = batch_size * rows_per_memory
+        empty = x_encoded.new_zeros(
+            (n_rows, self.n_heads, 0, self.d_model // self.n_heads))
+        # memory_keys and memory_values hold the packed memory and its
+        # padding mask: they are passed to decoder_step as is.
+        return DecoderCache(
+            self_attn_keys=[empty] * self.n_layers,
+            self_attn_values=[empty] * self.n_layers,
+            memory_keys=[memory_kv], memory_values=[memory_pad_mask],
+            memory_attn_mask=None)
+
+    def decode_incremental(self, y: Tensor, cache: DecoderCache
+                           ) -> Tuple[Tensor, DecoderCache]:
+        assert cache.n_decoded_tokens == len(y) - 1, \
+            f"Cache stores {cache.n_decoded_tokens} tokens, but prefix length is {len(y)}"
+        logits, keys, values = self.decoder_step(
+            y.long(), torch.stack(cache.self_attn_keys), torch.stack(cache.self_attn_values),
+            cache.memory_keys[0], cache.memory_values[0])
+        cache = DecoderCache(
+            self_attn_keys=list(keys.unbind(0)), self_attn_values=list(values.unbind(0)),
+            memory_keys=cache.memory_keys, memory_values=cache.memory_values,
+            memory_attn_mask=None)
+        return logits, cache
+
+
+def check_parity(model: EncoderDecoderTransformerLike, exported: ExportedModel,
+                 tokenizer, encoder_ins: List[Union[Tensor, Tuple[Tensor, Tensor]]],
+                 max_steps_n: int = 35, beamsize: int = 6) -> Dict[str, float]:
+    """
+    Decodes every swipe with greedy and beam search using
+    the eager model and the exported graphs.
+
+    Arguments:
+    ----------
+    encoder_ins: List[Union[Tensor, Tuple[Tensor, Tensor]]]
+        Encoder inputs of single swipes (without the batch dimension).
+
+    Returns:
+    --------
+    Dict with the share of swipes with equal outputs and the maximal
+    absolute difference of scores for greedy and beam search.
+    """
+    from word_generators_v2 import GreedyGenerator, BeamGenerator
+
+    report = {}
+    for name, generator_ctor, call_kwargs in (
+            ('greedy', GreedyGenerator, {'max_steps_n': max_steps_n}),
+            ('beam', BeamGenerator, {'max_steps_n': max_steps_n, 'beamsize': beamsize})):
+        eager = generator_ctor(model, tokenizer, 'cpu', use_kv_cache=True)
+        exported_generator = generator_ctor(exported, tokenizer, 'cpu', use_kv_cache=True)
+        n_equal = 0
+        max_score_diff = 0.0
+        for encoder_in in encoder_ins:
+            expected = eager(encoder_in, **call_kwargs)
+            result = exported_generator(encoder_in, **call_kwargs)
+            is_equal = [word for _, word in expected] == [word for _, word in result]
+            n_equal += is_equal
+            if is_equal:
+                max_score_diff = max(max_score_diff, *(
+                    abs(a - b) for (a, _), (b, _) in zip(expected, result)))
+        report[f'{name}_equal_share'] = n_equal / len(encoder_ins)
+        report[f'{name}_max_score_diff'] = max_score_diff
+    return report
+
+
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser()
+    p.add_argument('--model-name', type=str, required=True,
+                   help='A v3 key of MODEL_GETTERS_DICT.')
+    p.add_argument('--weights-path', type=str, required=True)
+    p.add_argument('--n-coord-feats', type=int, required=True)
+    p.add_argument('--out-dir', type=str, required=True)
+    p.add_argument('--voc-path', type=str, default=None,
+                   help='If set, parity with the eager model is checked.')
+    p.add_argument('--n-parity-swipes', type=int, default=20)
+    args = p.parse_args()
+    return args
+
+
+def main() -> None:
+    args = parse_args()
+    model = MODEL_GETTERS_DICT[args.model_name](
+        'cpu', args.weights_path, n_coord_feats=args.n_coord_feats)
+    export_model(model, args.model_name, args.n_coord_feats, args.out_dir)
+    print(f"Exported to {args.out_dir}")
+
+    if args.voc_path is not None:
+        from ns_tokenizers import CharLevelTokenizerv2
+        # Random inputs are enough to check that the graphs
+        # compute the same function as the eager model.
+        encoder_ins = [
+            get_example_encoder_in(args.model_name, args.n_coord_feats, curve_len, None)
+            for curve_len in torch.randint(8, 64, (args.n_parity_swipes,)).tolist()]
+        report = check_parity(model, ExportedModel.load(args.out_dir),
+                              CharLevelTokenizerv2(args.voc_path), encoder_ins)
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+"""
+On-disk cache of FullTransform outputs.
+
+A cache entry is a directory named after a hash of everything
+the features depend on (see `get_feature_cache_key`). It stores
+every tensor field of ((encoder_in, decoder_in), decoder_out)
+concatenated along the first dimension in a .npy file
+plus an offsets array, so the entry is opened with np.load(mmap_mode='r')
+without any feature extraction.
+"""
+
+from typing import Optional, List, Tuple, Callable, Iterable
+import os
+import json
+import shutil
+import hashlib
+
+import numpy as np
+import torch
+from torch import Tensor
+from tqdm import tqdm
+
+
+FEATURE_CACHE_META_FILENAME = 'meta.json'
+
+
+def get_file_hash(path: str, chunk_size: int = 2**20) -> str:
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def get_feature_cache_key(transform_name: str,
+                          include_time: Optional[bool],
+                          include_velocities: Optional[bool],
+                          include_accelerations: Optional[bool],
+                          grids_path: str,
+                          data_path: str,
+                          extra: Optional[dict] = None) -> str:
+    """
+    Returns a hash of the transform config and
+    of the contents of the grids file and the data file.
+
+    Arguments:
+    ----------
+    extra: Optional[dict]
+        Any other json-serializable parameters
+        the features depend on (ex. uniform_noise_range).
+    """
+    key_data = {
+        'transform_name': transform_name,
+        'include_time': include_time,
+        'include_velocities': include_velocities,
+        'include_accelerations': include_accelerations,
+        'grids_file_hash': get_file_hash(grids_path),
+        'data_file_hash': get_file_hash(data_path),
+        'extra': extra,
+    }
+    key_str = json.dumps(key_data, sort_keys=True)
+    return hashlib.sha1(key_str.encode('utf-8')).hexdigest()
+
+
+def _flatten_sample(sample) -> List[Optional[Tensor]]:
+    """
+    ((encoder_in, decoder_in), decoder_out) -> list of fields
+    where encoder_in is either a tensor or a tuple of tensors.
+    """
+    (encoder_in, decoder_in), decoder_out = sample
+    encoder_in = [encoder_in] if isinstance(encoder_in, Tensor) else list(encoder_in)
+    return encoder_in + [decoder_in, decoder_out]
+
+
+def save_feature_cache(samples: Iterable,
+                       grid_names: List[str],
+                       cache_dir: str,
+                       total: Optional[int] = None) -> None:
+    """
+    Packs FullTransform outputs into `cache_dir`.
+
+    Arguments:
+    ----------
+    samples: Iterable
+        FullTransform outputs: ((encoder_in, decoder_in), decoder_out).
+        decoder_in and decoder_out are None if there are no target words.
+    grid_names: List[str]
+        grid_names[i] is the grid name of the i-th sample.
+    """
+    fields: Optional[List[List[np.ndarray]]] = None
+    encoder_in_is_tuple = None
+    for sample in tqdm(samples, total=total):
+        if fields is None:
+            encoder_in_is_tuple = not isinstance(sample[0][0], Tensor)
+            fields = [[] for _ in _flatten_sample(sample)]
+        for field, value in zip(fields, _flatten_sample(sample)):
+            field.append(None if value is None else value.numpy())
+
+    assert fields is not None, "Can't cache an empty dataset"
+    assert len(fields[0]) == len(grid_names)
+
+    # The entry is written to a temporary directory and renamed
+    # so that an interrupted run never leaves a partial entry.
+    tmp_dir = cache_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    field_is_present = []
+    for i, field in enumerate(fields):
+        is_present = field[0] is not None
+        field_is_present.append(is_present)
+        if not is_present:
+            continue
+        lengths = np.array([len(value) for value in field], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        np.save(os.path.join(tmp_dir, f'field_{i}.npy'), np.concatenate(field))
+        np.save(os.path.join(tmp_dir, f'field_{i}_offsets.npy'), offsets)
+
+    unique_grid_names = sorted(set(grid_names))
+    grid_name_to_id = {gname: i for i, gname in enumerate(unique_grid_names)}
+    np.save(os.path.join(tmp_dir, 'grid_name_ids.npy'),
+            np.array([grid_name_to_id[gname] for gname in grid_names], dtype=np.int16))
+
+    meta = {
+        'n_samples': len(grid_names),
+        'encoder_in_is_tuple': encoder_in_is_tuple,
+        'field_is_present': field_is_present,
+        'grid_names': unique_grid_names,
+    }
+    with open(os.path.join(tmp_dir, FEATURE_CACHE_META_FILENAME), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+
+    os.replace(tmp_dir, cache_dir)
+
+
+class CachedFeaturesDataset:
+    """
+    A dataset of FullTransform outputs stored by `save_feature_cache`.
+
+    Has the same interface as CurveDataset with `init_transform`
+    equal to the full transform: dataset[i] is
+    ((encoder_in, decoder_in), decoder_out), and grid_name_list
+    is available for CurveDatasetSubset.
+    """
+
+    def __init__(self, cache_dir: str,
+                 get_item_transform: Optional[Callable] = None) -> None:
+        self.cache_dir = cache_dir
+        self.transform = get_item_transform
+        with open(os.path.join(cache_dir, FEATURE_CACHE_META_FILENAME), encoding='utf-8') as f:
+            meta = json.load(f)
+        self.n_samples = meta['n_samples']
+        self.encoder_in_is_tuple = meta['encoder_in_is_tuple']
+        self.field_is_present = meta['field_is_present']
+        grid_name_ids = np.load(os.path.join(cache_dir, 'grid_name_ids.npy'))
+        self.grid_name_list = [meta['grid_names'][i] for i in grid_name_ids.tolist()]
+        self._fields = None
+
+    @property
+    def fields(self) -> List[Optional[Tuple[np.ndarray, np.ndarray]]]:
+        # Opened lazily so that pickled copies (ex. in DataLoader workers)
+        # map the files instead of receiving the data.
+        if self._fields is None:
+            self._fields = [
+                (np.load(os.path.join(self.cache_dir, f'field_{i}.npy'), mmap_mode='r'),
+                 np.load(os.path.join(self.cache_dir, f'field_{i}_offsets.npy'), mmap_mode='r'))
+                if is_present else None
+                for i, is_present in enumerate(self.field_is_present)]
+        return self._fields
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_fields'] = None
+        return state
+
+    def __len__(self) -> int:
+        return self.n_samples
+
+    def get_swipe_and_word_lengths(self) -> Tuple[List[int], Optional[List[int]]]:
+        """
+        Returns swipe lengths and word lengths (None if there are no 
+        target words) of the stored elements read from the offsets,
+        without loading the features. Like `dataset.get_swipe_and_word_lengths`
+        for CurveDataset, get_item_transform is not taken into account.
+        """
+        _, swipe_offsets = self.fields[0]
+        swipe_lens = np.diff(swipe_offsets).tolist()
+        # Fields are (*encoder_in, decoder_in, decoder_out).
+        decoder_in_field = self.fields[-2]
+        if decoder_in_field is None:
+            return swipe_lens, None
+        return swipe_lens, np.diff(decoder_in_field[1]).tolist()
+
+    def _get_field(self, field_idx: int, idx: int) -> Optional[Tensor]:
+        field = self.fields[field_idx]
+        if field is None:
+            return None
+        values, offsets = field
+        # np.array copies the slice: memory-mapped arrays are read-only.
+        return torch.from_numpy(np.array(values[offsets[idx]: offsets[idx + 1]]))
+
+    def __getitem__(self, idx: int):
+        if idx < 0:
+            idx += self.n_samples
+        if not 0 <= idx < self.n_samples:
+            raise IndexError(f"Index {idx} is out of range")
+        values = [self._get_field(i, idx) for i in range(len(self.field_is_present))]
+        *encoder_in, decoder_in, decoder_out = values
+        encoder_in = tuple(encoder_in) if self.encoder_in_is_tuple else encoder_in[0]
+        sample = (encoder_in, decoder_in), decoder_out
+        if self.transform:
+            sample = self.transform(sample)
+        return sample
+
+
+def get_cached_features_dataset(cache_root: str, key: str,
+                                create_dataset: Callable[[], object]
+                                ) -> CachedFeaturesDataset:
+    """
+    Returns the cache entry `key` from `cache_root`. If there is
+    no such entry, `create_dataset()` is called (it should return
+    a dataset of FullTransform outputs with grid_name_list)
+    and its elements are cached.
+    """
+    cache_dir = os.path.join(cache_root, key)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_root, exist_ok=True)
+        dataset = create_dataset()
+        print("Saving features to cache...")
+        save_feature_cache((dataset[i] for i in range(len(dataset))),
+                           dataset.grid_name_list, cache_dir, total=len(dataset))
+    return CachedFeaturesDataset(cache_dir)
@@ -25,9 +25,12 @@ So `traj_feats` regard a point as a part of a trajectory and
 types of embedding layers (actually, `traj_feats` are not embedded at all).
 """
 
-from typing import Tuple, Dict, Optional, Iterable, List, Callable, Union, Set
+from typing import Tuple, Dict, Optional, Iterable, List, Callable, Union
 from array import array
+import os
 import json
+import hashlib
+import tempfile
 
 import torch
 from torch import Tensor
@@ -38,7 +41,7 @@ from .nearest_key_lookup import NearestKeyLookup, ExtendedNearestKeyLookup
 from .distances_lookup import DistancesLookup
 from ns_tokenizers import KeyboardTokenizerv1, CharLevelTokenizerv2
 from ns_tokenizers import ALL_CYRILLIC_LETTERS_ALPHABET_ORD
-from dataset import RawDatasetEl 
+from dataset import RawDatasetEl, CurveDatasetColumnar
 from grid_processing_utils import get_gname_to_wh, get_kb_label, get_grid
 
 
@@ -152,6 +155,18 @@ class TrajFeatsGetter:
     
 
 class NearestKbTokensGetter:
+    """
+    Returns keyboard tokens of the keys nearest to swipe points.
+
+    If the nearest key lookup has vectorized `get_label_ids` 
+    (see nearest_key_lookup.NearestKeyLookup), a whole swipe is converted
+    to label ids and then to tokens with fancy indexing.
+    Otherwise a (width, height) uint8 array of nearest key tokens
+    is built once (lazily) per grid, in-bounds points are looked up
+    in it and out-of-bounds points are resolved by the lookup itself.
+    Both paths truncate coordinates to int, so if `input_to_int` is False
+    every point is passed to the lookup as is.
+    """
     def __init__(self, 
                  grid_name_to_nk_lookup: Dict[str, NearestKeyLookup],
                  kb_tokenizer: KeyboardTokenizerv1,
@@ -164,19 +179,84 @@ class NearestKbTokensGetter:
         self.return_tensor = return_tensor
         self.grid_name_to_nk_lookup = grid_name_to_nk_lookup
         self.kb_tokenizer = kb_tokenizer
+        self._grid_name_to_label_tokens: Dict[str, np.ndarray] = {}
+        self._grid_name_to_token_grid: Dict[str, np.ndarray] = {}
+
+    def _get_label_tokens(self, grid_name: str) -> np.ndarray:
+        """
+        Returns a uint8 array where i-th element is 
+        the token of the nearest key lookup's i-th label.
+        """
+        if grid_name not in self._grid_name_to_label_tokens:
+            labels = self.grid_name_to_nk_lookup[grid_name].labels
+            self._grid_name_to_label_tokens[grid_name] = np.array(
+                [self.kb_tokenizer.get_token(label) for label in labels], dtype=np.uint8)
+        return self._grid_name_to_label_tokens[grid_name]
+
+    def _create_token_grid(self, nearest_key_lookup: NearestKeyLookup) -> np.ndarray:
+        # nearest_key_lookup_optimized.NearestKeyLookup doesn't store labels.
+        coord_to_kb_label = np.array(
+            [[nearest_key_lookup(x, y) for y in range(nearest_key_lookup.kb_height)]
+                for x in range(nearest_key_lookup.kb_width)], dtype=object)
+        labels, label_idxs = np.unique(coord_to_kb_label, return_inverse=True)
+        label_tokens = np.array([self.kb_tokenizer.get_token(label) for label in labels],
+                                dtype=np.uint8)
+        return label_tokens[label_idxs].reshape(coord_to_kb_label.shape)
+
+    def get_token_grid(self, grid_name: str) -> np.ndarray:
+        """
+        Returns a (width, height) uint8 array where [x, y] element 
+        is the token of the key nearest to (x, y).
+        """
+        if grid_name not in self._grid_name_to_token_grid:
+            nearest_key_lookup = self.grid_name_to_nk_lookup[grid_name]
+            if hasattr(nearest_key_lookup, 'coord_to_label_id'):
+                token_grid = self._get_label_tokens(grid_name)[nearest_key_lookup.coord_to_label_id]
+            else:
+                token_grid = self._create_token_grid(nearest_key_lookup)
+            self._grid_name_to_token_grid[grid_name] = token_grid
+        return self._grid_name_to_token_grid[grid_name]
+
+    def _get_kb_tokens_via_token_grid(self, X: np.ndarray, Y: np.ndarray, 
+                                      grid_name: str) -> np.ndarray:
+        token_grid = self.get_token_grid(grid_name)
+        width, height = token_grid.shape
+        # astype(int) truncates towards zero just like int().
+        X_int, Y_int = X.astype(np.int64), Y.astype(np.int64)
+
+        in_bounds = (X_int >= 0) & (X_int < width) & (Y_int >= 0) & (Y_int < height)
+        kb_tokens = np.empty(len(X_int), dtype=np.uint8)
+        kb_tokens[in_bounds] = token_grid[X_int[in_bounds], Y_int[in_bounds]]
+
+        out_of_bounds_idxs = np.flatnonzero(~in_bounds)
+        if len(out_of_bounds_idxs) > 0:
+            nearest_key_lookup = self.grid_name_to_nk_lookup[grid_name]
+            kb_tokens[out_of_bounds_idxs] = [
+                self.kb_tokenizer.get_token(
+                    nearest_key_lookup(X_int[i].item(), Y_int[i].item()))
+                for i in out_of_bounds_idxs]
+        return kb_tokens
     
     def __call__(self, X: Iterable, Y: Iterable, grid_name: str
                  ) -> Tensor:
         nearest_key_lookup = self.grid_name_to_nk_lookup[grid_name]
-        caster = int if self.input_to_int else lambda x: x
-        kb_labels = [nearest_key_lookup(caster(x), caster(y)) 
-                     for x, y in zip(X, Y)]
-        kb_tokens = [self.kb_tokenizer.get_token(label) for label in kb_labels]
+        if not self.input_to_int:
+            kb_tokens = np.array(
+                [self.kb_tokenizer.get_token(nearest_key_lookup(x, y)) for x, y in zip(X, Y)],
+                dtype=np.uint8)
+        elif hasattr(nearest_key_lookup, 'get_label_ids'):
+            # astype(int) truncates towards zero just like int().
+            label_ids = nearest_key_lookup.get_label_ids(
+                np.asarray(X).astype(np.int64), np.asarray(Y).astype(np.int64))
+            kb_tokens = self._get_label_tokens(grid_name)[label_ids]
+        else:
+            kb_tokens = self._get_kb_tokens_via_token_grid(
+                np.asarray(X), np.asarray(Y), grid_name)
 
         if self.return_tensor:
-            kb_tokens = torch.tensor(kb_tokens, dtype=self.dtype)
+            kb_tokens = torch.from_numpy(kb_tokens).to(self.dtype)
         else:
-            kb_tokens = array('B', kb_tokens)
+            kb_tokens = array('B', kb_tokens.tobytes())
 
         return kb_tokens
 
@@ -198,7 +278,9 @@ class DistancesGetter:
         dl_lookup = self.grid_name_to_dists_lookup[grid_name]
         # distances = dl_lookup.get_distances_for_full_swipe_without_map(X, Y)
         distances = dl_lookup.get_distances_for_full_swipe_using_map(X, Y)
-        distances = torch.tensor(distances, dtype=self.dtype)
+        # The array is a new one (not a view of the lookup table),
+        # so the tensor can share its memory. Copies only if dtypes differ.
+        distances = torch.from_numpy(distances).to(self.dtype)
         return distances
 
 
@@ -232,28 +314,184 @@ def get_gname_to_half_key_diag(gname_to_grid: Dict[str, dict],
 
 
 
+def weights_from_distances(distances: Tensor, half_key_diag: float,
+                           weights_function: Callable) -> Tensor:
+    """
+    Arguments:
+    ----------
+    distances: Tensor
+        A 2d tensor (n_points, n_keys) of distances in pixels where 
+        negative values stand for keys absent on the keyboard.
+        Is modified in place.
+    
+    Returns:
+    --------
+    weights: Tensor
+        weights_function(distances / half_key_diag) 
+        with zeros for absent keys.
+    """
+    mask = (distances < 0)
+    distances.masked_fill_(mask=mask, value = float('inf'))
+    distances_scaled = distances / half_key_diag
+    weights = weights_function(distances_scaled)
+    weights.masked_fill_(mask=mask, value=0)
+    return weights
+
+
+class KeyWeightsLookup:
+    """
+    Stores precomputed key weights (see `weights_from_distances`)
+    for every coordinate within the keyboard as a (w, h, n_keys) table.
+
+    The table is float16 by default (~50 MB for a 1080 x 667 grid
+    and 37 keys). If `table_path` is given, the table is loaded
+    from it (memory-mapped) if it exists and is saved there otherwise.
+    """
+    def __init__(self,
+                 dists_lookup: DistancesLookup,
+                 half_key_diag: float,
+                 weights_function: Callable,
+                 table_dtype: np.dtype = np.float16,
+                 table_path: Optional[str] = None) -> None:
+        self.dists_lookup = dists_lookup
+        self.half_key_diag = half_key_diag
+        self.weights_function = weights_function
+        if table_path is not None and os.path.exists(table_path):
+            self.coord_to_weights = np.load(table_path, mmap_mode='r')
+        else:
+            self.coord_to_weights = self._create_coord_to_weights(np.dtype(table_dtype))
+            if table_path is not None:
+                self._save_table(table_path)
+
+    def _save_table(self, table_path: str) -> None:
+        # The table is written to a temporary file and renamed, so that 
+        # concurrent readers (ex. DataLoader workers) never map a partial file.
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(table_path)), suffix='.npy.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, self.coord_to_weights)
+            os.replace(tmp_path, table_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def _get_weights(self, distances: np.ndarray) -> np.ndarray:
+        """
+        distances: array of shape (*DOT_DIMS, n_keys)
+        """
+        distances_2d = torch.from_numpy(
+            distances.reshape(-1, distances.shape[-1]).astype(np.float32))
+        weights = weights_from_distances(
+            distances_2d, self.half_key_diag, self.weights_function)
+        return weights.numpy().reshape(distances.shape)
+
+    def _create_coord_to_weights(self, dtype: np.dtype) -> np.ndarray:
+        coord_to_distances = self.dists_lookup.coord_to_distances
+        coord_to_weights = np.empty(coord_to_distances.shape, dtype=dtype)
+        x_chunk_size = 64
+        for x_start in range(0, len(coord_to_distances), x_chunk_size):
+            x_end = x_start + x_chunk_size
+            coord_to_weights[x_start: x_end] = self._get_weights(
+                coord_to_distances[x_start: x_end])
+        return coord_to_weights
+
+    def get_weights_for_full_swipe(self, X: Iterable, Y: Iterable) -> np.ndarray:
+        """
+        Returns a new (len(X), n_keys) array of weights: gathered 
+        from the table for in-bounds points and computed 
+        from distances for out-of-bounds points.
+        """
+        X = np.asarray(X, dtype=np.int64)
+        Y = np.asarray(Y, dtype=np.int64)
+        w, h = self.coord_to_weights.shape[:2]
+        weights = self.coord_to_weights[np.clip(X, 0, w - 1), np.clip(Y, 0, h - 1)]
+        out_of_bounds = (X < 0) | (X >= w) | (Y < 0) | (Y >= h)
+        if out_of_bounds.any():
+            distances = self.dists_lookup.get_distances_for_full_swipe_using_map(
+                X[out_of_bounds], Y[out_of_bounds])
+            weights[out_of_bounds] = self._get_weights(distances)
+        return weights
+
+
+def get_weights_function_fingerprint(weights_function: Callable, n_keys: int) -> str:
+    """
+    Returns a hash of the weights computed by `weights_function` 
+    for fixed pseudo-random distances (with some absent keys).
+    Unlike the function name, it differs for lambdas, closures 
+    and functools.partial objects with different parameters.
+    """
+    gen = torch.Generator().manual_seed(0)
+    distances = torch.rand(256, n_keys, generator=gen) * 10
+    distances[:, ::7] = -1
+    weights = weights_from_distances(distances, 1.0, weights_function)
+    return hashlib.sha1(weights.to(torch.float32).numpy().tobytes()).hexdigest()
+
+
+def get_weights_table_path(weights_tables_dir: str, grid_name: str, grid: dict,
+                           kb_key_list: List[str], half_key_diag: float,
+                           weights_function: Callable, table_dtype: np.dtype) -> str:
+    """
+    The file name contains a hash of everything the table depends on,
+    so a stale table is never loaded after a grid or a function changes.
+    """
+    key = json.dumps([grid, kb_key_list, half_key_diag, 
+                      get_weights_function_fingerprint(weights_function, len(kb_key_list)),
+                      np.dtype(table_dtype).str], sort_keys=True)
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(weights_tables_dir, f"{grid_name}__key_weights__{digest}.npy")
+
+
 class KeyWeightsGetter:
     def __init__(self, 
                  grid_name_to_dists_lookup: Dict[str, DistancesLookup],
                  grid_name_to_half_key_diag: Dict[str, float],
                  weights_function: Callable,
                  dtype: torch.dtype = torch.float32,
+                 weights_tables_dir: Optional[str] = None,
+                 table_dtype: np.dtype = np.float16,
                  ) -> None:
+        """
+        Arguments:
+        ----------
+        weights_tables_dir: Optional[str]
+            If provided, weights are gathered from per-grid 
+            KeyWeightsLookup tables persisted in this directory
+            instead of being computed for every swipe.
+        table_dtype: np.dtype
+            dtype of KeyWeightsLookup tables.
+        """
         self.distances_getter = DistancesGetter(grid_name_to_dists_lookup, dtype)
         self.weights_function = weights_function
         self.grid_name_to_half_key_diag = grid_name_to_half_key_diag
         self.dtype = dtype
+        self.weights_tables_dir = weights_tables_dir
+        self.table_dtype = table_dtype
+        self._grid_name_to_weights_lookup: Dict[str, KeyWeightsLookup] = {}
+
+    def get_weights_lookup(self, grid_name: str) -> KeyWeightsLookup:
+        if grid_name not in self._grid_name_to_weights_lookup:
+            dists_lookup = self.distances_getter.grid_name_to_dists_lookup[grid_name]
+            half_key_diag = self.grid_name_to_half_key_diag[grid_name]
+            os.makedirs(self.weights_tables_dir, exist_ok=True)
+            table_path = get_weights_table_path(
+                self.weights_tables_dir, grid_name, dists_lookup.grid, 
+                dists_lookup.KB_KEY_LIST, half_key_diag, 
+                self.weights_function, self.table_dtype)
+            self._grid_name_to_weights_lookup[grid_name] = KeyWeightsLookup(
+                dists_lookup, half_key_diag, self.weights_function,
+                self.table_dtype, table_path)
+        return self._grid_name_to_weights_lookup[grid_name]
 
     def __call__(self, X: Iterable, Y: Iterable, grid_name: str
                  ) -> Tensor:
+        if self.weights_tables_dir is not None:
+            weights = self.get_weights_lookup(grid_name).get_weights_for_full_swipe(X, Y)
+            return torch.from_numpy(weights).to(self.dtype)
+        
         distances = self.distances_getter._get_distances(X, Y, grid_name)
-        mask = (distances < 0)
-        distances.masked_fill_(mask=mask, value = float('inf'))
         half_key_diag = self.grid_name_to_half_key_diag[grid_name]
-        distances_scaled = distances / half_key_diag
-        weights = self.weights_function(distances_scaled)
-        weights.masked_fill_(mask=mask, value=0)
-        return weights
+        return weights_from_distances(distances, half_key_diag, self.weights_function)
 
 
 
@@ -432,7 +670,8 @@ class EncoderFeaturesGetter_KbKeyWeightsAndTrajFeats(EncoderFeaturesGetter):
                  include_velocities: bool,
                  include_accelerations: bool,
                  weights_func: Callable = weights_function_v1,
-                 allowed_keys = DEFAULT_ALLOWED_KEYS
+                 allowed_keys = DEFAULT_ALLOWED_KEYS,
+                 weights_tables_dir: Optional[str] = None
                  ) -> None:    
         gname_to_wh = get_gname_to_wh(grid_name_to_grid)
         self._get_traj_feats = TrajFeatsGetter(
@@ -442,7 +681,8 @@ class EncoderFeaturesGetter_KbKeyWeightsAndTrajFeats(EncoderFeaturesGetter):
         gname_to_hkd = get_gname_to_half_key_diag(grid_name_to_grid, 
                                                   allowed_keys)
         self.get_weights = KeyWeightsGetter(
-            grid_name_to_dist_lookup, gname_to_hkd, weights_func)
+            grid_name_to_dist_lookup, gname_to_hkd, weights_func,
+            weights_tables_dir=weights_tables_dir)
 
     def __call__(self, X: array, Y: array,
                     T: array, grid_name: str) -> Tuple[Tensor, Tensor]:
@@ -583,85 +823,172 @@ def get_grid(grid_name: str, grids_path: str) -> dict:
 
 
 
+def _get_gridname_to_xy(data_path: str, total: Optional[int] = None
+                        ) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """
+    Returns a dictionary with grid names as keys and (X, Y) 
+    arrays of all the points of all the swipes as values.
+
+    Arguments:
+    ----------
+    data_path: str
+        Path to a jsonl dataset or to a directory 
+        created by convert_dataset_to_columnar.py.
+    """
+    if os.path.isdir(data_path):
+        dataset = CurveDatasetColumnar(data_path, store_gnames=False)
+        columns = dataset.columns
+        point_grid_name_ids = np.repeat(
+            np.asarray(columns['grid_name_ids']), np.diff(columns['offsets']))
+        X = np.asarray(columns['x'], dtype=np.int32)
+        Y = np.asarray(columns['y'], dtype=np.int32)
+        return {gname: (X[point_grid_name_ids == i], Y[point_grid_name_ids == i])
+                for i, gname in enumerate(dataset.grid_names)}
+
+    gname_to_xy_buffers: Dict[str, Tuple[array, array]] = {}
+    with open(data_path, "r", encoding="utf-8") as json_file:
+        for line in tqdm(json_file, total=total):
+            curve = json.loads(line)['curve']
+            X_buf, Y_buf = gname_to_xy_buffers.setdefault(
+                curve['grid_name'], (array('i'), array('i')))
+            X_buf.extend(curve['x'])
+            Y_buf.extend(curve['y'])
+    return {gname: (np.frombuffer(X_buf, dtype=np.int32), np.frombuffer(Y_buf, dtype=np.int32))
+            for gname, (X_buf, Y_buf) in gname_to_xy_buffers.items()}
+
+
 def get_gridname_to_out_of_bounds_coords_dict(
         data_paths: List[str], gridname_to_wh: dict,
         totals: Iterable[Optional[int]] = None
-        ) -> Dict[str, Set[Tuple[int, int]]]:
+        ) -> Dict[str, np.ndarray]:
     """
     Returns a dictionary with grid names as keys and
-    lists of out of bounds coordinates present in the dataset as values.
+    unique out of bounds coordinates present in the dataset 
+    as values (int64 arrays of shape (n_coords, 2)).
     """
     totals = totals or [None] * len(data_paths)
-    
-    gname_to_out_of_bounds = {gname: set() for gname in gridname_to_wh.keys()}
+
+    gname_to_coords_list = {gname: [] for gname in gridname_to_wh.keys()}
 
     for data_path, total in zip(data_paths, totals):
-        with open(data_path, "r", encoding="utf-8") as json_file:
-            for line in tqdm(json_file, total=total):
-                json_data = json.loads(line)
-                curve = json_data['curve']
-                grid_name = curve['grid_name']
-                w, h = gridname_to_wh[grid_name]
-                X, Y = curve['x'], curve['y']
-                out_of_bounds = set((x, y) for x, y in zip(X, Y) 
-                                    if x < 0 or x >= w or y < 0 or y >= h)
-                gname_to_out_of_bounds[grid_name].update(out_of_bounds)
-    return gname_to_out_of_bounds
+        for grid_name, (X, Y) in _get_gridname_to_xy(data_path, total).items():
+            w, h = gridname_to_wh[grid_name]
+            out_of_bounds = (X < 0) | (X >= w) | (Y < 0) | (Y >= h)
+            gname_to_coords_list[grid_name].append(
+                np.stack([X[out_of_bounds], Y[out_of_bounds]], axis=1))
+
+    return {gname: _unique_coords(coords_list) 
+            for gname, coords_list in gname_to_coords_list.items()}
+
+
+def _unique_coords(coords_list: List[np.ndarray]) -> np.ndarray:
+    coords_list = [np.asarray(coords, dtype=np.int64).reshape(-1, 2) for coords in coords_list]
+    if not coords_list:
+        return np.empty((0, 2), dtype=np.int64)
+    return np.unique(np.concatenate(coords_list), axis=0)
 
 
+def _get_rectangle_coords(x_start: int, x_stop: int, 
+                          y_start: int, y_stop: int) -> np.ndarray:
+    """
+    Returns all the coordinates in [x_start, x_stop) x [y_start, y_stop).
+    """
+    X, Y = np.meshgrid(np.arange(x_start, x_stop, dtype=np.int64),
+                       np.arange(y_start, y_stop, dtype=np.int64), indexing='ij')
+    return np.stack([X.ravel(), Y.ravel()], axis=1)
+
 
 def update_out_of_bounds_with_noise(
     noise_min, noise_max,
     gname_to_out_of_bounds, gridname_to_wh: dict,
-    )-> Dict[str, Set[Tuple[int, int]]]:
+    )-> Dict[str, np.ndarray]:
+    """
+    Adds to the out of bounds coordinates of each grid:
+    * all the out of bounds coordinates that may be obtained
+        from them with a shift in [noise_min, noise_max] along each axis;
+    * a band of width noise_max (noise_min) around the keyboard.
+    """
     
     assert noise_min <= 0
     assert noise_max >= 0
-    
-    additional_out_of_bounds = {gname: set() for gname in gridname_to_wh.keys()}
+
+    shifts = _get_rectangle_coords(noise_min, noise_max+1, noise_min, noise_max+1)
     
     for gname in gname_to_out_of_bounds.keys():
         w, h = gridname_to_wh[gname]
-        
-        for x, y in gname_to_out_of_bounds[gname]:
-            for i in range(noise_min, noise_max+1):
-                for j in range(noise_min, noise_max+1):
-                    if x+i < 0 or x+i >= w or y+j < 0 or y+j >=h: 
-                        additional_out_of_bounds[gname].add((x+i, y+j))
-        
-        for x in range(noise_min, w+noise_max+1):
-            for y in range(noise_min, 0):
-                additional_out_of_bounds[gname].add((x, y))
-        
-        for x in range(noise_min, w+noise_max+1):
-            for y in range(h+1, h+noise_max+1):
-                additional_out_of_bounds[gname].add((x, y))
-        
-        for x in range(w, w+noise_max+1):
-            for y in range(0, h+1):
-                additional_out_of_bounds[gname].add((x, y))
-        
-        for x in range(noise_min, 0):
-            for y in range(0, h+1):
-                additional_out_of_bounds[gname].add((x, y))
-                
-        gname_to_out_of_bounds[gname].update(additional_out_of_bounds[gname])
+        coords = _unique_coords([gname_to_out_of_bounds[gname]])
+
+        shifted = (coords[:, None, :] + shifts[None, :, :]).reshape(-1, 2)
+        X, Y = shifted[:, 0], shifted[:, 1]
+        shifted = shifted[(X < 0) | (X >= w) | (Y < 0) | (Y >= h)]
+
+        gname_to_out_of_bounds[gname] = _unique_coords([
+            coords,
+            shifted,
+            _get_rectangle_coords(noise_min, w+noise_max+1, noise_min, 0),
+            _get_rectangle_coords(noise_min, w+noise_max+1, h+1, h+noise_max+1),
+            _get_rectangle_coords(w, w+noise_max+1, 0, h+1),
+            _get_rectangle_coords(noise_min, 0, 0, h+1),
+        ])
         
     return gname_to_out_of_bounds
-        
+
+
+def get_dataset_fingerprint(ds_paths_list: List[str],
+                            gridname_to_wh: Dict[str, Tuple[int, int]]) -> str:
+    """
+    Returns a hash of dataset paths, sizes and modification times
+    (the datasets are not read) and of the keyboard sizes.
+    """
+    files_info = []
+    for ds_path in ds_paths_list:
+        file_paths = [ds_path]
+        if os.path.isdir(ds_path):
+            file_paths = [os.path.join(ds_path, fname) for fname in sorted(os.listdir(ds_path))]
+        for file_path in file_paths:
+            stat = os.stat(file_path)
+            files_info.append((os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns))
+    fingerprint_data = {
+        'files': files_info,
+        'gridname_to_wh': sorted((gname, list(wh)) for gname, wh in gridname_to_wh.items()),
+    }
+    return hashlib.sha1(json.dumps(fingerprint_data).encode('utf-8')).hexdigest()
 
 
 def get_extra_coords_dict(ds_paths_list: List[str], 
                           gridname_to_wh: Dict[str, Tuple[int, int]],
                           uniform_noise_range: int = 0,
-                          totals: Optional[List[int]] = None
-                          ) -> Dict[str, Set[Tuple[int, int]]]:
-    print("Accumulating out-of-bounds coordinates...")
-    gname_to_out_of_bounds = get_gridname_to_out_of_bounds_coords_dict(
-        ds_paths_list, 
-        gridname_to_wh = gridname_to_wh,
-        totals=totals
-    )
+                          totals: Optional[List[int]] = None,
+                          cache_dir: Optional[str] = None
+                          ) -> Dict[str, np.ndarray]:
+    """
+    Returns a dictionary with grid names as keys and 
+    out-of-bounds coordinates (augmented with noise) as values.
+
+    cache_dir: Optional[str]
+        If provided, out-of-bounds coordinates found in the datasets 
+        are saved to this directory under the datasets fingerprint
+        (see get_dataset_fingerprint), and the datasets are not 
+        scanned next time.
+    """
+    cache_path = None
+    if cache_dir is not None:
+        fingerprint = get_dataset_fingerprint(ds_paths_list, gridname_to_wh)
+        cache_path = os.path.join(cache_dir, f"out_of_bounds__{fingerprint}.npz")
+
+    if cache_path is not None and os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            gname_to_out_of_bounds = {gname: cached[gname] for gname in gridname_to_wh}
+    else:
+        print("Accumulating out-of-bounds coordinates...")
+        gname_to_out_of_bounds = get_gridname_to_out_of_bounds_coords_dict(
+            ds_paths_list, 
+            gridname_to_wh = gridname_to_wh,
+            totals=totals
+        )
+        if cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.savez(cache_path, **gname_to_out_of_bounds)
 
     print("augmenting gname_to_out_of_bounds")
     gname_to_out_of_bounds = update_out_of_bounds_with_noise(
@@ -674,7 +1001,7 @@ def get_extra_coords_dict(ds_paths_list: List[str],
 
 
 def get_gname_to_nkl(gname_to_grid: Dict[str, dict],
-                     gname_to_out_of_bounds: Dict[str, Set[Tuple[int, int]]]
+                     gname_to_out_of_bounds: Dict[str, np.ndarray]
                         ) -> Dict[str, ExtendedNearestKeyLookup]:
     
     gridname_to_nkl = {
@@ -694,13 +1021,15 @@ def get_traj_feats_and_weights_transform(gname_to_grid: Dict[str, dict],
                                            weights_func: Callable,
                                            include_time: bool,
                                            include_velocities: bool,
-                                           include_accelerations: bool
+                                           include_accelerations: bool,
+                                           weights_tables_dir: Optional[str] = None
                                             ) -> Callable:
     full_transform = FullTransform(
         encoder_in_getter=EncoderFeaturesGetter_KbKeyWeightsAndTrajFeats(
             grid_name_to_dists_lookup, gname_to_grid,
             include_time=include_time, include_velocities=include_velocities,
-            include_accelerations=include_accelerations, weights_func=weights_func
+            include_accelerations=include_accelerations, weights_func=weights_func,
+            weights_tables_dir=weights_tables_dir
         ),
         decoder_in_out_getter=DecoderInputOutputGetter(
             word_tokenizer=char_tokenizer,
@@ -732,9 +1061,22 @@ def get_val_transform(gridname_to_grid_path: str,
                       ds_paths_list: Optional[List[str]] = None,
                       totals: Tuple[Optional[int], Optional[int]] = None,
                       kb_x_scaler: Callable = lambda x: x,
-                      kb_y_scaler: Callable = lambda y: y
+                      kb_y_scaler: Callable = lambda y: y,
+                      weights_tables_dir: Optional[str] = None,
+                      out_of_bounds_cache_dir: Optional[str] = None
                    ) -> Tuple[Callable, Callable]:
-    """Returns validation transform"""
+    """
+    Returns validation transform
+    
+    weights_tables_dir: Optional[str]
+        Is used only by "traj_feats_and_distance_weights" transform.
+        If provided, key weights are gathered from precomputed 
+        tables stored in this directory (see KeyWeightsLookup).
+    out_of_bounds_cache_dir: Optional[str]
+        Is used only by transforms that need out-of-bounds coordinates.
+        If provided, the coordinates are cached in this directory
+        and ds_paths_list is not rescanned (see get_extra_coords_dict).
+    """
     TRAJ_FEATS_AND_WEIGHTS = "traj_feats_and_distance_weights"
     # Better to keep this name since originally TRAJ_FEATS_AND_WEIGHTS was eqal to "traj_feats_and_distances"
     TRAJ_FEATS_AND_DISTANCES = "traj_feats_and_distances__actual" 
@@ -762,7 +1104,8 @@ def get_val_transform(gridname_to_grid_path: str,
             gname_to_out_of_bounds = {gname: set() for gname in gname_to_wh.keys()}
         else:
             gname_to_out_of_bounds = get_extra_coords_dict(
-                ds_paths_list, gname_to_wh, uniform_noise_range, totals
+                ds_paths_list, gname_to_wh, uniform_noise_range, totals,
+                cache_dir=out_of_bounds_cache_dir
             )
     
     if transform_name in transforms_need_nkl:
@@ -802,7 +1145,7 @@ def get_val_transform(gridname_to_grid_path: str,
 
         full_transform = get_traj_feats_and_weights_transform(
             gname_to_grid, char_tokenizer, gridname_to_dists_lookup, dist_weights_func,
-            include_time, include_velocities, include_accelerations
+            include_time, include_velocities, include_accelerations, weights_tables_dir
         )
 
     elif transform_name == NEAREST_KEY_ONLY:
@@ -872,7 +1215,9 @@ def get_transforms(gridname_to_grid_path: str,
                      ds_paths_list: Optional[List[str]] = None,
                      totals: Tuple[Optional[int], Optional[int]] = None,
                      kb_x_scaler: Callable = lambda x: x,
-                     kb_y_scaler: Callable = lambda y: y
+                     kb_y_scaler: Callable = lambda y: y,
+                     weights_tables_dir: Optional[str] = None,
+                     out_of_bounds_cache_dir: Optional[str] = None
                      ) -> Tuple[Callable, Callable]:
     """Returns train and validation transforms"""
     
@@ -881,7 +1226,7 @@ def get_transforms(gridname_to_grid_path: str,
         gridname_to_grid_path, grid_names, transform_name, char_tokenizer,
         uniform_noise_range, include_time, include_velocities,
         include_accelerations, dist_weights_func, ds_paths_list, totals,
-        kb_x_scaler, kb_y_scaler
+        kb_x_scaler, kb_y_scaler, weights_tables_dir, out_of_bounds_cache_dir
     )
 
     train_transform = val_transform
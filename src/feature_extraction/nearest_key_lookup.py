@@ -1,5 +1,6 @@
+import os
 import pickle
-from typing import Dict, Tuple, Iterable
+from typing import Dict, Tuple, Iterable, List, Optional, Union
 
 import numpy as np
 
@@ -10,14 +11,29 @@ class NearestKeyLookup:
     """
     Given a keyboard grid and a list of nearest_key_candidates
     returns the nearest key label for a given (x, y) coordinate.
+
+    The nearest keys of all coordinates within the keyboard are stored
+    as a (width, height) uint8 array of label ids (`coord_to_label_id`);
+    `labels[label_id]` is the label. The array is ~700 KB for
+    a 1080 x 667 grid and can be saved as .npy and memory-mapped.
     """
 
+    # Coordinates are encoded as a single int64 to search
+    # out-of-bounds coordinates in a sorted array.
+    _COORD_OFFSET = 2**20
+    _COORD_STRIDE = 2**21
+
+    # Distances are calculated for this many x coordinates at once
+    # to limit memory used by (chunk, height, n_keys) distances array.
+    _X_CHUNK_SIZE = 64
+
     def __init__(self, 
                  grid: dict, 
                  nearest_key_candidates: Iterable[str]) -> None:
         self._nearest_key_candidates = nearest_key_candidates
         self.grid = grid
-        self.coord_to_kb_label = self._create_coord_to_kb_label(grid)
+        self._init_keys(grid)
+        self.coord_to_label_id = self._create_coord_to_label_id(grid)
     
     def __call__(self, x, y):
         return self.get_nearest_kb_label(x, y)
@@ -35,55 +51,94 @@ class NearestKeyLookup:
         y = hitbox['y'] + hitbox['h'] / 2
         return x, y
     
+    def _init_keys(self, grid: dict) -> None:
+        """
+        Creates the label table and arrays of allowed keys'
+        centers and label ids (in the order of grid['keys']).
+        """
+        label_to_id = {}
+        self.keys = [key for key in grid['keys']
+                     if self.is_allowed_label(self._get_kb_label(key))]
+        for key in self.keys:
+            label_to_id.setdefault(self._get_kb_label(key), len(label_to_id))
+        self.labels: List[str] = list(label_to_id)
+        assert len(self.labels) <= np.iinfo(np.uint8).max, "Too many labels for uint8 ids"
+        self.key_label_ids = np.array(
+            [label_to_id[self._get_kb_label(key)] for key in self.keys], dtype=np.uint8)
+        self.key_centers = np.array(
+            [self._get_key_center(key['hitbox']) for key in self.keys], dtype=np.float64)
+        self.label_to_id = label_to_id
+
+    def _get_label_ids_without_map(self, X: np.ndarray, Y: np.ndarray) -> np.ndarray:
+        """
+        Returns label ids of the nearest keys for arrays of coordinates
+        (of any equal shapes) calculating distances to all key centers.
+        If distances are equal, the key that goes first in grid['keys'] wins.
+        """
+        dx = X[..., None] - self.key_centers[:, 0]
+        dy = Y[..., None] - self.key_centers[:, 1]
+        return self.key_label_ids[np.argmin(dx**2 + dy**2, axis=-1)]
+
     def _get_kb_label_without_map(self, x: int, y: int) -> str:
         """
         Returns label of the nearest key on the keyboard without using a map.
+        """
+        label_id = self._get_label_ids_without_map(np.array(x), np.array(y))
+        return self.labels[label_id]
          
-        Iterates over all keys and calculates the
-        distance to (x, y) to find the nearest one.
-        """
-        min_dist = float("inf")
-
-        for key in self.grid['keys']:
-            label = self._get_kb_label(key)
-            
-            if not self.is_allowed_label(label):
-                continue
-
-            key_x, key_y = self._get_key_center(key['hitbox'])
-            dist = (x - key_x)**2 + (y - key_y)**2
-            if dist < min_dist:
-                min_dist = dist
-                nearest_kb_label = label 
-        return nearest_kb_label
-    
-    def _create_coord_to_kb_label(self, grid: dict) -> np.ndarray: # dtype = object
-        # It may be confusing that coord_to_kb_label's height = grid['width']
+    def _create_coord_to_label_id(self, grid: dict) -> np.ndarray:
+        # It may be confusing that coord_to_label_id's height = grid['width']
         # and width = grid['height'], but it's correct.
-        coord_to_kb_label = np.zeros(
-            (grid['width'], grid['height']), dtype=object)  # 1080 x 640 in our case
-        coord_to_kb_label.fill('')
-
-        for key in grid['keys']:
-            label = self._get_kb_label(key)
-
-            if not self.is_allowed_label(label):
-                continue
+        w, h = grid['width'], grid['height']
+        coord_to_label_id = np.empty((w, h), dtype=np.uint8)  # 1080 x 640 in our case
+        ys = np.arange(h, dtype=np.float64)
+        for x_start in range(0, w, self._X_CHUNK_SIZE):
+            xs = np.arange(x_start, min(x_start + self._X_CHUNK_SIZE, w), dtype=np.float64)
+            coord_to_label_id[x_start: x_start + len(xs)] = self._get_label_ids_without_map(
+                xs[:, None], ys[None, :])
 
+        # A point within a hitbox belongs to the key even if
+        # another key's center is nearer.
+        for key, label_id in zip(self.keys, self.key_label_ids):
             x_left = key['hitbox']['x']
             x_right = x_left + key['hitbox']['w']
             y_top = key['hitbox']['y']
             y_bottom = y_top + key['hitbox']['h']
 
-            coord_to_kb_label[x_left:x_right, y_top:y_bottom] = label
+            coord_to_label_id[x_left:x_right, y_top:y_bottom] = label_id
 
-        for x in range(grid['width']):
-            for y in range(grid['height']):
-                if coord_to_kb_label[x, y] != '':
-                    continue
-                coord_to_kb_label[x, y] = self._get_kb_label_without_map(x, y)
+        return coord_to_label_id
 
-        return coord_to_kb_label
+    @property
+    def coord_to_kb_label(self) -> np.ndarray:  # dtype = object
+        """
+        (width, height) array of nearest key labels.
+        Created on access; prefer `coord_to_label_id` and `labels`.
+        """
+        return np.array(self.labels, dtype=object)[self.coord_to_label_id]
+
+    def _is_in_bounds(self, X: np.ndarray, Y: np.ndarray) -> np.ndarray:
+        w, h = self.coord_to_label_id.shape
+        return (X >= 0) & (X < w) & (Y >= 0) & (Y < h)
+
+    def _get_out_of_bounds_label_ids(self, X: np.ndarray, Y: np.ndarray) -> np.ndarray:
+        return self._get_label_ids_without_map(X.astype(np.float64), Y.astype(np.float64))
+
+    def get_label_ids(self, X: Iterable[int], Y: Iterable[int]) -> np.ndarray:
+        """
+        Vectorized version of get_nearest_kb_label: returns
+        a uint8 array of label ids for integer coordinate arrays.
+        """
+        X = np.asarray(X, dtype=np.int64)
+        Y = np.asarray(Y, dtype=np.int64)
+        in_bounds = self._is_in_bounds(X, Y)
+        label_ids = np.empty(X.shape, dtype=np.uint8)
+        label_ids[in_bounds] = self.coord_to_label_id[X[in_bounds], Y[in_bounds]]
+        if not in_bounds.all():
+            out_of_bounds = ~in_bounds
+            label_ids[out_of_bounds] = self._get_out_of_bounds_label_ids(
+                X[out_of_bounds], Y[out_of_bounds])
+        return label_ids
     
     def get_nearest_kb_label(self, x: int, y: int):
         """
@@ -92,35 +147,59 @@ class NearestKeyLookup:
         By default it uses an array assosiated that stores 
         the nearest key label for every coord pair within the keyboard.
         If the coordinate is out of bounds, finds the nearest key 
-        by iterating over all keys (among nearest_key_candidates).
+        by calculating distances to all keys (among nearest_key_candidates).
         """        
         if x < 0 or x >= self.grid['width'] or y < 0 or y >= self.grid['height']:
             return self._get_kb_label_without_map(x, y)
-        return self.coord_to_kb_label[x, y]
+        return self.labels[self.coord_to_label_id[x, y]]
+
+    @staticmethod
+    def _get_map_path(path: str) -> str:
+        return os.path.splitext(path)[0] + '__coord_to_label_id.npy'
     
     def _get_state(self) -> dict:
         state = {
             'nearest_key_candidates': self._nearest_key_candidates,
-            'coord_to_kb_label': self.coord_to_kb_label,
             'grid': self.grid
         }
         return state
         
     def save_state(self, path: str) -> None:
+        """
+        Saves the state to a pickle file at `path` and
+        the coord_to_label_id array to a .npy file next to it.
+        """
         state = self._get_state()
         with open(path, 'wb') as f:
             pickle.dump(state, f)
+        np.save(self._get_map_path(path), self.coord_to_label_id)
+
+    def _set_state(self, state: dict, path: str, mmap: bool) -> None:
+        self._nearest_key_candidates = state['nearest_key_candidates']
+        self.grid = state['grid']
+        self._init_keys(self.grid)
+        if 'coord_to_kb_label' in state:
+            # State saved by a version that stored labels as objects.
+            self.coord_to_label_id = self._label_array_to_ids(state['coord_to_kb_label'])
+        else:
+            self.coord_to_label_id = np.load(
+                self._get_map_path(path), mmap_mode='r' if mmap else None)
+
+    def _label_array_to_ids(self, label_array: np.ndarray) -> np.ndarray:
+        unique_labels, label_idxs = np.unique(label_array, return_inverse=True)
+        unique_label_ids = np.array(
+            [self.label_to_id[label] for label in unique_labels], dtype=np.uint8)
+        return unique_label_ids[label_idxs].reshape(label_array.shape)
         
     @classmethod
-    def from_state_dict(cls, path: str):
+    def from_state_dict(cls, path: str, mmap: bool = True):
+        """
+        If mmap is True, coord_to_label_id is memory-mapped.
+        """
         with open(path, 'rb') as f:
             state = pickle.load(f)
         obj = cls.__new__(cls)
-
-        obj._nearest_key_candidates = state['nearest_key_candidates']
-        obj.grid = state['grid']
-        obj.coord_to_kb_label = state['coord_to_kb_label']
-
+        obj._set_state(state, path, mmap)
         return obj
 
 
@@ -131,38 +210,85 @@ class ExtendedNearestKeyLookup(NearestKeyLookup):
     list. 
     This is useful during training when all the out-of-bounds
     coordinates are known and we can precompute the nearest key labels. 
+
+    Extended coordinates are stored as a sorted int64 array
+    of encoded coordinates and a uint8 array of their label ids.
     """
     def __init__(self, 
                  grid: dict, 
                  nearest_key_candidates: Iterable[str],
-                 extended_coords: Iterable[Tuple[int, int]]) -> None:
-        self._nearest_key_candidates = nearest_key_candidates
-        self.grid = grid
-        self.coord_to_kb_label = self._create_coord_to_kb_label(grid)
-        self.extended_coord_to_kb_label = {
-            (x,y): self._get_kb_label_without_map(x, y) 
-            for x, y in extended_coords}
+                 extended_coords: Union[Iterable[Tuple[int, int]], np.ndarray]) -> None:
+        super().__init__(grid, nearest_key_candidates)
+        if not isinstance(extended_coords, np.ndarray):
+            extended_coords = list(extended_coords)
+        extended_coords = np.asarray(extended_coords, dtype=np.int64).reshape(-1, 2)
+        encoded_coords = np.unique(self._encode_coords(extended_coords[:, 0], extended_coords[:, 1]))
+        X, Y = self._decode_coords(encoded_coords)
+        self.extended_encoded_coords = encoded_coords
+        self.extended_label_ids = self._get_label_ids_without_map(
+            X.astype(np.float64), Y.astype(np.float64))
+
+    @classmethod
+    def _encode_coords(cls, X: np.ndarray, Y: np.ndarray) -> np.ndarray:
+        return (X + cls._COORD_OFFSET) * cls._COORD_STRIDE + (Y + cls._COORD_OFFSET)
+
+    @classmethod
+    def _decode_coords(cls, encoded_coords: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        X, Y = np.divmod(encoded_coords, cls._COORD_STRIDE)
+        return X - cls._COORD_OFFSET, Y - cls._COORD_OFFSET
+
+    def _find_extended(self, X: np.ndarray, Y: np.ndarray
+                       ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns a mask of coordinates present among extended
+        coordinates and their indices in self.extended_label_ids.
+        """
+        encoded = self._encode_coords(X, Y)
+        idxs = np.searchsorted(self.extended_encoded_coords, encoded)
+        idxs = np.minimum(idxs, len(self.extended_encoded_coords) - 1)
+        is_found = self.extended_encoded_coords[idxs] == encoded \
+            if len(self.extended_encoded_coords) > 0 else np.zeros(X.shape, dtype=bool)
+        return is_found, idxs
+
+    @property
+    def extended_coord_to_kb_label(self) -> Dict[Tuple[int, int], str]:
+        X, Y = self._decode_coords(self.extended_encoded_coords)
+        return {(x, y): self.labels[label_id] for x, y, label_id
+                in zip(X.tolist(), Y.tolist(), self.extended_label_ids.tolist())}
+
+    def _get_out_of_bounds_label_ids(self, X: np.ndarray, Y: np.ndarray) -> np.ndarray:
+        is_found, idxs = self._find_extended(X, Y)
+        if is_found.all():
+            return self.extended_label_ids[idxs]
+        return np.where(is_found, self.extended_label_ids[idxs],
+                        super()._get_out_of_bounds_label_ids(X, Y))
 
     def get_nearest_kb_label(self, x: int, y: int):
-        if (x, y) in self.extended_coord_to_kb_label:
-            return self.extended_coord_to_kb_label[(x, y)]
+        if x < 0 or x >= self.grid['width'] or y < 0 or y >= self.grid['height']:
+            label_id = self._get_out_of_bounds_label_ids(
+                np.array([x], dtype=np.int64), np.array([y], dtype=np.int64))[0]
+            return self.labels[label_id]
         return super().get_nearest_kb_label(x, y)
     
     def _get_state(self) -> dict:
         state = super()._get_state()
-        state['extended_coord_to_kb_label'] = self.extended_coord_to_kb_label
+        state['extended_encoded_coords'] = self.extended_encoded_coords
+        state['extended_label_ids'] = self.extended_label_ids
         return state
     
-    @classmethod
-    def from_state_dict(cls, path: str):
-        with open(path, 'rb') as f:
-            state = pickle.load(f)
-        obj = cls.__new__(cls)
-
-        obj._nearest_key_candidates = state['nearest_key_candidates']
-        obj.grid = state['grid']
-        obj.coord_to_kb_label = state['coord_to_kb_label']
-        obj.extended_coord_to_kb_label = state['extended_coord_to_kb_label']
-
-        return obj
+    def _set_state(self, state: dict, path: str, mmap: bool) -> None:
+        super()._set_state(state, path, mmap)
+        if 'extended_coord_to_kb_label' in state:
+            # State saved by a version that stored a dict.
+            extended = state['extended_coord_to_kb_label']
+            coords = np.array(list(extended.keys()), dtype=np.int64).reshape(-1, 2)
+            encoded_coords = self._encode_coords(coords[:, 0], coords[:, 1])
+            label_ids = np.array([self.label_to_id[label] for label in extended.values()],
+                                 dtype=np.uint8)
+            order = np.argsort(encoded_coords)
+            self.extended_encoded_coords = encoded_coords[order]
+            self.extended_label_ids = label_ids[order]
+        else:
+            self.extended_encoded_coords = state['extended_encoded_coords']
+            self.extended_label_ids = state['extended_label_ids']
     
\ No newline at end of file
@@ -1,7 +1,7 @@
 from abc import ABC, abstractmethod
-from typing import List, Dict, Tuple, Set
-from collections import defaultdict
+from typing import List, Iterable, Optional
 
+import numpy as np
 import torch
 from torch import Tensor
 
@@ -14,12 +14,123 @@ class LogitProcessor(ABC):
         pass
 
 
-class VocabularyLogitProcessor(LogitProcessor):
+class StatefulLogitProcessor(LogitProcessor):
+    """
+    A logit processor that can process a whole batch of hypotheses at once.
+
+    Instead of a list of prefix token ids each hypothesis is represented
+    by an integer state. States are updated with generated tokens.
+    """
+    @abstractmethod
+    def get_initial_states(self, batch_size: int, device = 'cpu') -> Tensor:
+        """
+        Returns states of `batch_size` hypotheses that consist of <sos> only.
+        """
+        pass
+
+    @abstractmethod
+    def update_states(self, states: Tensor, next_tokens: Tensor) -> Tensor:
+        pass
+
+    @abstractmethod
+    def process_batch(self, logits: Tensor, states: Tensor) -> Tensor:
+        """
+        Arguments:
+        ----------
+        logits: Tensor of shape (batch_size, n_classes)
+        states: Tensor of shape (batch_size,)
+        """
+        pass
+
+
+class VocabularyTrie:
+    """
+    Array-backed prefix tree of tokenized words.
+
+    `children[node, token_id]` is the id of the node reached from `node`
+    by `token_id`. Node 0 is a "dead" node: it stands for all prefixes
+    that are not present in the vocabulary and has no children
+    (all of its children are node 0 too). Node 1 is the root that stands
+    for the prefix consisting of <sos> only.
+    """
+    DEAD_NODE = 0
+    ROOT_NODE = 1
+
+    def __init__(self, tokenized_words: Iterable[List[int]], n_tokens: int) -> None:
+        """
+        Arguments:
+        ----------
+        tokenized_words: Iterable[List[int]]
+            Words tokenized with <sos> as the first token.
+            <sos> itself is not stored in the trie.
+        n_tokens: int
+            Number of tokens in the tokenizer.
+        """
+        self.n_tokens = n_tokens
+        self.children = self._build_children(tokenized_words, n_tokens)
+
+    @classmethod
+    def from_children(cls, children: np.ndarray) -> 'VocabularyTrie':
+        trie = cls.__new__(cls)
+        trie.n_tokens = children.shape[1]
+        trie.children = children
+        return trie
+
+    def save(self, path: str) -> None:
+        np.save(path, self.children)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'VocabularyTrie':
+        """
+        If `mmap` is True the children table is memory-mapped 
+        in copy-on-write mode: processes that load the same file 
+        share its pages and the file is never modified.
+        """
+        return cls.from_children(np.load(path, mmap_mode='c' if mmap else None))
+
+    @staticmethod
+    def _build_children(tokenized_words: Iterable[List[int]], n_tokens: int) -> np.ndarray:
+        children = np.zeros((1024, n_tokens), dtype=np.int32)
+        n_nodes = 2  # dead node and root
+        for tokenized_word in tokenized_words:
+            node = VocabularyTrie.ROOT_NODE
+            for token_id in tokenized_word[1:]:
+                child = children[node, token_id]
+                if child == VocabularyTrie.DEAD_NODE:
+                    if n_nodes == len(children):
+                        children = np.concatenate([children, np.zeros_like(children)])
+                    child = n_nodes
+                    children[node, token_id] = child
+                    n_nodes += 1
+                node = child
+        return children[:n_nodes].copy()
+
+    @property
+    def n_nodes(self) -> int:
+        return len(self.children)
+
+    def get_node(self, prefix_ids: List[int]) -> int:
+        """
+        Returns a node for a prefix that starts with <sos>.
+        """
+        node = self.ROOT_NODE
+        for token_id in prefix_ids[1:]:
+            node = self.children[node, token_id]
+        return int(node)
+
+
+class VocabularyLogitProcessor(StatefulLogitProcessor):
     """
     Mask out the tokens that can't follow the generated prefix.
+
+    The vocabulary is stored as a VocabularyTrie. Allowed tokens 
+    of a node are the ones with a non-dead child, so masking is
+    one tensor indexing operation. States used by the batched interface
+    are trie node ids.
     """
-    def __init__(self, tokenizer: CharLevelTokenizerv2, 
-                 vocab: List[str], max_token_id: int) -> None:
+    def __init__(self, tokenizer: CharLevelTokenizerv2,
+                 vocab: Optional[List[str]], max_token_id: int,
+                 trie: Optional[VocabularyTrie] = None) -> None:
         """
         Arguments:
         ----------
@@ -36,31 +147,45 @@ class VocabularyLogitProcessor(LogitProcessor):
             It's supposed that if model doesn't generate some tokens,
             the unallowed tokens correspond to the last n_tokens - n_out_neurons
             tokens in the tokenizer.
+        trie: Optional[VocabularyTrie]
+            A prebuilt trie of the vocabulary (ex. loaded with
+            VocabularyTrie.load). If provided, vocab is not used.
         """
+        assert vocab is not None or trie is not None, \
+            "Either vocab or trie must be provided."
         self.tokenizer = tokenizer
         self.vocab = vocab
         self.max_token_id = max_token_id
-        self.prefix_to_allowed_ids = self._create_prefix_to_allowed_ids(vocab)
+        self.trie = trie if trie is not None else self._create_trie(vocab)
+        self.children = torch.from_numpy(self.trie.children)
 
-    def _create_prefix_to_allowed_ids(self, vocab: List[str]) -> Dict[Tuple[int, ...], Set[int]]:
+    def _create_trie(self, vocab: List[str]) -> VocabularyTrie:
         # ! When switching to another type of tokenizer where tokens are not just characters
-        # but can be a sequence of characters, we need to change the implementation of this method. 
-        prefix_to_allowed_ids = defaultdict(set)
-        for word in vocab:
-            tokenized_word = self.tokenizer.encode(word)
-            for i in range(1, len(tokenized_word)):
-                prefix = tuple(tokenized_word[:i])
-                prefix_to_allowed_ids[prefix].add(tokenized_word[i])
-        return prefix_to_allowed_ids
-
-    def _get_unallowed_token_ids(self, prefix_ids: List[int]) -> Set[int]:
-        allowed_ids = self.prefix_to_allowed_ids[tuple(prefix_ids)]
-        all_ids = set(self.tokenizer.idx_to_char.keys())
-        impossible_ids = set(range(self.max_token_id + 1, len(self.tokenizer.char_to_idx)))
-        unallowed_ids = all_ids - allowed_ids - impossible_ids
-        return unallowed_ids
+        # but can be a sequence of characters, we need to change the implementation of this method.
+        return VocabularyTrie(
+            (self.tokenizer.encode(word) for word in vocab),
+            n_tokens=len(self.tokenizer.char_to_idx))
+
+    def _get_allowed_mask(self, nodes) -> Tensor:
+        # allowed_mask[..., token_id] is True if token_id can follow node's prefix.
+        # It's not precomputed for all nodes to avoid a copy of the trie
+        # (the children table may be shared between processes via mmap).
+        return self.children[nodes, :self.max_token_id + 1] != VocabularyTrie.DEAD_NODE
 
     def process(self, logits: Tensor, prefix_ids: List[int]) -> Tensor:
-        unallowed_ids = self._get_unallowed_token_ids(prefix_ids)
-        logits[torch.tensor(list(unallowed_ids), dtype = torch.int)] = float('-inf')
+        allowed_mask = self._get_allowed_mask(self.trie.get_node(prefix_ids))
+        logits.masked_fill_(~allowed_mask.to(logits.device), float('-inf'))
+        return logits
+
+    def get_initial_states(self, batch_size: int, device = 'cpu') -> Tensor:
+        return torch.full((batch_size,), VocabularyTrie.ROOT_NODE,
+                          dtype=torch.int64, device=device)
+
+    def update_states(self, states: Tensor, next_tokens: Tensor) -> Tensor:
+        next_states = self.children[states.cpu(), next_tokens.cpu().long()]
+        return next_states.to(device=states.device, dtype=torch.int64)
+
+    def process_batch(self, logits: Tensor, states: Tensor) -> Tensor:
+        allowed_mask = self._get_allowed_mask(states.cpu()).to(logits.device)
+        logits.masked_fill_(~allowed_mask, float('-inf'))
         return logits
@@ -10,12 +10,14 @@ The primary difference between models is in the swipe point embedder.
 """
 
 
-from typing import Callable, Optional, Tuple
+from typing import Callable, Optional, Tuple, List
+from dataclasses import dataclass, replace
 import math
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch import Tensor
 
 
 
@@ -298,14 +300,153 @@ def _get_mask(max_seq_len: int):
 encode() and decode() methods are extremely useful in decoding algorithms
 like beamsearch where we do encoding once and decoding multimple times.
 Rhis reduces computations up to two times.
+
+decode_incremental() goes further: it stores self-attention keys and values
+of already decoded tokens and cross-attention keys and values of the
+encoder memory in a DecoderCache. Each step runs the decoder layers for 
+the last token only, so decoding a word costs O(L) instead of O(L^2).
 """
 
+
+@dataclass
+class DecoderCache:
+    """
+    State of incremental decoding for every layer of nn.TransformerDecoder.
+
+    `n_rows` is the number of decoded sequences. Memory is stored once
+    per encoded swipe and is shared by `rows_per_memory` consecutive rows
+    (for example, by all hypotheses of a beam): 
+    row `i` attends to memory `i // rows_per_memory`.
+
+    self_attn_keys, self_attn_values: List[Tensor]
+        i-th element is of shape (n_rows, n_heads, n_decoded_tokens, head_dim)
+    memory_keys, memory_values: List[Tensor]
+        i-th element is of shape (batch_size, n_heads, memory_len, head_dim)
+    memory_attn_mask: Optional[Tensor]
+        Shape (batch_size, 1, 1, memory_len). True for positions that 
+        take part in attention (an inverted memory_key_padding_mask).
+    """
+    self_attn_keys: List[Tensor]
+    self_attn_values: List[Tensor]
+    memory_keys: List[Tensor]
+    memory_values: List[Tensor]
+    memory_attn_mask: Optional[Tensor]
+    rows_per_memory: int = 1
+
+    @property
+    def n_decoded_tokens(self) -> int:
+        return self.self_attn_keys[0].size(2)
+
+    def reorder(self, row_indices: Tensor) -> 'DecoderCache':
+        """
+        Returns a cache where i-th row is `row_indices[i]`-th row of this cache.
+
+        Every row must stay within its memory group (e.g. beam search
+        may only pick parents among hypotheses of the same swipe).
+        """
+        return replace(
+            self,
+            self_attn_keys=[k.index_select(0, row_indices) for k in self.self_attn_keys],
+            self_attn_values=[v.index_select(0, row_indices) for v in self.self_attn_values])
+
+
+def _split_heads(x: Tensor, n_heads: int) -> Tensor:
+    # (seq_len, n_rows, d_model) -> (n_rows, n_heads, seq_len, head_dim)
+    seq_len, n_rows, d_model = x.shape
+    return x.view(seq_len, n_rows, n_heads, d_model // n_heads).permute(1, 2, 0, 3)
+
+
+def _merge_heads(x: Tensor) -> Tensor:
+    # (n_rows, n_heads, seq_len, head_dim) -> (seq_len, n_rows, d_model)
+    n_rows, n_heads, seq_len, head_dim = x.shape
+    return x.permute(2, 0, 1, 3).reshape(seq_len, n_rows, n_heads * head_dim)
+
+
+def _in_projection(mha: nn.MultiheadAttention, x: Tensor, 
+                   part: int, n_parts: int = 1) -> Tensor:
+    """
+    Applies `n_parts` consecutive parts of mha's packed q, k, v input 
+    projection starting from `part` (0 - q, 1 - k, 2 - v).
+    """
+    d_model = mha.embed_dim
+    weight = mha.in_proj_weight[part * d_model: (part + n_parts) * d_model]
+    bias = None
+    if mha.in_proj_bias is not None:
+        bias = mha.in_proj_bias[part * d_model: (part + n_parts) * d_model]
+    return F.linear(x, weight, bias)
+
+
+def _self_attn_step(mha: nn.MultiheadAttention, x: Tensor,
+                    past_keys: Optional[Tensor], past_values: Optional[Tensor]
+                    ) -> Tuple[Tensor, Tensor, Tensor]:
+    # x.shape = (1, n_rows, d_model)
+    q, k, v = _in_projection(mha, x, 0, 3).chunk(3, dim=-1)
+    q, k, v = (_split_heads(el, mha.num_heads) for el in (q, k, v))
+    if past_keys is not None:
+        k = torch.cat([past_keys, k], dim=2)
+        v = torch.cat([past_values, v], dim=2)
+    # The last token may attend to all previous tokens, no mask is needed.
+    attn = F.scaled_dot_product_attention(q, k, v)
+    return mha.out_proj(_merge_heads(attn)), k, v
+
+
+def _cross_attn_step(mha: nn.MultiheadAttention, x: Tensor,
+                     memory_keys: Tensor, memory_values: Tensor,
+                     memory_attn_mask: Optional[Tensor], 
+                     rows_per_memory: int) -> Tensor:
+    # x.shape = (1, n_rows, d_model)
+    q = _split_heads(_in_projection(mha, x, 0), mha.num_heads)  # (n_rows, n_heads, 1, head_dim)
+    n_rows, n_heads, _, head_dim = q.shape
+    # Rows sharing the same memory are treated as a sequence of queries.
+    q = q.view(n_rows // rows_per_memory, rows_per_memory, n_heads, head_dim).transpose(1, 2)
+    attn = F.scaled_dot_product_attention(q, memory_keys, memory_values, 
+                                          attn_mask=memory_attn_mask)
+    attn = attn.transpose(1, 2).reshape(n_rows, n_heads, 1, head_dim)
+    return mha.out_proj(_merge_heads(attn))
+
+
+def _decoder_layer_step(layer: nn.TransformerDecoderLayer, x: Tensor,
+                        cache: DecoderCache, layer_idx: int
+                        ) -> Tuple[Tensor, Tensor, Tensor]:
+    """
+    Same as nn.TransformerDecoderLayer.forward for the last token only.
+    Returns the layer output and updated self-attention keys and values.
+    """
+    past_keys, past_values = None, None
+    if cache.n_decoded_tokens > 0:
+        past_keys = cache.self_attn_keys[layer_idx]
+        past_values = cache.self_attn_values[layer_idx]
+    
+    def cross_attn(x):
+        return _cross_attn_step(
+            layer.multihead_attn, x, cache.memory_keys[layer_idx], 
+            cache.memory_values[layer_idx], cache.memory_attn_mask, 
+            cache.rows_per_memory)
+
+    if layer.norm_first:
+        sa, keys, values = _self_attn_step(layer.self_attn, layer.norm1(x), past_keys, past_values)
+        x = x + layer.dropout1(sa)
+        x = x + layer.dropout2(cross_attn(layer.norm2(x)))
+        x = x + layer._ff_block(layer.norm3(x))
+    else:
+        sa, keys, values = _self_attn_step(layer.self_attn, x, past_keys, past_values)
+        x = layer.norm1(x + layer.dropout1(sa))
+        x = layer.norm2(x + layer.dropout2(cross_attn(x)))
+        x = layer.norm3(x + layer._ff_block(x))
+    return x, keys, values
+
+
 class EncoderDecoderTransformerLike(nn.Module):
     def _get_mask(self, max_seq_len: int):
         """
         Returns a mask for the decoder transformer.
+
+        The mask is a slice of the cached `causal_mask` buffer, so it's
+        already on the model's device and nothing is allocated.
         """
-        return _get_mask(max_seq_len)
+        if max_seq_len <= len(self.causal_mask):
+            return self.causal_mask[:max_seq_len, :max_seq_len]
+        return _get_mask(max_seq_len).to(device=self.causal_mask.device)
 
     def __init__(self, 
                  enc_in_emb_model: nn.Module, 
@@ -313,15 +454,32 @@ class EncoderDecoderTransformerLike(nn.Module):
                  encoder: nn.Module, 
                  decoder: nn.Module, 
                  out: nn.Module,
-                 device: Optional[str] = None):
+                 device: Optional[str] = None,
+                 max_out_seq_len: int = 35):
+        """
+        Arguments:
+        ----------
+        device: Optional[str]
+            Initial device of the causal mask buffer. The buffer 
+            follows the model on .to(), so the argument is optional.
+        max_out_seq_len: int
+            Size of the cached causal mask. Longer masks are 
+            created on demand.
+        """
         super().__init__()
         self.enc_in_emb_model = enc_in_emb_model
         self.dec_in_emb_model = dec_in_emb_model
         self.encoder = encoder
         self.decoder = decoder
         self.out = out  # linear
-        self.device = torch.device(
-            device or 'cuda' if torch.cuda.is_available() else 'cpu')
+        # Not persistent: state dicts stay compatible with old checkpoints.
+        self.register_buffer(
+            'causal_mask', _get_mask(max_out_seq_len).to(device=device), persistent=False)
+
+    @property
+    def device(self) -> torch.device:
+        # The actual device of the model (changes on .to()).
+        return self.causal_mask.device
 
     # x can be a tuple (ex. traj_feats, kb_tokens) or a single tensor
     # (ex. just kb_tokens).
@@ -331,12 +489,90 @@ class EncoderDecoderTransformerLike(nn.Module):
     
     def decode(self, y, x_encoded, memory_key_padding_mask, tgt_key_padding_mask):
         y = self.dec_in_emb_model(y)
-        tgt_mask = self._get_mask(len(y)).to(device=self.device)
+        tgt_mask = self._get_mask(len(y))
         dec_out = self.decoder(y, x_encoded, tgt_mask=tgt_mask, 
                                memory_key_padding_mask=memory_key_padding_mask, 
                                tgt_key_padding_mask=tgt_key_padding_mask)
         return self.out(dec_out)
 
+    def init_decoder_cache(self, x_encoded: Tensor, 
+                           memory_key_padding_mask: Optional[Tensor] = None,
+                           rows_per_memory: int = 1) -> DecoderCache:
+        """
+        Precomputes cross-attention keys and values over the encoder memory.
+
+        Arguments:
+        ----------
+        x_encoded: Tensor
+            Encoder output of shape (curve_len, batch_size, d_model).
+        memory_key_padding_mask: Optional[Tensor]
+            Shape (batch_size, curve_len).
+        rows_per_memory: int
+            Number of decoded sequences per swipe (e.g. beamsize).
+            Decoded rows are expected to be grouped by swipe: 
+            row `i` belongs to swipe `i // rows_per_memory`.
+        """
+        memory_keys, memory_values = [], []
+        for layer in self.decoder.layers:
+            mha = layer.multihead_attn
+            k, v = _in_projection(mha, x_encoded, 1, 2).chunk(2, dim=-1)
+            memory_keys.append(_split_heads(k, mha.num_heads))
+            memory_values.append(_split_heads(v, mha.num_heads))
+
+        memory_attn_mask = None
+        if memory_key_padding_mask is not None:
+            memory_attn_mask = ~memory_key_padding_mask.bool()[:, None, None, :]
+        
+        n_rows = x_encoded.size(1) * rows_per_memory
+        n_layers = len(self.decoder.layers)
+        empty = x_encoded.new_empty((n_rows, 0, 0, 0))
+        return DecoderCache(
+            self_attn_keys=[empty] * n_layers, self_attn_values=[empty] * n_layers,
+            memory_keys=memory_keys, memory_values=memory_values,
+            memory_attn_mask=memory_attn_mask, rows_per_memory=rows_per_memory)
+
+    def decode_incremental(self, y: Tensor, cache: DecoderCache
+                           ) -> Tuple[Tensor, DecoderCache]:
+        """
+        Returns logits for the next token and the updated cache.
+
+        Is equivalent to `self.decode(y, ...)[-1]` but runs decoder 
+        layers only for the last token of `y`. The cache is not modified
+        in place so it can be shared between hypotheses.
+
+        Arguments:
+        ----------
+        y: Tensor
+            Whole decoded prefix of shape (chars_seq_len, n_rows).
+            The cache must store the first `chars_seq_len - 1` tokens.
+            Positions after <eos> are not masked (unlike decode() 
+            with tgt_key_padding_mask) so rows of finished sequences 
+            produce garbage that should be ignored.
+
+        Returns:
+        --------
+        logits: Tensor of shape (n_rows, n_classes)
+        cache: DecoderCache
+        """
+        assert cache.n_decoded_tokens == len(y) - 1, \
+            f"Cache stores {cache.n_decoded_tokens} tokens, but prefix length is {len(y)}"
+        # Embedding is computed for the whole prefix because
+        # positional encoding is a part of dec_in_emb_model. 
+        # It's negligible compared to decoder layers.
+        x = self.dec_in_emb_model(y)[-1:]
+
+        self_attn_keys, self_attn_values = [], []
+        for layer_idx, layer in enumerate(self.decoder.layers):
+            x, keys, values = _decoder_layer_step(layer, x, cache, layer_idx)
+            self_attn_keys.append(keys)
+            self_attn_values.append(values)
+        if self.decoder.norm is not None:
+            x = self.decoder.norm(x)
+        
+        cache = replace(cache, self_attn_keys=self_attn_keys, 
+                        self_attn_values=self_attn_values)
+        return self.out(x)[0], cache
+
     def forward(self, x, y, x_pad_mask, y_pad_mask):
         x_encoded = self.encode(x, x_pad_mask)
         return self.decode(y, x_encoded, x_pad_mask, y_pad_mask)
@@ -453,24 +689,47 @@ def _get_transformer_bigger__v3(input_embedding: nn.Module,
 
 
     return EncoderDecoderTransformerLike(
-        input_embedding, word_char_embedding_model, encoder, decoder, out
+        input_embedding, word_char_embedding_model, encoder, decoder, out,
+        max_out_seq_len=MAX_OUT_SEQ_LEN
     )
 
 
 
-def _set_state(model, weights_path, device):
+def quantize_dynamic_int8(model: nn.Module) -> nn.Module:
+    """
+    Returns a copy of the model with nn.Linear layers replaced
+    by dynamically quantized int8 ones (weights are stored in int8,
+    activations are quantized on the fly). CPU only.
+
+    Attention projections of nn.MultiheadAttention are not
+    quantized: in_proj is a bare parameter and out_proj is a
+    NonDynamicallyQuantizableLinear. So the feedforward layers 
+    and the output layer are quantized, and `decode_incremental`
+    works unchanged.
+    """
+    return torch.ao.quantization.quantize_dynamic(
+        model, {nn.Linear}, dtype=torch.qint8)
+
+
+
+def _set_state(model, weights_path, device, quantize: bool = False):
     if weights_path:
         model.load_state_dict(
             torch.load(weights_path, map_location = device))
     model = model.to(device)
     model = model.eval()
+    if quantize:
+        assert torch.device(device).type == 'cpu', \
+            "Dynamic quantization is only supported on cpu"
+        model = quantize_dynamic_int8(model)
     return model
 
 
 
 def get_transformer_bigger_weighted_and_traj__v3(device = None, 
                                                  weights_path = None,
-                                                 n_coord_feats = 6) -> EncoderDecoderTransformerLike:
+                                                 n_coord_feats = 6,
+                                                 quantize: bool = False) -> EncoderDecoderTransformerLike:
     CHAR_VOCAB_SIZE = 37  # = len(word_char_tokenizer.char_to_idx)
     MAX_CURVES_SEQ_LEN = 299
     # Actually, n_keys != n_word_chars. n_keys = 36.
@@ -490,7 +749,7 @@ def get_transformer_bigger_weighted_and_traj__v3(device = None,
     
     model = _get_transformer_bigger__v3(input_embedding, device)
 
-    model = _set_state(model, weights_path, device)
+    model = _set_state(model, weights_path, device, quantize)
 
     return model
 
@@ -499,7 +758,8 @@ def get_transformer_bigger_weighted_and_traj__v3(device = None,
 
 def get_transformer_bigger_nearest_and_traj__v3(device = None,
                                                 weights_path = None,
-                                                n_coord_feats = 6) -> EncoderDecoderTransformerLike:
+                                                n_coord_feats = 6,
+                                                quantize: bool = False) -> EncoderDecoderTransformerLike:
     device = torch.device(
         device 
         or 'cuda' if torch.cuda.is_available() else 'cpu')
@@ -513,7 +773,7 @@ def get_transformer_bigger_nearest_and_traj__v3(device = None,
     
     model = _get_transformer_bigger__v3(input_embedding, device)
 
-    model = _set_state(model, weights_path, device)
+    model = _set_state(model, weights_path, device, quantize)
 
     return model
 
@@ -523,7 +783,8 @@ def get_transformer_bigger_nearest_and_traj__v3(device = None,
 
 def get_transformer_bigger_nearest_only__v3(device = None,
                                             weights_path = None,
-                                            n_coord_feats = 0) -> EncoderDecoderTransformerLike:
+                                            n_coord_feats = 0,
+                                            quantize: bool = False) -> EncoderDecoderTransformerLike:
     assert n_coord_feats == 0, f"n_coord_feats is {n_coord_feats}, but should be 0"
     device = torch.device(
         device 
@@ -536,7 +797,7 @@ def get_transformer_bigger_nearest_only__v3(device = None,
     
     model = _get_transformer_bigger__v3(input_embedding, device)
 
-    model = _set_state(model, weights_path, device)
+    model = _set_state(model, weights_path, device, quantize)
 
     return model
 
@@ -546,7 +807,8 @@ def get_transformer_bigger_trainable_gaussian_weights_and_traj__v3(
                                                                 device = None,
                                                                 weights_path = None,
                                                                 n_coord_feats = 6,
-                                                                key_centers: Optional[torch.Tensor] = None
+                                                                key_centers: Optional[torch.Tensor] = None,
+                                                                quantize: bool = False
                                                                 ) -> EncoderDecoderTransformerLike:
     device = torch.device(
         device 
@@ -562,7 +824,7 @@ def get_transformer_bigger_trainable_gaussian_weights_and_traj__v3(
     
     model = _get_transformer_bigger__v3(input_embedding, device)
 
-    model = _set_state(model, weights_path, device)
+    model = _set_state(model, weights_path, device, quantize)
 
     return model
 
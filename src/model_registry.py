@@ -0,0 +1,127 @@
+"""
+Caches models, tokenizers and logit processors shared by predictors.
+
+Model weights are read with `torch.load(mmap=True)`: the checkpoint
+is not read into an intermediate buffer, its pages are copied straight
+into the model parameters. The parameters never alias the file, so
+a checkpoint overwritten later (ex. by a running training) doesn't
+affect already loaded models.
+
+Cache keys include the size and modification time of the files,
+so an overwritten checkpoint or vocabulary is loaded again.
+"""
+
+from typing import Callable, Hashable, Optional, Tuple
+from collections import OrderedDict
+import os
+
+import torch
+
+from model import MODEL_GETTERS_DICT, EncoderDecoderTransformerLike, quantize_dynamic_int8
+from ns_tokenizers import CharLevelTokenizerv2, get_vocab
+from logit_processors import VocabularyLogitProcessor
+
+
+def _get_file_stamp(path: str) -> Tuple[str, int, int]:
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+
+def load_model(model_architecture_name: str,
+               weights_path: Optional[str],
+               n_coord_feats: int,
+               device = 'cpu',
+               quantize: bool = False) -> EncoderDecoderTransformerLike:
+    """
+    Same as MODEL_GETTERS_DICT[model_architecture_name](...)
+    but the state dict is memory-mapped instead of being read into memory.
+    """
+    device = torch.device(device)
+    model = MODEL_GETTERS_DICT[model_architecture_name](
+        device, None, n_coord_feats=n_coord_feats)
+    if weights_path:
+        state_dict = torch.load(weights_path, map_location='cpu', mmap=True)
+        # Weights are copied: parameters assigned from a private mapping
+        # would change (or raise SIGBUS) if the file is rewritten in place.
+        model.load_state_dict(state_dict)
+        del state_dict
+    model = model.to(device).eval()
+    if quantize:
+        assert device.type == 'cpu', "Dynamic quantization is only supported on cpu"
+        model = quantize_dynamic_int8(model)
+    return model
+
+
+class LRUCache:
+    """
+    A mapping that keeps at most `maxsize` most recently used values.
+    """
+    def __init__(self, maxsize: int) -> None:
+        assert maxsize > 0, f"maxsize should be positive, got {maxsize}"
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def get_or_create(self, key: Hashable, create: Callable[[], object]):
+        if key in self._data:
+            self._data.move_to_end(key)
+            return self._data[key]
+        value = create()
+        self._data[key] = value
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        return value
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+class ModelRegistry:
+    """
+    Creates models, tokenizers and vocabulary logit processors once
+    and returns cached instances on subsequent calls with the same
+    arguments. Cached models are shared: they should only be used
+    for inference.
+    """
+    def __init__(self, max_models: int = 4,
+                 max_tokenizers: int = 4,
+                 max_logit_processors: int = 2) -> None:
+        """
+        Arguments:
+        ----------
+        max_models: int
+            Number of models kept in memory. A v3 model is a few MiB.
+        max_logit_processors: int
+            Number of vocabulary logit processors kept in memory.
+            Each stores a trie of the whole vocabulary.
+        """
+        self.models = LRUCache(max_models)
+        self.tokenizers = LRUCache(max_tokenizers)
+        self.logit_processors = LRUCache(max_logit_processors)
+
+    def get_model(self, model_architecture_name: str, weights_path: Optional[str],
+                  n_coord_feats: int, device = 'cpu',
+                  quantize: bool = False) -> EncoderDecoderTransformerLike:
+        weights_stamp = _get_file_stamp(weights_path) if weights_path else None
+        key = (model_architecture_name, weights_stamp, n_coord_feats,
+               str(torch.device(device)), quantize)
+        return self.models.get_or_create(key, lambda: load_model(
+            model_architecture_name, weights_path, n_coord_feats, device, quantize))
+
+    def get_tokenizer(self, voc_path: str) -> CharLevelTokenizerv2:
+        return self.tokenizers.get_or_create(
+            _get_file_stamp(voc_path), lambda: CharLevelTokenizerv2(voc_path))
+
+    def get_logit_processor(self, voc_path: str,
+                            max_token_id: int) -> VocabularyLogitProcessor:
+        def create() -> VocabularyLogitProcessor:
+            return VocabularyLogitProcessor(
+                tokenizer=self.get_tokenizer(voc_path),
+                vocab=get_vocab(voc_path), max_token_id=max_token_id)
+        key = (_get_file_stamp(voc_path), max_token_id)
+        return self.logit_processors.get_or_create(key, create)
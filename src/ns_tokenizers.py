@@ -8,6 +8,14 @@ ALL_CYRILLIC_LETTERS_ALPHABET_ORD = [
 ]
 
 
+def get_vocab(vocab_path: str) -> List[str]:
+    """
+    Reads a vocabulary file with one word per line.
+    """
+    with open(vocab_path, 'r', encoding = "utf-8") as f:
+        return f.read().splitlines()
+
+
 class CharLevelTokenizerv2:
     """
     Tokenizes a word into a list of integers.
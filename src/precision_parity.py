@@ -0,0 +1,164 @@
+"""
+Compares a low-precision inference mode (dynamic int8 quantization
+and / or bf16 autocast, see Predictor) against fp32 on a subset
+of a validation split and prints an accuracy-parity report.
+
+Usage example:
+python src/precision_parity.py --config configs/config__my_nearest_features.json \
+    --n-swipes 1000 --quantize --batch-size 64
+"""
+
+from typing import List, Tuple, Dict, Optional
+import io
+import os
+import json
+import time
+import argparse
+
+import torch
+
+from predict_v2 import Predictor, get_config, get_gridname_to_dataset
+from model_registry import ModelRegistry
+from ns_tokenizers import CharLevelTokenizerv2
+from metrics import get_mmr, get_accuracy
+
+
+RawPredictionType = List[List[Tuple[float, str]]]
+
+
+def get_precision_parity_report(reference_preds: RawPredictionType,
+                                preds: RawPredictionType,
+                                labels: Optional[List[str]] = None
+                                ) -> Dict[str, float]:
+    """
+    Arguments:
+    ----------
+    reference_preds: RawPredictionType
+        fp32 predictions: reference_preds[i] is a list of
+        (score, word) tuples for the i-th swipe.
+    preds: RawPredictionType
+        Predictions of the same swipes in a low-precision mode.
+    labels: Optional[List[str]]
+        Target words. If provided, accuracy and mmr
+        of both predictions are added to the report.
+    """
+    assert len(reference_preds) == len(preds)
+    reference_words = [[word for _, word in swipe_preds] for swipe_preds in reference_preds]
+    words = [[word for _, word in swipe_preds] for swipe_preds in preds]
+
+    n = len(preds)
+    top1_score_diffs = [
+        abs(ref[0][0] - pred[0][0]) for ref, pred in zip(reference_preds, preds)
+        if ref and pred and ref[0][1] == pred[0][1]]
+    report = {
+        'n_swipes': n,
+        'top1_agreement': sum(ref[:1] == w[:1] for ref, w in zip(reference_words, words)) / n,
+        'top4_agreement': sum(ref[:4] == w[:4] for ref, w in zip(reference_words, words)) / n,
+        'max_top1_score_diff': max(top1_score_diffs, default=0.0),
+    }
+
+    if labels is not None:
+        for prefix, preds_words in (('fp32', reference_words), ('low_precision', words)):
+            report[f'{prefix}_accuracy'] = get_accuracy(
+                [swipe_words[0] if swipe_words else '' for swipe_words in preds_words], labels)
+            report[f'{prefix}_mmr'] = get_mmr(
+                [swipe_words[:4] for swipe_words in preds_words], labels)
+        report['accuracy_diff'] = report['low_precision_accuracy'] - report['fp32_accuracy']
+        report['mmr_diff'] = report['low_precision_mmr'] - report['fp32_mmr']
+
+    return report
+
+
+def get_state_dict_size(model: torch.nn.Module) -> int:
+    """Size of the serialized state dict in bytes."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def get_labels(dataset, tokenizer: CharLevelTokenizerv2) -> Optional[List[str]]:
+    """
+    Decodes target words of dataset elements ((encoder_in, decoder_in), decoder_out).
+    Returns None if the dataset has no targets (ex. the test split).
+    """
+    labels = []
+    for (_, _), decoder_out in dataset:
+        if decoder_out is None:
+            return None
+        # The last token is <eos>.
+        labels.append(tokenizer.decode(decoder_out[:-1]))
+    return labels
+
+
+def _predict_timed(predictor: Predictor, dataset, num_workers: int
+                   ) -> Tuple[RawPredictionType, float]:
+    start = time.perf_counter()
+    preds = predictor.predict_raw(dataset, num_workers)
+    return preds, time.perf_counter() - start
+
+
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser()
+    p.add_argument('--config', type=str)
+    p.add_argument('--model-idx', type=int, default=0,
+                   help='Index of the model in config["model_params"].')
+    p.add_argument('--n-swipes', type=int, default=1000)
+    p.add_argument('--quantize', action='store_true')
+    p.add_argument('--bf16-autocast', action='store_true')
+    p.add_argument('--num-workers', type=int, default=0)
+    p.add_argument('--batch-size', type=int, default=None)
+    args = p.parse_args()
+    return args
+
+
+def main() -> None:
+    args = parse_args()
+    assert args.quantize or args.bf16_autocast, \
+        "Nothing to compare: set --quantize and / or --bf16-autocast"
+
+    config = get_config(args.config)
+
+    grid_name, model_getter_name, weights_f_name = config['model_params'][args.model_idx]
+    dataset = get_gridname_to_dataset(config)[grid_name]
+    n_swipes = min(args.n_swipes, len(dataset))
+    dataset = [dataset[i] for i in range(n_swipes)]
+    labels = get_labels(dataset, CharLevelTokenizerv2(config['voc_path']))
+
+    # Both predictors share the tokenizer and the logit processor.
+    registry = ModelRegistry()
+    report = {}
+    all_preds = []
+    for name, quantize, use_bf16_autocast in (
+            ('fp32', False, False),
+            ('low_precision', args.quantize, args.bf16_autocast)):
+        predictor = Predictor(
+            model_getter_name,
+            os.path.join(config['models_root'], weights_f_name),
+            include_coords=config['include_coords'],
+            include_time=config['include_time'],
+            include_velocities=config['include_velocities'],
+            include_accelerations=config['include_accelerations'],
+            word_generator_type=config['generator'],
+            use_vocab_for_generation=config['use_vocab_for_generation'],
+            n_classes=config['n_classes'],
+            generator_call_kwargs=config['generator_call_kwargs'],
+            voc_path=config['voc_path'],
+            batch_size=args.batch_size,
+            quantize=quantize,
+            use_bf16_autocast=use_bf16_autocast,
+            registry=registry,
+        )
+        preds, seconds = _predict_timed(predictor, dataset, args.num_workers)
+        all_preds.append(preds)
+        report[f'{name}_seconds'] = seconds
+        report[f'{name}_state_dict_bytes'] = get_state_dict_size(
+            predictor.word_generator.model)
+
+    report.update(get_precision_parity_report(*all_preds, labels))
+    report['quantize'] = args.quantize
+    report['bf16_autocast'] = args.bf16_autocast
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
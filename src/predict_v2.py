@@ -1,8 +1,10 @@
 # ! Если use_vocab_for_generation == True 
-# многопоточность почему-то сильно медленнее, чем выполнение в главном потоке.
-# Поэтому num_workers должно быть равно 0 (это запуск без многопоточности).
-# Предполагаю, что замедление связано с переносом из одного потока в другой
-# очень большого словаря, хранящегося в генераторе слов
+# многопоточность раньше была сильно медленнее, чем выполнение в главном потоке:
+# с каждой задачей в процесс передавался генератор слов вместе с моделью
+# и очень большим словарем.  Теперь модель и словарь (префиксное дерево,
+# сохраненное в .npy и открытое через mmap) загружаются один раз
+# в каждом процессе (см. _init_worker), а задачи содержат только
+# индекс кривой и ее признаки.
 
 
 # Сейчас предсказания отдельных моделей сохраняются как список списков
@@ -48,22 +50,29 @@ import os
 import json
 import pickle
 import argparse
+import tempfile
+import contextlib
 from dataclasses import dataclass, asdict
 
 
 import torch
 from torch import Tensor
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, DataLoader
 from tqdm import tqdm
 from concurrent.futures import ProcessPoolExecutor
 # import pandas as pd
 
-from model import MODEL_GETTERS_DICT
-from ns_tokenizers import CharLevelTokenizerv2, KeyboardTokenizerv1
-from dataset import CurveDataset, CurveDatasetSubset
-from word_generators_v2 import GENERATOR_CTORS_DICT, WordGenerator
+from model_registry import ModelRegistry, load_model
+from ns_tokenizers import CharLevelTokenizerv2, KeyboardTokenizerv1, get_vocab
+from dataset import (CurveDataset, CurveDatasetSubset, CollateFnV2, 
+                     LengthBucketedBatchSampler, get_padding_ratio,
+                     get_swipe_and_word_lengths)
+from word_generators_v2 import (GENERATOR_CTORS_DICT, BATCHED_GENERATOR_CTORS_DICT, 
+                                WordGenerator, EncoderMemory)
 from feature_extraction.feature_extractors import get_val_transform, weights_function_v1
-from logit_processors import VocabularyLogitProcessor
+from logit_processors import VocabularyLogitProcessor, VocabularyTrie
+from feature_cache import (get_feature_cache_key, get_file_hash, get_cached_features_dataset,
+                           save_feature_cache, CachedFeaturesDataset)
 
 
 RawPredictionType = List[List[Tuple[float, str]]]
@@ -87,11 +96,6 @@ class Prediction:
 
 
 
-def get_vocab(vocab_path: str) -> List[str]:
-    with open(vocab_path, 'r', encoding = "utf-8") as f:
-        return f.read().splitlines()
-
-
 def get_n_coord_feats(include_coords: bool,
                       inculde_time: bool,
                       include_velocities: bool,
@@ -100,6 +104,91 @@ def get_n_coord_feats(include_coords: bool,
     return 2 * (include_coords + include_velocities + include_accelerations) + inculde_time
 
 
+def get_inference_context(use_bf16_autocast: bool):
+    """
+    Returns a context manager for the model calls: bf16 autocast
+    on cpu if `use_bf16_autocast` else a no-op context.
+    """
+    if use_bf16_autocast:
+        return torch.autocast('cpu', dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+# Word generator and its call kwargs of a worker process. 
+# They are created once per process by `_init_worker`.
+_worker_word_generator: Optional[WordGenerator] = None
+_worker_generator_call_kwargs: Optional[dict] = None
+_worker_use_bf16_autocast: bool = False
+
+
+def _init_worker(model_architecture_name: str,
+                 model_weights_path: str,
+                 n_coord_feats: int,
+                 voc_path: str,
+                 word_generator_type: str,
+                 generator_call_kwargs: dict,
+                 trie_path: Optional[str],
+                 max_token_id: int,
+                 quantize: bool = False,
+                 use_bf16_autocast: bool = False) -> None:
+    """
+    Loads the model and the vocabulary trie once per worker process.
+    The trie file is memory-mapped, so all workers share its pages.
+    """
+    global _worker_word_generator, _worker_generator_call_kwargs, _worker_use_bf16_autocast
+    DEVICE = torch.device('cpu')
+    # Workers run in parallel, so intra-op parallelism 
+    # would only oversubscribe the cores.
+    torch.set_num_threads(1)
+
+    # The checkpoint is memory-mapped while its weights are copied.
+    model = load_model(model_architecture_name, model_weights_path, 
+                       n_coord_feats, DEVICE, quantize)
+    tokenizer = CharLevelTokenizerv2(voc_path)
+
+    logit_processor = None
+    if trie_path is not None:
+        logit_processor = VocabularyLogitProcessor(
+            tokenizer=tokenizer, vocab=None, max_token_id=max_token_id,
+            trie=VocabularyTrie.load(trie_path, mmap=True))
+
+    _worker_word_generator = GENERATOR_CTORS_DICT[word_generator_type](
+        model, tokenizer, DEVICE, logit_processor)
+    _worker_generator_call_kwargs = generator_call_kwargs
+    _worker_use_bf16_autocast = use_bf16_autocast
+
+
+def _predict_example_in_worker(data: Tuple[int, Tuple[Tensor, Tensor]]
+                               ) -> Tuple[int, List[Tuple[float, str]]]:
+    """
+    Same as Predictor._predict_example but uses 
+    the word generator created by `_init_worker`.
+    """
+    i, gen_in = data
+    with get_inference_context(_worker_use_bf16_autocast):
+        pred = _worker_word_generator(gen_in, **_worker_generator_call_kwargs)
+    return i, pred
+
+
+def get_length_bucketed_batches(lengths: List[int], batch_size: int
+                                ) -> List[List[int]]:
+    """
+    Splits dataset indices into batches of swipes with similar lengths
+    to minimize padding. Batches with the longest swipes go first
+    so that the memory peak happens at the start.
+    """
+    return LengthBucketedBatchSampler(lengths, batch_size, shuffle=False).batches
+
+
+def get_swipe_padding_ratio(dataset: Dataset, batch_size: int) -> float:
+    """
+    Returns the fraction of swipe padding in the batches
+    decoded by a predictor with the given batch_size.
+    """
+    lengths, _ = get_swipe_and_word_lengths(dataset)
+    return get_padding_ratio(lengths, get_length_bucketed_batches(lengths, batch_size))
+
+
 class Predictor:
     """
     Creates a prediction for a whole dataset.
@@ -119,14 +208,51 @@ class Predictor:
                  use_vocab_for_generation: bool,
                  n_classes: int,
                  generator_call_kwargs,
+                 voc_path: str,
+                 batch_size: Optional[int] = None,
+                 quantize: bool = False,
+                 use_bf16_autocast: bool = False,
+                 registry: Optional[ModelRegistry] = None,
                  ) -> None:
+        """
+        Arguments:
+        ----------
+        voc_path: str
+            Path to the vocabulary file. It's used by the tokenizer
+            and, if use_vocab_for_generation, by the logit processor.
+        batch_size: Optional[int]
+            If provided, swipes are decoded in length-bucketed batches
+            by a generator from BATCHED_GENERATOR_CTORS_DICT.
+            Otherwise swipes are decoded one by one.
+        quantize: bool
+            If True, linear layers of the model are dynamically 
+            quantized to int8 (see `model.quantize_dynamic_int8`).
+        use_bf16_autocast: bool
+            If True, the model is run under bf16 autocast.
+            Use `precision_parity.py` to check the accuracy 
+            of both options against fp32 before relying on them.
+        registry: Optional[ModelRegistry]
+            If provided, the model, the tokenizer and the logit processor
+            are taken from the registry, so predictors sharing 
+            a checkpoint or a vocabulary don't load them again.
+        """
         DEVICE = torch.device('cpu')
 
         self.word_generator_type = word_generator_type
-        word_generator_ctor = GENERATOR_CTORS_DICT[word_generator_type]
+        self.batch_size = batch_size
+        self.quantize = quantize
+        self.use_bf16_autocast = use_bf16_autocast
+        if batch_size is not None and word_generator_type not in BATCHED_GENERATOR_CTORS_DICT:
+            raise ValueError(
+                f"Generator '{word_generator_type}' can't decode batches. "
+                f"Use one of {list(BATCHED_GENERATOR_CTORS_DICT)} or don't set batch_size.")
+        generator_ctors_dict = GENERATOR_CTORS_DICT if batch_size is None \
+            else BATCHED_GENERATOR_CTORS_DICT
+        word_generator_ctor = generator_ctors_dict[word_generator_type]
         self.model_architecture_name = model_architecture_name
         self.model_weights_path = model_weights_path
-        model_getter = MODEL_GETTERS_DICT[model_architecture_name]
+        if registry is None:
+            registry = ModelRegistry()
 
         self.include_coords = include_coords
         self.include_time = include_time
@@ -141,18 +267,21 @@ class Predictor:
         )
 
         print(n_coord_feats)
+        self.n_coord_feats = n_coord_feats
+        self.n_classes = n_classes
+        self.voc_path = voc_path
 
-        model = model_getter(DEVICE, model_weights_path, n_coord_feats=n_coord_feats)
-        self.word_char_tokenizer = CharLevelTokenizerv2(config['voc_path'])
+        model = registry.get_model(model_architecture_name, model_weights_path,
+                                   n_coord_feats, DEVICE, quantize)
+        self.word_char_tokenizer = registry.get_tokenizer(voc_path)
 
         self.use_vocab_for_generation = use_vocab_for_generation
 
         logit_processor = None
         if use_vocab_for_generation:
-            logit_processor = VocabularyLogitProcessor(
-                tokenizer=self.word_char_tokenizer, 
-                vocab=get_vocab(config['voc_path']), 
-                max_token_id=n_classes - 1)
+            logit_processor = registry.get_logit_processor(
+                voc_path, max_token_id=n_classes - 1)
+        self.logit_processor = logit_processor
 
         self.word_generator = word_generator_ctor(
             model, self.word_char_tokenizer, DEVICE, 
@@ -186,11 +315,13 @@ class Predictor:
         """
 
         i, gen_in = data
-        pred = self.word_generator(gen_in, **self.generator_call_kwargs)
+        with get_inference_context(self.use_bf16_autocast):
+            pred = self.word_generator(gen_in, **self.generator_call_kwargs)
         return i, pred
     
     def _predict_raw_mp(self, dataset: CurveDataset,
-                        num_workers: int) -> List[List[Tuple[float, str]]]:
+                        num_workers: int,
+                        is_encoded: bool = False) -> List[List[Tuple[float, str]]]:
         """
         Creates predictions given a word generator
         
@@ -200,7 +331,11 @@ class Predictor:
             The dataset is supposed to be a subset of the original dataset
             containing only examples with the same grid_name as the predictor.
         num_workers: int
-            Number of processes.
+            Number of processes. Each process loads the model and
+            the vocabulary once (see `_init_worker`).
+        is_encoded: bool
+            If True, encoder_in of dataset elements is the output 
+            of model.encode (see `get_cached_encoder_outputs`).
 
         Returns:
         --------
@@ -211,8 +346,8 @@ class Predictor:
         """
         preds = [None] * len(dataset)
 
-        data = [(i, encoder_in)
-                for i, ((encoder_in, _), _) in enumerate(dataset)]     
+        data = ((i, EncoderMemory(encoder_in) if is_encoded else encoder_in)
+                for i, ((encoder_in, _), _) in enumerate(dataset))
         
         if num_workers <= 0:
 
@@ -220,15 +355,143 @@ class Predictor:
                 preds[i] = pred
             return preds
         
-        with ProcessPoolExecutor(num_workers) as executor:
-            for i, pred in tqdm(executor.map(self._predict_example, data), total=len(dataset)):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trie_path = None
+            if self.logit_processor is not None:
+                trie_path = os.path.join(tmp_dir, 'vocab_trie.npy')
+                self.logit_processor.trie.save(trie_path)
+
+            init_args = (
+                self.model_architecture_name, self.model_weights_path,
+                self.n_coord_feats, self.voc_path, self.word_generator_type,
+                self.generator_call_kwargs, trie_path, self.n_classes - 1,
+                self.quantize, self.use_bf16_autocast)
+            
+            with ProcessPoolExecutor(num_workers, initializer=_init_worker, 
+                                     initargs=init_args) as executor:
+                chunksize = max(1, len(dataset) // (num_workers * 16))
+                for i, pred in tqdm(executor.map(_predict_example_in_worker, data, chunksize=chunksize),
+                                    total=len(dataset)):
+                    preds[i] = pred
+
+        return preds
+
+    def _predict_raw_batched(self, dataset: CurveDataset,
+                             num_workers: int,
+                             is_encoded: bool = False) -> List[List[Tuple[float, str]]]:
+        """
+        Creates predictions decoding length-bucketed batches of swipes.
+        The output has the same format as the output of `_predict_raw_mp`.
+        
+        Arguments:
+        ----------
+        dataset: CurveDataset
+            The dataset is supposed to be a subset of the original dataset
+            containing only examples with the same grid_name as the predictor.
+        num_workers: int
+            Number of DataLoader workers. Each worker receives a pickled 
+            copy of the dataset, so 0 (loading in the main process) 
+            is usually the best choice.
+        is_encoded: bool
+            See `_predict_raw_mp`.
+        """
+        preds = [None] * len(dataset)
+
+        lengths, _ = get_swipe_and_word_lengths(dataset)
+        batches = get_length_bucketed_batches(lengths, self.batch_size)
+
+        collate_fn = CollateFnV2(
+            batch_first=False, 
+            word_pad_idx=self.word_char_tokenizer.char_to_idx['<pad>'])
+        dataloader = DataLoader(
+            dataset, batch_sampler=batches, collate_fn=collate_fn,
+            num_workers=max(num_workers, 0))
+
+        # DataLoader yields batches in the order of `batches`.
+        for batch_idxs, ((encoder_in, _, encoder_pad_mask, _), _) in tqdm(
+                zip(batches, dataloader), total=len(batches)):
+            if is_encoded:
+                encoder_in = EncoderMemory(encoder_in)
+            with get_inference_context(self.use_bf16_autocast):
+                batch_preds = self.word_generator.generate_batch(
+                    encoder_in, encoder_pad_mask, **self.generator_call_kwargs)
+            for i, pred in zip(batch_idxs, batch_preds):
                 preds[i] = pred
 
         return preds
 
+    def predict_raw(self, dataset: CurveDataset, num_workers: int,
+                    is_encoded: bool = False) -> List[List[Tuple[float, str]]]:
+        """
+        Creates predictions in the format of `_predict_raw_mp`.
+        Swipes are decoded in batches if the predictor has a batch_size
+        (see `_predict_raw_batched`) and one by one otherwise.
+        """
+        if self.batch_size is None:
+            return self._predict_raw_mp(dataset, num_workers, is_encoded)
+        return self._predict_raw_batched(dataset, num_workers, is_encoded)
+
+    @torch.inference_mode()
+    def encode_dataset(self, dataset: CurveDataset, 
+                       batch_size: int = 64) -> List[Tensor]:
+        """
+        Returns model.encode outputs of shape (curve_len, d_model)
+        for every swipe of the dataset. Swipes are encoded 
+        in length-bucketed batches, padding is stripped.
+        """
+        model = self.word_generator.model
+        encoded_swipes = [None] * len(dataset)
+
+        lengths, _ = get_swipe_and_word_lengths(dataset)
+        batches = get_length_bucketed_batches(lengths, batch_size)
+        collate_fn = CollateFnV2(
+            batch_first=False, 
+            word_pad_idx=self.word_char_tokenizer.char_to_idx['<pad>'])
+        dataloader = DataLoader(dataset, batch_sampler=batches, collate_fn=collate_fn)
+
+        for batch_idxs, ((encoder_in, _, encoder_pad_mask, _), _) in tqdm(
+                zip(batches, dataloader), total=len(batches)):
+            with get_inference_context(self.use_bf16_autocast):
+                encoded = model.encode(encoder_in, encoder_pad_mask)
+            # The output is stored in the dtype the encoder produced, so 
+            # the decoder sees the same memory as without the cache. 
+            # Under bf16 autocast it's still fp32: the final LayerNorm 
+            # of the encoder runs in fp32.
+            assert encoded.dtype in (torch.float32, torch.float16), \
+                f"Encoder outputs of dtype {encoded.dtype} can't be stored in a .npy file"
+            for j, i in enumerate(batch_idxs):
+                encoded_swipes[i] = encoded[:lengths[i], j].clone()
+        return encoded_swipes
+
+    def get_cached_encoder_outputs(self, dataset: CurveDataset, grid_name: str,
+                                   cache_root: str, key: str,
+                                   batch_size: int = 64) -> CachedFeaturesDataset:
+        """
+        Returns a dataset where i-th element is ((encoded_swipe, None), None):
+        encoded_swipe is the model.encode output for dataset[i].
+        The outputs are stored in `cache_root` as a memory-mapped feature cache 
+        entry `key`. They are computed only if the entry doesn't exist.
+        The key should identify the dataset, the weights and the inference mode.
+
+        Swipes are encoded in padded batches, so the stored outputs may 
+        differ from ones of unpadded swipes by float rounding. With the same 
+        batch_size as the predictor's one, `_predict_raw_batched` gets 
+        exactly the same memory as without the cache.
+        """
+        cache_dir = os.path.join(cache_root, key)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_root, exist_ok=True)
+            print("Encoding swipes...")
+            encoded_swipes = self.encode_dataset(dataset, batch_size)
+            save_feature_cache(
+                (((encoded, None), None) for encoded in encoded_swipes),
+                [grid_name] * len(encoded_swipes), cache_dir, total=len(encoded_swipes))
+        return CachedFeaturesDataset(cache_dir)
+
     def predict(self, dataset: CurveDataset, 
                 grid_name: str, dataset_split: str,
-                transform_name: str, num_workers: int) -> Prediction:
+                transform_name: str, num_workers: int,
+                encoder_outputs: Optional[Dataset] = None) -> Prediction:
         """
         Creates predictions given a word generator
         
@@ -240,8 +503,16 @@ class Predictor:
         dataset_split: str
         num_workers: int
             Number of processes.
+        encoder_outputs: Optional[Dataset]
+            Output of `get_cached_encoder_outputs` for the dataset. 
+            If provided, only the decoder is run.
         """
-        preds = self._predict_raw_mp(dataset, num_workers)
+        is_encoded = encoder_outputs is not None
+        if is_encoded:
+            assert len(encoder_outputs) == len(dataset)
+            dataset = encoder_outputs
+
+        preds = self.predict_raw(dataset, num_workers, is_encoded)
 
         preds_with_meta = Prediction(
             prediction=preds, 
@@ -296,30 +567,46 @@ def get_config(config_path: str) -> dict:
 
 
 def get_gridname_to_dataset(config) -> Dict[str, Dataset]:
-    char_tokenizer = CharLevelTokenizerv2(config['voc_path'])
-
-    transform = get_val_transform(
-        gridname_to_grid_path=config['grid_name_to_grid__path'],
-        grid_names=('default', 'extra'),
-        transform_name=config['transform_name'],
-        char_tokenizer=char_tokenizer,
-        uniform_noise_range=0,
-        include_time=config['include_time'],
-        include_velocities=config['include_velocities'],
-        include_accelerations=config['include_accelerations'],
-        ds_paths_list=[config['data_path']],
-        dist_weights_func=weights_function_v1,
-        totals = [10_000]
-    )
-
-    print("Creating dataset...")
-    dataset = CurveDataset(
-        data_path=config['data_path'],
-        store_gnames = True,
-        init_transform=transform,
-        get_item_transform=None,
-        total = 10_000,
-    )
+    def create_dataset() -> CurveDataset:
+        char_tokenizer = CharLevelTokenizerv2(config['voc_path'])
+
+        transform = get_val_transform(
+            gridname_to_grid_path=config['grid_name_to_grid__path'],
+            grid_names=('default', 'extra'),
+            transform_name=config['transform_name'],
+            char_tokenizer=char_tokenizer,
+            uniform_noise_range=0,
+            include_time=config['include_time'],
+            include_velocities=config['include_velocities'],
+            include_accelerations=config['include_accelerations'],
+            ds_paths_list=[config['data_path']],
+            dist_weights_func=weights_function_v1,
+            totals = [10_000],
+            out_of_bounds_cache_dir=config.get('out_of_bounds_cache_dir')
+        )
+
+        print("Creating dataset...")
+        return CurveDataset(
+            data_path=config['data_path'],
+            store_gnames = True,
+            init_transform=transform,
+            get_item_transform=None,
+            total = 10_000,
+        )
+
+    # If feature_cache_dir is set, features are extracted only once
+    # per (transform config, grids file, data file) combination.
+    feature_cache_dir = config.get('feature_cache_dir')
+    if feature_cache_dir is None:
+        dataset = create_dataset()
+    else:
+        key = get_feature_cache_key(
+            config['transform_name'], config['include_time'],
+            config['include_velocities'], config['include_accelerations'],
+            config['grid_name_to_grid__path'], config['data_path'],
+            extra={'uniform_noise_range': 0,
+                   'voc_file_hash': get_file_hash(config['voc_path'])})
+        dataset = get_cached_features_dataset(feature_cache_dir, key, create_dataset)
 
     gridname_to_dataset = {
         'default': CurveDatasetSubset(dataset, grid_name='default'),
@@ -337,8 +624,13 @@ def check_all_weights_exist(model_params: Iterable, models_root: str) -> None:
 
 def parse_args() -> argparse.Namespace:
     p = argparse.ArgumentParser()
-    p.add_argument('--num-workers', type=int, default=1)
+    p.add_argument('--num-workers', type=int, default=None,
+                   help='Number of processes (default: 1) or, with --batch-size, '
+                        'number of DataLoader workers (default: 0).')
     p.add_argument('--config', type=str)
+    p.add_argument('--batch-size', type=int, default=None,
+                   help='If set, swipes are decoded in batches of this size. '
+                        'Supported generators: greedy, beam_batched.')
     args = p.parse_args()
     return args 
 
@@ -347,6 +639,9 @@ def parse_args() -> argparse.Namespace:
 if __name__ == '__main__':
     args = parse_args()
     config = get_config(args.config)
+    num_workers = args.num_workers
+    if num_workers is None:
+        num_workers = 1 if args.batch_size is None else 0
 
     check_all_weights_exist(config['model_params'], config['models_root'])
 
@@ -354,10 +649,19 @@ if __name__ == '__main__':
 
     gridname_to_dataset = get_gridname_to_dataset(config)
 
+    # Models, the tokenizer and the vocabulary logit processor
+    # are shared by predictors of all checkpoints.
+    registry = ModelRegistry()
+
     for grid_name, model_getter_name, weights_f_name in config['model_params']:
 
-        out_path = os.path.join(config['out_path'],
-                                f"{weights_f_name.replace('/', '__')}.pkl")
+        quantize = config.get('quantize', False)
+        use_bf16_autocast = config.get('use_bf16_autocast', False)
+        # Low-precision predictions must not be mistaken for fp32 ones.
+        precision_suffix = '__int8' * quantize + '__bf16' * use_bf16_autocast
+        out_path = os.path.join(
+            config['out_path'],
+            f"{weights_f_name.replace('/', '__')}{precision_suffix}.pkl")
         
         if os.path.exists(out_path):
             print(f"Path {out_path} exists. Skipping.")
@@ -374,11 +678,43 @@ if __name__ == '__main__':
             use_vocab_for_generation = config['use_vocab_for_generation'],
             n_classes = config['n_classes'],
             generator_call_kwargs=config['generator_call_kwargs'],
+            voc_path=config['voc_path'],
+            batch_size=args.batch_size,
+            quantize=quantize,
+            use_bf16_autocast=use_bf16_autocast,
+            registry=registry,
         )
 
+        # If encoder_outputs_cache_dir is set, swipes are encoded only once
+        # per checkpoint, so runs with other decoding settings cost only decoding.
+        encoder_outputs = None
+        encoder_outputs_cache_dir = config.get('encoder_outputs_cache_dir')
+        if encoder_outputs_cache_dir is not None:
+            # Outputs are encoded in padded batches, so they depend on the batch size.
+            encode_batch_size = args.batch_size or 64
+            key = get_feature_cache_key(
+                config['transform_name'], config['include_time'],
+                config['include_velocities'], config['include_accelerations'],
+                config['grid_name_to_grid__path'], config['data_path'],
+                extra={'grid_name': grid_name,
+                       'model_architecture_name': model_getter_name,
+                       'weights_file_hash': get_file_hash(predictor.model_weights_path),
+                       'voc_file_hash': get_file_hash(config['voc_path']),
+                       'quantize': quantize, 'use_bf16_autocast': use_bf16_autocast,
+                       'batch_size': encode_batch_size})
+            encoder_outputs = predictor.get_cached_encoder_outputs(
+                gridname_to_dataset[grid_name], grid_name, 
+                encoder_outputs_cache_dir, key, batch_size=encode_batch_size)
+
+        if args.batch_size is not None:
+            padding_ratio = get_swipe_padding_ratio(
+                gridname_to_dataset[grid_name], args.batch_size)
+            print(f"Swipe padding ratio: {padding_ratio:.3f}")
+
         preds_and_meta = predictor.predict(
             gridname_to_dataset[grid_name],
             grid_name, config['data_split'], 
-            config['transform_name'], args.num_workers)
+            config['transform_name'], num_workers,
+            encoder_outputs=encoder_outputs)
 
         save_predictions(preds_and_meta, out_path, config["csv_path"])
@@ -0,0 +1,258 @@
+import sys; import os; sys.path.insert(1, os.path.join(os.getcwd(), "src"))
+
+
+import unittest
+import tempfile
+import json
+import pickle
+import random
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from torch.nn.utils.rnn import pad_sequence
+
+from dataset import (
+    CurveDataset, CurveDatasetColumnar, CurveDatasetSubset, CurveDatasetStreaming, CollateFnV2,
+    LengthBucketedBatchSampler, get_swipe_and_word_lengths, get_padding_ratio
+)
+from data_obtaining_and_preprocessing.convert_dataset_to_columnar import (
+    convert_dataset_to_columnar
+)
+
+
+def write_test_jsonl(path: str, n_swipes: int, with_words: bool, seed: int = 0) -> None:
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as f:
+        for _ in range(n_swipes):
+            n_points = rng.randint(2, 30)
+            line_data = {'curve': {
+                'x': [rng.randint(-100, 1200) for _ in range(n_points)],
+                'y': [rng.randint(-100, 700) for _ in range(n_points)],
+                't': sorted(rng.randint(0, 3000) for _ in range(n_points)),
+                'grid_name': rng.choice(['default', 'extra']),
+            }}
+            if with_words:
+                line_data['word'] = rng.choice(['привет', 'мир', 'ёж'])
+            f.write(json.dumps(line_data, ensure_ascii=False) + '\n')
+
+
+class TestCurveDatasetColumnar(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def _check_matches_curve_dataset(self, with_words: bool) -> None:
+        data_path = os.path.join(self.tmp_dir.name, 'data.jsonl')
+        out_dir = os.path.join(self.tmp_dir.name, 'columnar')
+        write_test_jsonl(data_path, 50, with_words)
+        n_swipes = convert_dataset_to_columnar(data_path, out_dir, flush_every=7)
+        self.assertEqual(n_swipes, 50)
+
+        expected_dataset = CurveDataset(data_path, store_gnames=True)
+        dataset = CurveDatasetColumnar(out_dir, store_gnames=True)
+        self.assertEqual(len(dataset), len(expected_dataset))
+        self.assertEqual(dataset.grid_name_list, expected_dataset.grid_name_list)
+        for i in range(len(dataset)):
+            X, Y, T, grid_name, tgt_word = dataset[i]
+            eX, eY, eT, e_grid_name, e_tgt_word = expected_dataset[i]
+            for arr, expected_arr in ((X, eX), (Y, eY), (T, eT)):
+                self.assertTrue(np.array_equal(arr, np.array(expected_arr)))
+            self.assertEqual((grid_name, tgt_word), (e_grid_name, e_tgt_word))
+
+        subset = CurveDatasetSubset(dataset, 'extra')
+        self.assertTrue(all(el[3] == 'extra' for el in (subset[i] for i in range(len(subset)))))
+
+    def test_matches_curve_dataset(self):
+        self._check_matches_curve_dataset(with_words=True)
+
+    def test_matches_curve_dataset_without_words(self):
+        self._check_matches_curve_dataset(with_words=False)
+
+    def test_pickling_does_not_copy_columns(self):
+        data_path = os.path.join(self.tmp_dir.name, 'data.jsonl')
+        out_dir = os.path.join(self.tmp_dir.name, 'columnar')
+        write_test_jsonl(data_path, 10, with_words=True)
+        convert_dataset_to_columnar(data_path, out_dir)
+        dataset = CurveDatasetColumnar(out_dir, store_gnames=False)
+        _ = dataset[0]
+        restored = pickle.loads(pickle.dumps(dataset))
+        self.assertIsNone(restored._columns)
+        self.assertTrue(np.array_equal(restored[3][0], dataset[3][0]))
+        self.assertEqual(restored[-1][4], dataset[9][4])
+
+
+def get_t_list(el) -> tuple:
+    return tuple(el[2])
+
+
+class TestCurveDatasetStreaming(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.data_path = os.path.join(self.tmp_dir.name, 'data.jsonl')
+        write_test_jsonl(self.data_path, 40, with_words=True)
+        self.expected = [get_t_list(el) for el in CurveDataset(self.data_path, store_gnames=False)]
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_same_order_without_shuffling(self):
+        dataset = CurveDatasetStreaming(self.data_path, init_transform=get_t_list)
+        self.assertEqual(list(dataset), self.expected)
+
+    def test_columnar_format(self):
+        out_dir = os.path.join(self.tmp_dir.name, 'columnar')
+        convert_dataset_to_columnar(self.data_path, out_dir)
+        dataset = CurveDatasetStreaming(out_dir, get_item_transform=get_t_list)
+        self.assertEqual(list(dataset), self.expected)
+
+    def test_ranks_and_workers_shard_dataset(self):
+        elements = []
+        for rank in range(2):
+            dataset = CurveDatasetStreaming(
+                self.data_path, init_transform=get_t_list, rank=rank, world_size=2)
+            loader = DataLoader(dataset, batch_size=None, num_workers=2)
+            elements.extend(tuple(el) for el in loader)
+        self.assertEqual(len(elements), len(self.expected))
+        self.assertEqual(sorted(elements), sorted(self.expected))
+
+    def test_shuffle_buffer(self):
+        dataset = CurveDatasetStreaming(
+            self.data_path, init_transform=get_t_list, shuffle_buffer_size=8, seed=1)
+        first_epoch = list(dataset)
+        dataset.set_epoch(1)
+        second_epoch = list(dataset)
+        self.assertEqual(sorted(first_epoch), sorted(self.expected))
+        self.assertNotEqual(first_epoch, self.expected)
+        self.assertNotEqual(first_epoch, second_epoch)
+        self.assertEqual(first_epoch, list(CurveDatasetStreaming(
+            self.data_path, init_transform=get_t_list, shuffle_buffer_size=8, seed=1)))
+
+
+class TestLengthBucketedBatchSampler(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = random.Random(0)
+        self.swipe_lengths = [rng.randint(2, 299) for _ in range(500)]
+        self.word_lengths = [rng.randint(1, 20) for _ in range(500)]
+
+    def _check_is_partition(self, batches) -> None:
+        self.assertEqual(sorted(i for batch in batches for i in batch),
+                         list(range(len(self.swipe_lengths))))
+
+    def test_shuffle_within_buckets(self):
+        sampler = LengthBucketedBatchSampler(
+            self.swipe_lengths, batch_size=16, word_lengths=self.word_lengths,
+            bucket_width=8, word_bucket_width=4)
+        batches = list(sampler)
+        self._check_is_partition(batches)
+        self.assertEqual(len(sampler), len(batches))
+        for batch in batches:
+            self.assertLessEqual(len(batch), 16)
+            self.assertEqual(len({self.swipe_lengths[i] // 8 for i in batch}), 1)
+            self.assertEqual(len({self.word_lengths[i] // 4 for i in batch}), 1)
+
+        self.assertEqual(batches, list(sampler))
+        sampler.set_epoch(1)
+        self.assertNotEqual(batches, list(sampler))
+
+        random_batches = [list(range(i, min(i + 16, 500))) for i in range(0, 500, 16)]
+        self.assertLess(sampler.get_padding_ratio(),
+                        get_padding_ratio(self.swipe_lengths, random_batches))
+
+    def test_token_budget(self):
+        max_tokens = 1000
+        sampler = LengthBucketedBatchSampler(
+            self.swipe_lengths, max_tokens=max_tokens, shuffle=False)
+        self._check_is_partition(sampler.batches)
+        for batch in sampler.batches:
+            max_len = max(self.swipe_lengths[i] for i in batch)
+            self.assertTrue(len(batch) * max_len <= max_tokens or len(batch) == 1)
+
+    def test_lengths_of_datasets(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            data_path = os.path.join(tmp_dir, 'data.jsonl')
+            columnar_dir = os.path.join(tmp_dir, 'columnar')
+            write_test_jsonl(data_path, 30, with_words=True)
+            convert_dataset_to_columnar(data_path, columnar_dir)
+
+            dataset = CurveDataset(data_path, store_gnames=True)
+            expected = ([len(el[0]) for el in dataset], [len(el[4]) for el in dataset])
+            self.assertEqual(get_swipe_and_word_lengths(dataset), expected)
+            self.assertEqual(get_swipe_and_word_lengths(
+                CurveDatasetColumnar(columnar_dir, store_gnames=False)), expected)
+
+            subset = CurveDatasetSubset(dataset, 'extra')
+            swipe_lens, word_lens = get_swipe_and_word_lengths(subset)
+            self.assertEqual(swipe_lens, [len(el[0]) for el in subset])
+            self.assertEqual(word_lens, [len(el[4]) for el in subset])
+
+            sampler = LengthBucketedBatchSampler.from_dataset(subset, batch_size=4)
+            loader = DataLoader(subset, batch_sampler=sampler, collate_fn=lambda batch: batch)
+            self.assertEqual(sum(len(batch) for batch in loader), len(subset))
+
+
+class TestCollateFnV2(unittest.TestCase):
+    WORD_PAD_IDX = 35
+
+    def _get_batch(self, encoder_in_is_tuple: bool, with_words: bool):
+        gen = torch.Generator().manual_seed(0)
+        batch = []
+        for _ in range(7):
+            swipe_len = int(torch.randint(1, 50, (1,), generator=gen))
+            traj_feats = torch.rand(swipe_len, 6, generator=gen)
+            kb_tokens = torch.randint(0, 30, (swipe_len,), generator=gen, dtype=torch.int32)
+            encoder_in = (traj_feats, kb_tokens) if encoder_in_is_tuple else traj_feats
+            decoder_in = decoder_out = None
+            if with_words:
+                word = torch.randint(0, self.WORD_PAD_IDX, 
+                                     (int(torch.randint(2, 10, (1,), generator=gen)),), 
+                                     generator=gen)
+                decoder_in, decoder_out = word[:-1], word[1:]
+            batch.append(((encoder_in, decoder_in), decoder_out))
+        return batch
+
+    def test_matches_pad_sequence(self):
+        for encoder_in_is_tuple in (True, False):
+            for with_words in (True, False):
+                for batch_first in (True, False):
+                    batch = self._get_batch(encoder_in_is_tuple, with_words)
+                    (encoder_in, dec_in, encoder_pad_mask, word_pad_mask), dec_out = \
+                        CollateFnV2(batch_first, self.WORD_PAD_IDX)(batch)
+                    
+                    encoder_ins = [encoder_in] if not encoder_in_is_tuple else encoder_in
+                    for i, part in enumerate(encoder_ins):
+                        seqs = [el[0][0][i] if encoder_in_is_tuple else el[0][0] for el in batch]
+                        expected = pad_sequence(seqs, batch_first=batch_first)
+                        self.assertEqual(part.dtype, expected.dtype)
+                        self.assertTrue(torch.equal(part, expected))
+                    
+                    lens = [len(seqs_el) for seqs_el in 
+                            (el[0][0][0] if encoder_in_is_tuple else el[0][0] for el in batch)]
+                    expected_mask = torch.tensor(
+                        [[j >= l for j in range(max(lens))] for l in lens])
+                    self.assertTrue(torch.equal(encoder_pad_mask, expected_mask))
+
+                    if not with_words:
+                        self.assertIsNone(dec_in)
+                        self.assertIsNone(dec_out)
+                        self.assertIsNone(word_pad_mask)
+                        continue
+                    expected_dec_in = pad_sequence([el[0][1] for el in batch], batch_first, 
+                                                   self.WORD_PAD_IDX)
+                    expected_dec_out = pad_sequence([el[1] for el in batch], batch_first, 
+                                                    self.WORD_PAD_IDX)
+                    self.assertTrue(torch.equal(dec_in, expected_dec_in))
+                    self.assertTrue(torch.equal(dec_out, expected_dec_out))
+                    expected_word_pad_mask = expected_dec_in == self.WORD_PAD_IDX
+                    if not batch_first:
+                        expected_word_pad_mask = expected_word_pad_mask.T
+                    self.assertTrue(torch.equal(word_pad_mask, expected_word_pad_mask))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,20 @@
 import sys; import os; sys.path.insert(1, os.path.join(os.getcwd(), "src"))
+sys.path.insert(1, os.path.join(os.getcwd(), "src", "unittests"))
 
 
 import unittest
+import tempfile
 
 import numpy as np
+import torch
 
-from feature_extraction.distances_lookup import distance
+from ns_tokenizers import KeyboardTokenizerv1
+from feature_extraction.distances_lookup import distance, DistancesLookup
+from feature_extraction.feature_extractors import (
+    DistancesGetter, KeyWeightsGetter, weights_function_v1, weights_function_v1_softmax,
+    get_avg_half_key_diag
+)
+from test_feature_extractors import get_test_grid, get_test_swipe_coords
 
 
 class TestDistance(unittest.TestCase):
@@ -48,5 +57,71 @@ class TestDistance(unittest.TestCase):
         self.assertTrue(np.allclose(result, expected))
 
 
+class TestDistancesLookup(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.grid = get_test_grid()
+        self.kb_key_list = KeyboardTokenizerv1.i2t + ['<extra_token>']
+        self.X, self.Y = get_test_swipe_coords(self.grid)
+    
+    def test_full_swipe_matches_per_point(self):
+        dl_lookup = DistancesLookup(self.grid, self.kb_key_list)
+        swipe_distances = dl_lookup.get_distances_for_full_swipe_using_map(self.X, self.Y)
+        self.assertEqual(swipe_distances.dtype, np.float32)
+        expected = dl_lookup.get_distances_for_full_swipe_without_map(self.X, self.Y)
+        self.assertTrue(np.array_equal(swipe_distances, expected.astype(np.float32)))
+        for i, (x, y) in enumerate(zip(self.X, self.Y)):
+            self.assertTrue(np.array_equal(swipe_distances[i], dl_lookup(x, y)))
+
+    def test_float16_table(self):
+        dl_lookup = DistancesLookup(self.grid, self.kb_key_list, dtype=np.float16)
+        self.assertEqual(dl_lookup.coord_to_distances.dtype, np.float16)
+        swipe_distances = dl_lookup.get_distances_for_full_swipe_using_map(self.X, self.Y)
+        expected = dl_lookup.get_distances_for_full_swipe_without_map(self.X, self.Y)
+        self.assertTrue(np.allclose(swipe_distances, expected, rtol=1e-3))
+
+    def test_getter_does_not_share_memory_with_table(self):
+        dl_lookup = DistancesLookup(self.grid, self.kb_key_list)
+        table_copy = dl_lookup.coord_to_distances.copy()
+        distances = DistancesGetter({'default': dl_lookup})(self.X, self.Y, None, 'default')
+        self.assertEqual(distances.dtype, torch.float32)
+        distances.fill_(0)
+        self.assertTrue(np.array_equal(dl_lookup.coord_to_distances, table_copy))
+
+
+class TestKeyWeightsLookup(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.grid = get_test_grid()
+        kb_key_list = KeyboardTokenizerv1.i2t + ['<extra_token>']
+        self.gname_to_dl = {'default': DistancesLookup(self.grid, kb_key_list)}
+        self.gname_to_hkd = {'default': get_avg_half_key_diag(self.grid)}
+        self.X, self.Y = get_test_swipe_coords(self.grid)
+
+    def test_table_matches_computed_weights(self):
+        for weights_function in (weights_function_v1, weights_function_v1_softmax):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                expected = KeyWeightsGetter(
+                    self.gname_to_dl, self.gname_to_hkd, weights_function
+                    )(self.X, self.Y, 'default')
+                getter = KeyWeightsGetter(
+                    self.gname_to_dl, self.gname_to_hkd, weights_function, 
+                    weights_tables_dir=tmp_dir)
+                weights = getter(self.X, self.Y, 'default')
+                self.assertEqual(weights.dtype, torch.float32)
+                self.assertTrue(torch.allclose(weights, expected, atol=1e-3))
+                self.assertEqual(len(os.listdir(tmp_dir)), 1)
+
+                # The second getter loads the persisted table.
+                loaded_getter = KeyWeightsGetter(
+                    self.gname_to_dl, self.gname_to_hkd, weights_function, 
+                    weights_tables_dir=tmp_dir)
+                lookup = loaded_getter.get_weights_lookup('default')
+                self.assertIsInstance(lookup.coord_to_weights, np.memmap)
+                self.assertEqual(lookup.coord_to_weights.dtype, np.float16)
+                self.assertTrue(torch.equal(loaded_getter(self.X, self.Y, 'default'), weights))
+                del lookup, loaded_getter
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,70 @@
+import sys; import os; sys.path.insert(1, os.path.join(os.getcwd(), "src"))
+sys.path.insert(1, os.path.join(os.getcwd(), "src", "unittests"))
+
+import unittest
+import tempfile
+
+import torch
+
+from model import MODEL_GETTERS_DICT
+from export_model import export_model, ExportedModel, check_parity, get_example_encoder_in
+from word_generators_v2 import BatchedBeamGenerator, GreedyGeneratorBatched
+from test_word_generators import get_test_vocab, get_test_tokenizer, pad_swipes
+
+
+V3_MODEL_NAMES_AND_N_COORD_FEATS = (
+    ('v3_nearest_only_transformer_bigger', 0),
+    ('v3_nearest_and_traj_transformer_bigger', 6),
+    ('v3_weighted_and_traj_transformer_bigger', 6),
+    ('v3_trainable_gaussian_weights_and_traj_transformer_bigger', 6),
+)
+
+
+class TestTorchScriptExport(unittest.TestCase):
+
+    def setUp(self) -> None:
+        torch.manual_seed(0)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.tokenizer = get_test_tokenizer(get_test_vocab())
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def _export(self, model_name: str, n_coord_feats: int):
+        model = MODEL_GETTERS_DICT[model_name]('cpu', n_coord_feats=n_coord_feats)
+        out_dir = os.path.join(self.tmp_dir.name, model_name)
+        export_model(model, model_name, n_coord_feats, out_dir)
+        return model, ExportedModel.load(out_dir)
+
+    def test_greedy_and_beam_parity(self):
+        for model_name, n_coord_feats in V3_MODEL_NAMES_AND_N_COORD_FEATS:
+            with self.subTest(model_name=model_name):
+                model, exported = self._export(model_name, n_coord_feats)
+                # Curve lengths differ from the ones used for tracing.
+                encoder_ins = [get_example_encoder_in(model_name, n_coord_feats, curve_len, None)
+                               for curve_len in (5, 23, 40)]
+                report = check_parity(model, exported, self.tokenizer, encoder_ins,
+                                      max_steps_n=8, beamsize=3)
+                self.assertEqual(report['greedy_equal_share'], 1.0)
+                self.assertEqual(report['beam_equal_share'], 1.0)
+                self.assertLess(report['beam_max_score_diff'], 1e-4)
+
+    def test_padded_batch_parity(self):
+        model_name = 'v3_nearest_only_transformer_bigger'
+        model, exported = self._export(model_name, 0)
+        swipes = [get_example_encoder_in(model_name, 0, curve_len, None)
+                  for curve_len in (7, 19, 12)]
+        encoder_in, pad_mask = pad_swipes(swipes)
+        for generator_ctor, call_kwargs in (
+                (GreedyGeneratorBatched, {'max_steps_n': 8}),
+                (BatchedBeamGenerator, {'max_steps_n': 8, 'beamsize': 3})):
+            expected, result = [
+                generator_ctor(m, self.tokenizer, 'cpu', use_kv_cache=True).generate_batch(
+                    encoder_in, pad_mask, **call_kwargs)
+                for m in (model, exported)]
+            self.assertEqual([[w for _, w in p] for p in expected],
+                             [[w for _, w in p] for p in result])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import sys; import os; sys.path.insert(1, os.path.join(os.getcwd(), "src"))
+
+import unittest
+import tempfile
+import pickle
+
+import torch
+
+from feature_cache import (get_feature_cache_key, save_feature_cache,
+                           CachedFeaturesDataset, get_cached_features_dataset)
+from dataset import CurveDatasetSubset, get_swipe_and_word_lengths, get_sample_lengths
+
+
+def get_test_samples(n_samples: int, encoder_in_is_tuple: bool, with_words: bool):
+    gen = torch.Generator().manual_seed(0)
+    samples = []
+    for i in range(n_samples):
+        swipe_len = 5 + i % 7
+        traj_feats = torch.rand(swipe_len, 6, generator=gen)
+        kb_tokens = torch.randint(0, 30, (swipe_len,), generator=gen, dtype=torch.int32)
+        encoder_in = (traj_feats, kb_tokens) if encoder_in_is_tuple else traj_feats
+        decoder_in = decoder_out = None
+        if with_words:
+            word_len = 2 + i % 4
+            decoder_in = torch.randint(0, 35, (word_len,), generator=gen)
+            decoder_out = torch.randint(0, 35, (word_len,), generator=gen)
+        samples.append(((encoder_in, decoder_in), decoder_out))
+    return samples
+
+
+class TestFeatureCache(unittest.TestCase):
+    def assertSamplesEqual(self, actual, expected):
+        (enc_a, dec_in_a), dec_out_a = actual
+        (enc_e, dec_in_e), dec_out_e = expected
+        if isinstance(enc_e, tuple):
+            self.assertIsInstance(enc_a, tuple)
+            for a, e in zip(enc_a, enc_e):
+                self.assertEqual(a.dtype, e.dtype)
+                self.assertTrue(torch.equal(a, e))
+        else:
+            self.assertTrue(torch.equal(enc_a, enc_e))
+        for a, e in ((dec_in_a, dec_in_e), (dec_out_a, dec_out_e)):
+            if e is None:
+                self.assertIsNone(a)
+            else:
+                self.assertTrue(torch.equal(a, e))
+
+    def test_roundtrip(self):
+        for encoder_in_is_tuple in (True, False):
+            for with_words in (True, False):
+                samples = get_test_samples(20, encoder_in_is_tuple, with_words)
+                grid_names = ['default' if i % 3 else 'extra' for i in range(20)]
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    cache_dir = os.path.join(tmp_dir, 'entry')
+                    save_feature_cache(samples, grid_names, cache_dir)
+                    dataset = CachedFeaturesDataset(cache_dir)
+                    self.assertEqual(len(dataset), 20)
+                    self.assertEqual(dataset.grid_name_list, grid_names)
+                    for i, sample in enumerate(samples):
+                        self.assertSamplesEqual(dataset[i], sample)
+
+                    # Lengths are read from the offsets.
+                    swipe_lens, word_lens = zip(*map(get_sample_lengths, samples))
+                    self.assertEqual(get_swipe_and_word_lengths(dataset), 
+                                     (list(swipe_lens), list(word_lens) if with_words else None))
+
+                    # Pickled copies reopen the memory-mapped files.
+                    dataset_copy = pickle.loads(pickle.dumps(dataset))
+                    self.assertSamplesEqual(dataset_copy[-1], samples[-1])
+
+                    subset = CurveDatasetSubset(dataset, grid_name='extra')
+                    self.assertSamplesEqual(subset[1], samples[3])
+
+    def test_get_cached_features_dataset_creates_dataset_once(self):
+        samples = get_test_samples(10, True, True)
+
+        class ListDataset(list):
+            grid_name_list = ['default'] * 10
+
+        n_calls = []
+        def create_dataset():
+            n_calls.append(1)
+            return ListDataset(samples)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for _ in range(2):
+                dataset = get_cached_features_dataset(tmp_dir, 'key', create_dataset)
+                self.assertSamplesEqual(dataset[4], samples[4])
+        self.assertEqual(len(n_calls), 1)
+
+    def test_key_depends_on_config_and_file_contents(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            grids_path = os.path.join(tmp_dir, 'grids.json')
+            data_path = os.path.join(tmp_dir, 'data.jsonl')
+            with open(grids_path, 'w') as f:
+                f.write('{}')
+            with open(data_path, 'w') as f:
+                f.write('{"a": 1}\n')
+
+            args = ('traj_feats_and_nearest_key', True, True, True, grids_path, data_path)
+            key = get_feature_cache_key(*args)
+            self.assertEqual(key, get_feature_cache_key(*args))
+            self.assertNotEqual(
+                key, get_feature_cache_key('traj_feats_and_xy', *args[1:]))
+            self.assertNotEqual(
+                key, get_feature_cache_key(args[0], False, *args[2:]))
+
+            with open(data_path, 'a') as f:
+                f.write('{"a": 2}\n')
+            self.assertNotEqual(key, get_feature_cache_key(*args))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,281 @@
+import sys; import os; sys.path.insert(1, os.path.join(os.getcwd(), "src"))
+sys.path.insert(1, os.path.join(os.getcwd(), "src", "unittests"))
+
+
+import unittest
+import tempfile
+import pickle
+import json
+import functools
+from array import array
+from unittest import mock
+
+import numpy as np
+import torch
+
+from ns_tokenizers import KeyboardTokenizerv1, ALL_CYRILLIC_LETTERS_ALPHABET_ORD
+from feature_extraction.nearest_key_lookup import ExtendedNearestKeyLookup
+from feature_extraction import feature_extractors
+from feature_extraction.distances_lookup import DistancesLookup
+from feature_extraction.feature_extractors import (
+    NearestKbTokensGetter, get_gridname_to_out_of_bounds_coords_dict, 
+    update_out_of_bounds_with_noise, get_extra_coords_dict,
+    KeyWeightsGetter, get_weights_table_path, weights_function_v1)
+from data_obtaining_and_preprocessing.convert_dataset_to_columnar import convert_dataset_to_columnar
+from test_dataset import write_test_jsonl
+
+
+KEY_W, KEY_H = 10, 20
+
+
+def get_test_grid(width: int = 130, height: int = 80) -> dict:
+    """
+    A small keyboard with all cyrillic letters 
+    in three rows and a '-' key.
+    """
+    labels = ALL_CYRILLIC_LETTERS_ALPHABET_ORD
+    rows = [labels[:12], labels[12:23], labels[23:] + ['-']]
+    keys = []
+    for row_idx, row in enumerate(rows):
+        x_offset = row_idx * KEY_W // 2
+        for col_idx, label in enumerate(row):
+            keys.append({'label': label, 'hitbox': {
+                'x': x_offset + col_idx * KEY_W, 'y': 10 + row_idx * KEY_H, 
+                'w': KEY_W, 'h': KEY_H}})
+    return {'width': width, 'height': height, 'keys': keys}
+
+
+def get_test_swipe_coords(grid: dict, n_points: int = 300, seed: int = 0):
+    """
+    Coordinates mostly within the keyboard and some out of bounds.
+    """
+    rng = np.random.default_rng(seed)
+    X = rng.integers(-15, grid['width'] + 15, n_points)
+    Y = rng.integers(-15, grid['height'] + 15, n_points)
+    return array('h', X.tolist()), array('h', Y.tolist())
+
+
+def get_out_of_bounds_coords(X, Y, grid: dict):
+    return {(x, y) for x, y in zip(X, Y) 
+            if not (0 <= x < grid['width'] and 0 <= y < grid['height'])}
+
+
+class TestNearestKbTokensGetter(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.grid = get_test_grid()
+        self.X, self.Y = get_test_swipe_coords(self.grid)
+        self.nkl = ExtendedNearestKeyLookup(
+            self.grid, ALL_CYRILLIC_LETTERS_ALPHABET_ORD,
+            get_out_of_bounds_coords(self.X, self.Y, self.grid))
+        self.kb_tokenizer = KeyboardTokenizerv1()
+
+    def test_matches_per_point_lookup(self):
+        getter = NearestKbTokensGetter(
+            {'default': self.nkl}, self.kb_tokenizer, return_tensor=True)
+        kb_tokens = getter(self.X, self.Y, 'default')
+        expected = torch.tensor(
+            [self.kb_tokenizer.get_token(self.nkl(x, y)) for x, y in zip(self.X, self.Y)],
+            dtype=torch.int32)
+        self.assertEqual(kb_tokens.dtype, torch.int32)
+        self.assertTrue(torch.equal(kb_tokens, expected))
+
+    def test_array_output(self):
+        getter = NearestKbTokensGetter(
+            {'default': self.nkl}, self.kb_tokenizer, return_tensor=False)
+        kb_tokens = getter(self.X, self.Y, 'default')
+        self.assertIsInstance(kb_tokens, array)
+        self.assertEqual(kb_tokens.tolist(), [self.kb_tokenizer.get_token(self.nkl(x, y)) 
+                                              for x, y in zip(self.X, self.Y)])
+
+    def test_without_input_to_int(self):
+        # Float coordinates are passed to the lookup as is.
+        lookup = mock.Mock(side_effect=lambda x, y: self.nkl(int(x), int(y)))
+        lookup.get_label_ids = mock.Mock()
+        getter = NearestKbTokensGetter(
+            {'default': lookup}, self.kb_tokenizer, return_tensor=True, input_to_int=False)
+        X, Y = [1.5, 25.7], [12.2, 30.9]
+        kb_tokens = getter(X, Y, 'default')
+        self.assertEqual([c.args for c in lookup.call_args_list], list(zip(X, Y)))
+        lookup.get_label_ids.assert_not_called()
+        self.assertEqual(kb_tokens.tolist(), [self.kb_tokenizer.get_token(self.nkl(int(x), int(y)))
+                                              for x, y in zip(X, Y)])
+
+    def test_token_grid(self):
+        getter = NearestKbTokensGetter(
+            {'default': self.nkl}, self.kb_tokenizer, return_tensor=True)
+        token_grid = getter.get_token_grid('default')
+        self.assertEqual(token_grid.shape, (self.grid['width'], self.grid['height']))
+        self.assertEqual(token_grid.dtype, np.uint8)
+        self.assertEqual(token_grid[0, 10], self.kb_tokenizer.get_token(ALL_CYRILLIC_LETTERS_ALPHABET_ORD[0]))
+
+
+class TestKeyWeightsTables(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.grid = get_test_grid()
+        self.X, self.Y = get_test_swipe_coords(self.grid)
+        self.dists_lookup = DistancesLookup(self.grid, ALL_CYRILLIC_LETTERS_ALPHABET_ORD)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def get_table_path(self, weights_function) -> str:
+        return get_weights_table_path(
+            self.tmp_dir.name, 'default', self.grid, ALL_CYRILLIC_LETTERS_ALPHABET_ORD,
+            5.0, weights_function, np.float16)
+
+    def test_table_path_depends_on_function_behavior(self):
+        paths = [self.get_table_path(f) for f in (
+            weights_function_v1,
+            functools.partial(weights_function_v1, bias=3),
+            lambda d: weights_function_v1(d, scale=1.5),
+            lambda d: weights_function_v1(d, scale=2))]
+        self.assertEqual(len(set(paths)), len(paths))
+        self.assertEqual(self.get_table_path(functools.partial(weights_function_v1, bias=4)),
+                         self.get_table_path(weights_function_v1))
+
+    def test_table_matches_computed_weights(self):
+        kwargs = dict(grid_name_to_dists_lookup={'default': self.dists_lookup},
+                      grid_name_to_half_key_diag={'default': 5.0},
+                      weights_function=weights_function_v1)
+        expected = KeyWeightsGetter(**kwargs)(self.X, self.Y, 'default')
+        for _ in range(2):
+            # The first call saves the table, the second one loads it.
+            getter = KeyWeightsGetter(**kwargs, weights_tables_dir=self.tmp_dir.name)
+            weights = getter(self.X, self.Y, 'default')
+            self.assertTrue(torch.allclose(weights, expected, atol=1e-3))
+        # No temporary files are left.
+        self.assertEqual(len(os.listdir(self.tmp_dir.name)), 1)
+
+
+class TestNearestKeyLookup(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.grid = get_test_grid()
+        self.X, self.Y = get_test_swipe_coords(self.grid)
+        out_of_bounds_coords = list(get_out_of_bounds_coords(self.X, self.Y, self.grid))
+        # Half of out-of-bounds coords are known in advance.
+        self.nkl = ExtendedNearestKeyLookup(
+            self.grid, ALL_CYRILLIC_LETTERS_ALPHABET_ORD, out_of_bounds_coords[::2])
+
+    def test_coord_to_label_id_is_compact(self):
+        self.assertEqual(self.nkl.coord_to_label_id.dtype, np.uint8)
+        self.assertEqual(self.nkl.coord_to_label_id.shape, 
+                         (self.grid['width'], self.grid['height']))
+
+    def test_matches_distances_to_centers(self):
+        for x, y in zip(self.X, self.Y):
+            if self.nkl._is_in_bounds(x, y) and any(
+                    k['hitbox']['x'] <= x < k['hitbox']['x'] + k['hitbox']['w'] and
+                    k['hitbox']['y'] <= y < k['hitbox']['y'] + k['hitbox']['h']
+                    for k in self.grid['keys']):
+                continue
+            letter_keys = [k for k in self.grid['keys'] if k['label'] in ALL_CYRILLIC_LETTERS_ALPHABET_ORD]
+            distances = [(x - (k['hitbox']['x'] + KEY_W / 2))**2 + (y - (k['hitbox']['y'] + KEY_H / 2))**2 
+                         for k in letter_keys]
+            expected = letter_keys[int(np.argmin(distances))]['label']
+            self.assertEqual(self.nkl(x, y), expected)
+
+    def test_get_label_ids_matches_get_nearest_kb_label(self):
+        label_ids = self.nkl.get_label_ids(self.X, self.Y)
+        labels = [self.nkl.labels[label_id] for label_id in label_ids]
+        self.assertEqual(labels, [self.nkl(x, y) for x, y in zip(self.X, self.Y)])
+
+    def test_save_and_load_mmap(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'nkl.pkl')
+            self.nkl.save_state(path)
+            loaded = ExtendedNearestKeyLookup.from_state_dict(path, mmap=True)
+            self.assertIsInstance(loaded.coord_to_label_id, np.memmap)
+            self.assertTrue(np.array_equal(loaded.get_label_ids(self.X, self.Y), 
+                                           self.nkl.get_label_ids(self.X, self.Y)))
+            del loaded
+
+    def test_load_legacy_state(self):
+        legacy_state = {
+            'nearest_key_candidates': ALL_CYRILLIC_LETTERS_ALPHABET_ORD,
+            'grid': self.grid,
+            'coord_to_kb_label': self.nkl.coord_to_kb_label,
+            'extended_coord_to_kb_label': self.nkl.extended_coord_to_kb_label,
+        }
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'nkl.pkl')
+            with open(path, 'wb') as f:
+                pickle.dump(legacy_state, f)
+            loaded = ExtendedNearestKeyLookup.from_state_dict(path)
+        self.assertEqual([loaded(x, y) for x, y in zip(self.X, self.Y)],
+                         [self.nkl(x, y) for x, y in zip(self.X, self.Y)])
+
+
+class TestOutOfBoundsCoords(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.data_path = os.path.join(self.tmp_dir.name, 'data.jsonl')
+        write_test_jsonl(self.data_path, 50, with_words=True)
+        self.gname_to_wh = {'default': (1080, 667), 'extra': (1080, 500)}
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def _get_expected_out_of_bounds(self):
+        expected = {gname: set() for gname in self.gname_to_wh}
+        with open(self.data_path, encoding='utf-8') as f:
+            for line in f:
+                curve = json.loads(line)['curve']
+                w, h = self.gname_to_wh[curve['grid_name']]
+                expected[curve['grid_name']].update(
+                    (x, y) for x, y in zip(curve['x'], curve['y'])
+                    if x < 0 or x >= w or y < 0 or y >= h)
+        return expected
+
+    def test_scan_jsonl_and_columnar(self):
+        columnar_dir = os.path.join(self.tmp_dir.name, 'columnar')
+        convert_dataset_to_columnar(self.data_path, columnar_dir)
+        expected = self._get_expected_out_of_bounds()
+        for data_path in (self.data_path, columnar_dir):
+            actual = get_gridname_to_out_of_bounds_coords_dict(
+                [data_path], self.gname_to_wh)
+            for gname in self.gname_to_wh:
+                self.assertEqual(set(map(tuple, actual[gname].tolist())), expected[gname])
+
+    def test_noise_halo(self):
+        noise_min, noise_max = -1, 2
+        w, h = 6, 4
+        coords = {(-1, 2), (7, 0), (3, 5)}
+        expected = set(coords)
+        for x, y in coords:
+            for i in range(noise_min, noise_max+1):
+                for j in range(noise_min, noise_max+1):
+                    if x+i < 0 or x+i >= w or y+j < 0 or y+j >= h:
+                        expected.add((x+i, y+j))
+        for x in range(noise_min, w+noise_max+1):
+            expected.update((x, y) for y in range(noise_min, 0))
+            expected.update((x, y) for y in range(h+1, h+noise_max+1))
+        for y in range(0, h+1):
+            expected.update((x, y) for x in range(w, w+noise_max+1))
+            expected.update((x, y) for x in range(noise_min, 0))
+
+        actual = update_out_of_bounds_with_noise(
+            noise_min, noise_max, {'g': np.array(list(coords))}, {'g': (w, h)})['g']
+        self.assertEqual(set(map(tuple, actual.tolist())), expected)
+        self.assertEqual(len(actual), len(expected))
+
+    def test_cache_skips_rescan(self):
+        cache_dir = os.path.join(self.tmp_dir.name, 'cache')
+        expected = get_extra_coords_dict(
+            [self.data_path], self.gname_to_wh, 1, cache_dir=cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+        with mock.patch.object(feature_extractors, 'get_gridname_to_out_of_bounds_coords_dict',
+                               side_effect=AssertionError("dataset was rescanned")):
+            actual = get_extra_coords_dict(
+                [self.data_path], self.gname_to_wh, 1, cache_dir=cache_dir)
+        for gname in self.gname_to_wh:
+            np.testing.assert_array_equal(actual[gname], expected[gname])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import sys; import os; sys.path.insert(1, os.path.join(os.getcwd(), "src"))
+sys.path.insert(1, os.path.join(os.getcwd(), "src", "unittests"))
+
+import unittest
+import tempfile
+import json
+import random
+
+from data_obtaining_and_preprocessing.filter_dataset import (
+    create_dataset_without_errors, get_line_errors, get_lines_errors, ERROR_TYPES)
+from data_obtaining_and_preprocessing.swipe_validity import get_key_centers_array
+from data_obtaining_and_preprocessing.chunking import get_byte_range_chunks
+from grid_processing_utils import get_label_to_key_map, get_kb_key_center
+from test_feature_extractors import get_test_grid
+
+
+def write_test_dataset(path: str, grid: dict, n_swipes: int, seed: int = 0) -> None:
+    """
+    Writes swipes going through the centers of the word keys. 
+    Some of them have non-monotonic time, points far from the keyboard
+    or a single point per key.
+    """
+    rng = random.Random(seed)
+    label2key = get_label_to_key_map(grid['keys'])
+    with open(path, 'w', encoding='utf-8') as f:
+        for _ in range(n_swipes):
+            word = ''.join(rng.choice('абвгдежзийкл') for _ in range(rng.randint(4, 6)))
+            n_points_per_key = 1 if rng.random() < 0.2 else 3
+            x, y = [], []
+            for char in word:
+                key_x, key_y = get_kb_key_center(label2key[char]['hitbox'])
+                x.extend([int(key_x)] * n_points_per_key)
+                y.extend([int(key_y)] * n_points_per_key)
+            t = list(range(0, 10 * len(x), 10))
+            if rng.random() < 0.2:
+                t[1] = t[0]
+            if rng.random() < 0.2:
+                x[-1] += 1000
+            line_data = {'word': word, 'curve': {'x': x, 'y': y, 't': t, 'grid_name': 'default'}}
+            f.write(json.dumps(line_data, ensure_ascii=False) + '\n')
+
+
+class TestFilterDataset(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.grids = {'default': get_test_grid()}
+        self.data_path = os.path.join(self.tmp_dir.name, 'data.jsonl')
+        write_test_dataset(self.data_path, self.grids['default'], 200)
+        self.max_dist = 30
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_byte_range_chunks(self):
+        with open(self.data_path, 'rb') as f:
+            content = f.read()
+        chunks = get_byte_range_chunks(self.data_path, 7)
+        self.assertEqual(chunks[0][0], 0)
+        self.assertEqual(chunks[-1][1], len(content))
+        for (_, end), (start, _) in zip(chunks[:-1], chunks[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(content[start - 1: start], b'\n')
+
+    def test_lines_errors_match_line_errors(self):
+        grids = {'default': self.grids['default'], 
+                 'shifted': get_test_grid(width=150, height=90)}
+        with open(self.data_path, encoding='utf-8') as f:
+            lines_data = [json.loads(line) for line in f]
+        for i, line_data in enumerate(lines_data):
+            if i % 3 == 0:
+                line_data['curve']['grid_name'] = 'shifted'
+        grid_name_to_key_centers = {grid_name: get_key_centers_array(grid['keys'])
+                                    for grid_name, grid in grids.items()}
+        self.assertEqual(
+            get_lines_errors(lines_data, self.max_dist, grids, grid_name_to_key_centers),
+            [get_line_errors(line_data, self.max_dist, grids) for line_data in lines_data])
+
+    def test_matches_line_by_line_filtering(self):
+        expected_lines = []
+        expected_logs = {error_type: [] for error_type in ERROR_TYPES}
+        with open(self.data_path, encoding='utf-8') as f:
+            for i, line in enumerate(f):
+                errors = get_line_errors(json.loads(line), self.max_dist, self.grids)
+                for error_type in errors:
+                    expected_logs[error_type].append(i)
+                if not errors:
+                    expected_lines.append(line)
+        self.assertTrue(all(expected_logs.values()))
+
+        for num_workers in (1, 3):
+            out_path = os.path.join(self.tmp_dir.name, f'out_{num_workers}.jsonl')
+            log_dir = os.path.join(self.tmp_dir.name, f'logs_{num_workers}')
+            error_logs = create_dataset_without_errors(
+                self.data_path, out_path, self.max_dist, self.grids,
+                num_workers=num_workers, log_dir=log_dir)
+            self.assertEqual(error_logs, expected_logs)
+            with open(out_path, encoding='utf-8') as f:
+                self.assertEqual(f.readlines(), expected_lines)
+            for error_type, idxs in expected_logs.items():
+                with open(os.path.join(log_dir, f"{error_type}.txt")) as f:
+                    self.assertEqual([int(line) for line in f], idxs)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import sys; import os; sys.path.insert(1, os.path.join(os.getcwd(), "src"))
+
+import unittest
+import random
+
+from data_analysis.get_segments import (
+    get_segments, get_segment_boundaries, get_segment_lengths)
+from grid_processing_utils import distance
+
+
+def get_segments_reference(key_centers, x_coords, y_coords):
+    """Point by point implementation of the SEGMENTS algorithm."""
+    points = list(zip(x_coords[2:-2], y_coords[2:-2]))
+    point_index = 0
+    segments = []
+    for current_key, next_key in zip(key_centers[:-1], key_centers[1:]):
+        if current_key == next_key:
+            continue
+        segment = []
+        previous_dist_to_current = float('inf')
+        while point_index < len(points):
+            dist_to_current = distance(*points[point_index], *current_key)
+            dist_to_next = distance(*points[point_index], *next_key)
+            if not (dist_to_current < previous_dist_to_current 
+                    or dist_to_current < dist_to_next):
+                break
+            segment.append(points[point_index])
+            previous_dist_to_current = dist_to_current
+            point_index += 1
+        segments.append(segment)
+    if not segments:
+        return [list(zip(x_coords, y_coords))]
+    segments[0] = list(zip(x_coords[:2], y_coords[:2])) + segments[0]
+    segments.append(points[point_index:] + list(zip(x_coords[-2:], y_coords[-2:])))
+    return segments
+
+
+class TestGetSegments(unittest.TestCase):
+
+    def test_straight_line(self):
+        key_centers = [(0, 0), (10, 0), (20, 0)]
+        x = list(range(-2, 23))
+        y = [0] * len(x)
+        self.assertEqual(get_segment_lengths(key_centers, x, y).tolist(), [7, 10, 8])
+        self.assertEqual(get_segment_boundaries(key_centers, x, y).tolist(), [0, 7, 17, 25])
+
+    def test_matches_reference(self):
+        rng = random.Random(0)
+        for _ in range(1000):
+            n_points = rng.randint(4, 60)
+            key_centers = [(rng.randint(0, 10) * 10 + 5, rng.randint(0, 3) * 20 + 10)
+                           for _ in range(rng.randint(0, 7))]
+            if key_centers and rng.random() < 0.3:
+                key_centers.insert(rng.randrange(len(key_centers)), key_centers[0])
+            x, y = [rng.randint(0, 110)], [rng.randint(0, 80)]
+            for _ in range(n_points - 1):
+                x.append(x[-1] + rng.randint(-6, 6))
+                y.append(y[-1] + rng.randint(-6, 6))
+            
+            expected = get_segments_reference(key_centers, x, y)
+            self.assertEqual(get_segments(key_centers, x, y), expected)
+            self.assertEqual(get_segment_lengths(key_centers, x, y).tolist(), 
+                             [len(segment) for segment in expected])
+
+    def test_too_few_points(self):
+        with self.assertRaises(ValueError):
+            get_segment_boundaries([(0, 0), (1, 1)], [0, 1, 2], [0, 1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import sys; import os; sys.path.insert(1, os.path.join(os.getcwd(), "src"))
+sys.path.insert(1, os.path.join(os.getcwd(), "src", "unittests"))
+
+
+import unittest
+import random
+import tempfile
+
+import torch
+
+from logit_processors import VocabularyLogitProcessor, VocabularyTrie
+from test_word_generators import get_test_vocab, get_test_tokenizer
+
+
+N_CLASSES = 35
+
+
+def get_allowed_ids_reference(tokenizer, vocab, prefix_ids):
+    allowed_ids = set()
+    for word in vocab:
+        tokenized_word = tokenizer.encode(word)
+        if tuple(tokenized_word[:len(prefix_ids)]) == tuple(prefix_ids) \
+                and len(tokenized_word) > len(prefix_ids):
+            allowed_ids.add(tokenized_word[len(prefix_ids)])
+    return allowed_ids
+
+
+class TestVocabularyLogitProcessor(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.vocab = get_test_vocab(n_words=100)
+        self.tokenizer = get_test_tokenizer(self.vocab)
+        self.processor = VocabularyLogitProcessor(
+            self.tokenizer, self.vocab, max_token_id=N_CLASSES - 1)
+        rng = random.Random(0)
+        self.prefixes = []
+        for word in rng.sample(self.vocab, 30):
+            tokenized_word = self.tokenizer.encode(word)
+            self.prefixes.append(tokenized_word[:rng.randint(1, len(tokenized_word) - 1)])
+        # prefixes that are not in the vocabulary
+        self.prefixes.append(self.tokenizer.encode('яяяя')[:-1])
+        self.prefixes.append(self.tokenizer.encode('а')[:-1] + [self.tokenizer.char_to_idx['<eos>']])
+
+    def test_process_matches_reference(self):
+        for prefix_ids in self.prefixes:
+            logits = self.processor.process(torch.zeros(N_CLASSES), prefix_ids)
+            allowed_ids = set(torch.nonzero(logits != float('-inf')).view(-1).tolist())
+            expected = get_allowed_ids_reference(self.tokenizer, self.vocab, prefix_ids)
+            self.assertEqual(allowed_ids, expected)
+
+    def test_process_batch_matches_process(self):
+        states = self.processor.get_initial_states(len(self.prefixes))
+        max_len = max(len(p) for p in self.prefixes)
+        eos = self.tokenizer.char_to_idx['<eos>']
+        for i in range(1, max_len):
+            next_tokens = torch.tensor([p[i] if i < len(p) else eos for p in self.prefixes])
+            is_active = torch.tensor([i < len(p) for p in self.prefixes])
+            states = torch.where(
+                is_active, self.processor.update_states(states, next_tokens), states)
+
+        logits = self.processor.process_batch(torch.zeros(len(self.prefixes), N_CLASSES), states)
+        for row_logits, prefix_ids in zip(logits, self.prefixes):
+            expected = self.processor.process(torch.zeros(N_CLASSES), prefix_ids)
+            self.assertTrue(torch.equal(row_logits, expected))
+
+    def test_trie_nodes_are_shared(self):
+        trie = VocabularyTrie([[0, 1, 2], [0, 1, 3], [0, 1, 2, 4]], n_tokens=5)
+        # dead, root, 1, 1->2, 1->3, 1->2->4
+        self.assertEqual(trie.n_nodes, 6)
+        self.assertEqual(trie.get_node([0, 1, 2]), trie.children[trie.get_node([0, 1]), 2])
+        self.assertEqual(trie.get_node([0, 4]), VocabularyTrie.DEAD_NODE)
+
+    def test_processor_from_loaded_trie(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trie_path = os.path.join(tmp_dir, 'trie.npy')
+            self.processor.trie.save(trie_path)
+            loaded_processor = VocabularyLogitProcessor(
+                self.tokenizer, None, max_token_id=N_CLASSES - 1,
+                trie=VocabularyTrie.load(trie_path, mmap=True))
+            for prefix_ids in self.prefixes:
+                expected = self.processor.process(torch.zeros(N_CLASSES), prefix_ids)
+                result = loaded_processor.process(torch.zeros(N_CLASSES), prefix_ids)
+                self.assertTrue(torch.equal(expected, result))
+            del loaded_processor
+
+
+if __name__ == '__main__':
+    unittest.main()
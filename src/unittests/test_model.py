@@ -0,0 +1,80 @@
+import sys; import os; sys.path.insert(1, os.path.join(os.getcwd(), "src"))
+sys.path.insert(1, os.path.join(os.getcwd(), "src", "unittests"))
+
+import unittest
+import tempfile
+
+import torch
+
+from model import _get_mask, get_transformer_bigger_nearest_only__v3, quantize_dynamic_int8
+from test_word_generators import get_test_model, get_test_swipes, pad_swipes
+
+
+class TestCausalMaskCache(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.model = get_test_model()
+
+    def test_mask_is_a_slice_of_the_buffer(self):
+        for seq_len in (1, 7, 35):
+            mask = self.model._get_mask(seq_len)
+            self.assertTrue(torch.equal(mask, _get_mask(seq_len)))
+            self.assertEqual(mask.data_ptr(), self.model.causal_mask.data_ptr())
+        self.assertTrue(torch.equal(self.model._get_mask(40), _get_mask(40)))
+
+    def test_mask_follows_model(self):
+        self.model.to(torch.float64)
+        self.assertEqual(self.model._get_mask(5).dtype, torch.float64)
+        self.assertEqual(self.model.device, self.model.out.weight.device)
+
+    @torch.inference_mode()
+    def test_decode_matches_fresh_mask(self):
+        encoder_in, pad_mask = pad_swipes(get_test_swipes(3))
+        encoded = self.model.encode(encoder_in, pad_mask)
+        dec_in = torch.randint(0, 35, (6, 3), dtype=torch.int32)
+        logits = self.model.decode(dec_in, encoded, pad_mask, None)
+        expected = self.model.out(self.model.decoder(
+            self.model.dec_in_emb_model(dec_in), encoded, tgt_mask=_get_mask(6),
+            memory_key_padding_mask=pad_mask))
+        self.assertTrue(torch.allclose(logits, expected))
+
+    def test_state_dict_is_unchanged(self):
+        self.assertNotIn('causal_mask', self.model.state_dict())
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            weights_path = os.path.join(tmp_dir, 'weights.pt')
+            torch.save(self.model.state_dict(), weights_path)
+            get_transformer_bigger_nearest_only__v3('cpu', weights_path)
+
+
+class TestDynamicQuantization(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.model = get_test_model()
+        self.quantized = quantize_dynamic_int8(self.model)
+
+    def test_linear_layers_are_quantized(self):
+        quantized_types = {type(m).__name__ for m in self.quantized.modules()}
+        self.assertIn('Linear', quantized_types)
+        self.assertFalse(any(type(m) is torch.nn.Linear for m in self.quantized.modules()))
+        # The original model is not modified.
+        self.assertIs(type(self.model.out), torch.nn.Linear)
+
+    @torch.inference_mode()
+    def test_logits_are_close_to_fp32(self):
+        encoder_in, pad_mask = pad_swipes(get_test_swipes(3))
+        dec_in = torch.randint(0, 35, (6, 3), dtype=torch.int32)
+        expected = self.model(encoder_in, dec_in, pad_mask, None)
+        result = self.quantized(encoder_in, dec_in, pad_mask, None)
+        self.assertTrue(torch.allclose(result, expected, atol=0.1))
+
+    def test_getter_quantizes_weights(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            weights_path = os.path.join(tmp_dir, 'weights.pt')
+            torch.save(self.model.state_dict(), weights_path)
+            model = get_transformer_bigger_nearest_only__v3(
+                'cpu', weights_path, quantize=True)
+        self.assertIsNot(type(model.out), torch.nn.Linear)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import sys; import os; sys.path.insert(1, os.path.join(os.getcwd(), "src"))
+sys.path.insert(1, os.path.join(os.getcwd(), "src", "unittests"))
+
+import unittest
+import tempfile
+
+import torch
+
+from model_registry import LRUCache, ModelRegistry, load_model
+from test_word_generators import get_test_vocab, get_test_model, get_test_swipes, pad_swipes
+
+
+MODEL_NAME = 'v3_nearest_only_transformer_bigger'
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_least_recently_used_is_evicted(self):
+        cache = LRUCache(2)
+        self.assertEqual(cache.get_or_create('a', lambda: 1), 1)
+        self.assertEqual(cache.get_or_create('b', lambda: 2), 2)
+        # 'a' becomes the most recently used.
+        self.assertEqual(cache.get_or_create('a', lambda: -1), 1)
+        cache.get_or_create('c', lambda: 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+
+
+class TestModelRegistry(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.model = get_test_model()
+        self.weights_path = os.path.join(self.tmp_dir.name, 'weights.pt')
+        torch.save(self.model.state_dict(), self.weights_path)
+        self.voc_path = os.path.join(self.tmp_dir.name, 'voc.txt')
+        with open(self.voc_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(get_test_vocab()))
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    @torch.inference_mode()
+    def test_mmap_loaded_model_matches_original(self):
+        model = load_model(MODEL_NAME, self.weights_path, 0)
+        self.assertFalse(model.training)
+        encoder_in, pad_mask = pad_swipes(get_test_swipes(3))
+        dec_in = torch.randint(0, 35, (5, 3))
+        self.assertTrue(torch.equal(model(encoder_in, dec_in, pad_mask, None),
+                                    self.model(encoder_in, dec_in, pad_mask, None)))
+
+    def test_instances_are_cached(self):
+        registry = ModelRegistry(max_models=1)
+        model = registry.get_model(MODEL_NAME, self.weights_path, 0)
+        self.assertIs(registry.get_model(MODEL_NAME, self.weights_path, 0), model)
+        self.assertIsNot(registry.get_model(MODEL_NAME, self.weights_path, 0, quantize=True), model)
+        self.assertEqual(len(registry.models), 1)
+
+        tokenizer = registry.get_tokenizer(self.voc_path)
+        logit_processor = registry.get_logit_processor(self.voc_path, max_token_id=34)
+        self.assertIs(registry.get_tokenizer(self.voc_path), tokenizer)
+        self.assertIs(registry.get_logit_processor(self.voc_path, max_token_id=34), logit_processor)
+        self.assertIs(logit_processor.tokenizer, tokenizer)
+
+    def test_overwritten_file_is_reloaded(self):
+        registry = ModelRegistry()
+        model = registry.get_model(MODEL_NAME, self.weights_path, 0)
+        old_bias = self.model.out.bias.detach().clone()
+        state_dict = self.model.state_dict()
+        state_dict['out.bias'] = state_dict['out.bias'] + 1
+        torch.save(state_dict, self.weights_path)
+        os.utime(self.weights_path, ns=(0, 0))
+        reloaded = registry.get_model(MODEL_NAME, self.weights_path, 0)
+        self.assertIsNot(reloaded, model)
+        self.assertTrue(torch.equal(reloaded.out.bias, state_dict['out.bias']))
+        # The model loaded earlier doesn't alias the rewritten file.
+        self.assertTrue(torch.equal(model.out.bias, old_bias))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+import sys; import os; sys.path.insert(1, os.path.join(os.getcwd(), "src"))
+sys.path.insert(1, os.path.join(os.getcwd(), "src", "unittests"))
+
+
+import unittest
+import tempfile
+
+import torch
+
+from predict_v2 import Predictor, get_length_bucketed_batches
+from precision_parity import get_precision_parity_report
+from word_generators_v2 import GENERATOR_CTORS_DICT, BATCHED_GENERATOR_CTORS_DICT
+from test_word_generators import (
+    get_test_vocab, get_test_tokenizer, get_test_model, get_test_swipes
+)
+
+
+def get_test_predictor(generator_ctors_dict, generator_type,
+                       generator_call_kwargs, batch_size = None) -> Predictor:
+    # Predictor.__init__ loads weights from disk, so 
+    # the attributes are set manually.
+    predictor = Predictor.__new__(Predictor)
+    predictor.word_char_tokenizer = get_test_tokenizer(get_test_vocab())
+    predictor.word_generator = generator_ctors_dict[generator_type](
+        get_test_model(), predictor.word_char_tokenizer, 'cpu')
+    predictor.generator_call_kwargs = generator_call_kwargs
+    predictor.batch_size = batch_size
+    predictor.use_bf16_autocast = False
+    return predictor
+
+
+class TestBatchedPrediction(unittest.TestCase):
+
+    def setUp(self) -> None:
+        # A dataset without target words (like the test set).
+        self.dataset = [((swipe, None), None) for swipe in get_test_swipes(11)]
+
+    def test_length_bucketed_batches(self):
+        lengths = [3, 7, 1, 7, 5]
+        batches = get_length_bucketed_batches(lengths, batch_size=2)
+        self.assertEqual(sorted(i for batch in batches for i in batch), list(range(5)))
+        self.assertEqual([[lengths[i] for i in batch] for batch in batches],
+                         [[7, 7], [5, 3], [1]])
+
+    def test_batched_greedy_matches_sequential(self):
+        call_kwargs = {'max_steps_n': 10}
+        sequential = get_test_predictor(GENERATOR_CTORS_DICT, 'greedy', call_kwargs)
+        batched = get_test_predictor(
+            BATCHED_GENERATOR_CTORS_DICT, 'greedy', call_kwargs, batch_size=4)
+        expected = sequential._predict_raw_mp(self.dataset, num_workers=0)
+        result = batched._predict_raw_batched(self.dataset, num_workers=0)
+        self.assertEqual(len(expected), len(result))
+        for expected_pred, pred in zip(expected, result):
+            self.assertEqual(expected_pred[0][1], pred[0][1])
+            self.assertAlmostEqual(expected_pred[0][0], pred[0][0], places=3)
+
+
+class TestEncoderOutputsReuse(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dataset = [((swipe, None), None) for swipe in get_test_swipes(9)]
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_stored_outputs_match_model_encode(self):
+        predictor = get_test_predictor(GENERATOR_CTORS_DICT, 'greedy', {})
+        encoder_outputs = predictor.get_cached_encoder_outputs(
+            self.dataset, 'default', self.tmp_dir.name, 'key', batch_size=4)
+        self.assertEqual(len(encoder_outputs), len(self.dataset))
+        self.assertEqual(encoder_outputs.grid_name_list, ['default'] * len(self.dataset))
+        model = predictor.word_generator.model
+        with torch.inference_mode():
+            for ((swipe, _), _), ((encoded, _), _) in zip(self.dataset, encoder_outputs):
+                expected = model.encode(swipe.unsqueeze(1), None).squeeze(1)
+                self.assertEqual(encoded.dtype, expected.dtype)
+                self.assertTrue(torch.allclose(encoded, expected, atol=1e-5))
+
+    def test_cached_and_uncached_predictions_match(self):
+        call_kwargs = {'max_steps_n': 10, 'beamsize': 3}
+        for sequential_type, batched_type, generator_call_kwargs in (
+                ('greedy', 'greedy', {'max_steps_n': 10}),
+                ('beam', 'beam_batched', call_kwargs)):
+            sequential = get_test_predictor(
+                GENERATOR_CTORS_DICT, sequential_type, generator_call_kwargs)
+            batched = get_test_predictor(
+                BATCHED_GENERATOR_CTORS_DICT, batched_type, generator_call_kwargs, batch_size=4)
+            encoder_outputs = sequential.get_cached_encoder_outputs(
+                self.dataset, 'default', self.tmp_dir.name, sequential_type, batch_size=4)
+            for predict_raw in (sequential._predict_raw_mp, batched._predict_raw_batched):
+                with self.subTest(generator=sequential_type, method=predict_raw.__name__):
+                    expected = predict_raw(self.dataset, num_workers=0)
+                    result = predict_raw(encoder_outputs, num_workers=0, is_encoded=True)
+                    self.assertEqual([[w for _, w in p] for p in expected],
+                                     [[w for _, w in p] for p in result])
+                    for expected_pred, pred in zip(expected, result):
+                        for (s1, _), (s2, _) in zip(expected_pred, pred):
+                            self.assertAlmostEqual(s1, s2, places=4)
+
+    def test_bf16_batched_predictions_are_exact(self):
+        call_kwargs = {'max_steps_n': 10, 'beamsize': 3}
+        predictor = get_test_predictor(
+            BATCHED_GENERATOR_CTORS_DICT, 'beam_batched', call_kwargs, batch_size=4)
+        predictor.use_bf16_autocast = True
+        encoder_outputs = predictor.get_cached_encoder_outputs(
+            self.dataset, 'default', self.tmp_dir.name, 'bf16', batch_size=4)
+        expected = predictor._predict_raw_batched(self.dataset, num_workers=0)
+        result = predictor._predict_raw_batched(encoder_outputs, num_workers=0, is_encoded=True)
+        self.assertEqual(expected, result)
+
+
+class TestWorkerPoolPrediction(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.voc_path = os.path.join(self.tmp_dir.name, 'voc.txt')
+        with open(self.voc_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(get_test_vocab()))
+        self.weights_path = os.path.join(self.tmp_dir.name, 'weights.pt')
+        torch.save(get_test_model().state_dict(), self.weights_path)
+        self.dataset = [((swipe, None), None) for swipe in get_test_swipes(8)]
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_workers_match_main_process(self):
+        predictor = Predictor(
+            'v3_nearest_only_transformer_bigger', self.weights_path,
+            include_coords=False, include_time=False,
+            include_velocities=False, include_accelerations=False,
+            word_generator_type='beam', use_vocab_for_generation=True,
+            n_classes=35, generator_call_kwargs={'max_steps_n': 10, 'beamsize': 3},
+            voc_path=self.voc_path)
+        expected = predictor._predict_raw_mp(self.dataset, num_workers=0)
+        result = predictor._predict_raw_mp(self.dataset, num_workers=2)
+        self.assertEqual([[w for _, w in p] for p in expected],
+                         [[w for _, w in p] for p in result])
+
+    def test_beam_with_batch_size_is_rejected(self):
+        # BatchedBeamGenerator isn't equivalent to BeamGenerator,
+        # so "beam" must not be silently replaced by it.
+        with self.assertRaises(ValueError):
+            Predictor(
+                'v3_nearest_only_transformer_bigger', self.weights_path,
+                include_coords=False, include_time=False,
+                include_velocities=False, include_accelerations=False,
+                word_generator_type='beam', use_vocab_for_generation=False,
+                n_classes=35, generator_call_kwargs={}, voc_path=self.voc_path,
+                batch_size=4)
+
+    def test_low_precision_modes(self):
+        predictors = [
+            Predictor(
+                'v3_nearest_only_transformer_bigger', self.weights_path,
+                include_coords=False, include_time=False,
+                include_velocities=False, include_accelerations=False,
+                word_generator_type='greedy', use_vocab_for_generation=False,
+                n_classes=35, generator_call_kwargs={'max_steps_n': 10},
+                voc_path=self.voc_path, quantize=quantize, use_bf16_autocast=use_bf16_autocast)
+            for quantize, use_bf16_autocast in ((False, False), (True, True))]
+        reference, low_precision = [
+            predictor.predict_raw(self.dataset, num_workers=0)
+            for predictor in predictors]
+        in_workers = predictors[1]._predict_raw_mp(self.dataset, num_workers=2)
+        self.assertEqual(low_precision, in_workers)
+
+        labels = [preds[0][1] for preds in reference]
+        report = get_precision_parity_report(reference, low_precision, labels)
+        self.assertEqual(report['n_swipes'], len(self.dataset))
+        self.assertEqual(report['fp32_accuracy'], 1.0)
+        self.assertAlmostEqual(report['accuracy_diff'], report['top1_agreement'] - 1)
+        self.assertEqual(get_precision_parity_report(reference, reference)['top1_agreement'], 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
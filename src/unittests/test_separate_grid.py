@@ -0,0 +1,90 @@
+import sys; import os; sys.path.insert(1, os.path.join(os.getcwd(), "src"))
+sys.path.insert(1, os.path.join(os.getcwd(), "src", "unittests"))
+
+import unittest
+from unittest import mock
+import tempfile
+import json
+import random
+
+from data_obtaining_and_preprocessing import separate_grid as separate_grid_module
+from data_obtaining_and_preprocessing.separate_grid import (
+    separate_grid, create_all_datasets_with_separated_grid)
+from test_feature_extractors import get_test_grid
+
+
+def get_test_grids() -> dict:
+    grids = {'default': get_test_grid(), 'extra': get_test_grid(width=140)}
+    for grid_name, grid in grids.items():
+        grid['grid_name'] = grid_name
+    return grids
+
+
+def write_original_format_dataset(path: str, grids: dict, n_swipes: int, seed: int = 0) -> None:
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as f:
+        for _ in range(n_swipes):
+            n_points = rng.randint(1, 20)
+            line_data = {
+                'word': rng.choice(['привет', 'мир', 'ёж']),
+                'curve': {
+                    'x': [rng.randint(-10, 150) for _ in range(n_points)],
+                    'y': [rng.randint(-10, 90) for _ in range(n_points)],
+                    't': list(range(n_points)),
+                    'grid': grids[rng.choice(list(grids))],
+                }
+            }
+            f.write(json.dumps(line_data, ensure_ascii=False) + '\n')
+
+
+def separate_grid_reference(data_path: str) -> str:
+    out_lines = []
+    with open(data_path, encoding='utf-8') as f:
+        for line in f:
+            line_data = json.loads(line)
+            line_data['curve']['grid_name'] = line_data['curve']['grid']['grid_name']
+            del line_data['curve']['grid']
+            out_lines.append(json.dumps(line_data, ensure_ascii=False, separators=(',', ':')) + '\n')
+    return ''.join(out_lines)
+
+
+class TestSeparateGrid(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.grids = get_test_grids()
+        self.data_path = os.path.join(self.tmp_dir.name, 'data.jsonl')
+        write_original_format_dataset(self.data_path, self.grids, 100)
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def _check_matches_reference(self, out_name: str, num_workers: int) -> None:
+        out_path = os.path.join(self.tmp_dir.name, out_name)
+        grid_name_to_grid = separate_grid(self.data_path, out_path, num_workers=num_workers)
+        with open(out_path, encoding='utf-8') as f:
+            self.assertEqual(f.read(), separate_grid_reference(self.data_path))
+        self.assertEqual(grid_name_to_grid, self.grids)
+
+    def test_matches_reference(self):
+        for num_workers in (1, 3):
+            self._check_matches_reference(f'out_{num_workers}.jsonl', num_workers)
+
+    def test_matches_reference_without_orjson(self):
+        with mock.patch.object(separate_grid_module, 'orjson', None):
+            self._check_matches_reference('out.jsonl', 1)
+
+    def test_grids_with_the_same_name(self):
+        other_path = os.path.join(self.tmp_dir.name, 'other.jsonl')
+        other_grids = {'default': get_test_grid(width=100)}
+        other_grids['default']['grid_name'] = 'default'
+        write_original_format_dataset(other_path, other_grids, 10)
+        with self.assertRaises(ValueError):
+            create_all_datasets_with_separated_grid(
+                [self.data_path, other_path],
+                [os.path.join(self.tmp_dir.name, name) for name in ('out1', 'out2')],
+                [None, None])
+
+
+if __name__ == '__main__':
+    unittest.main()
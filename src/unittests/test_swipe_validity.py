@@ -0,0 +1,71 @@
+import sys; import os; sys.path.insert(1, os.path.join(os.getcwd(), "src"))
+sys.path.insert(1, os.path.join(os.getcwd(), "src", "unittests"))
+
+import unittest
+import random
+
+import numpy as np
+
+from data_obtaining_and_preprocessing.swipe_validity import (
+    monotoniacally_increases, points_not_too_far, 
+    get_key_centers_array, get_swipes_error_masks)
+from grid_processing_utils import get_kb_key_center, distance
+from test_feature_extractors import get_test_grid
+
+
+def monotoniacally_increases_reference(time) -> bool:
+    return all(t > prev_t for prev_t, t in zip(time, time[1:]))
+
+
+def points_not_too_far_reference(x_list, y_list, kb_keys, max_dist) -> bool:
+    return all(
+        any(distance(x, y, *get_kb_key_center(key['hitbox'])) < max_dist for key in kb_keys)
+        for x, y in zip(x_list, y_list))
+
+
+class TestSwipeValidity(unittest.TestCase):
+
+    def setUp(self) -> None:
+        rng = random.Random(0)
+        self.grid = get_test_grid()
+        self.max_dist = 15
+        self.swipes = []
+        for _ in range(200):
+            n_points = rng.randint(0, 20)
+            x = [rng.randint(-20, 150) for _ in range(n_points)]
+            y = [rng.randint(-20, 100) for _ in range(n_points)]
+            t = sorted(rng.sample(range(1000), n_points))
+            if n_points > 1 and rng.random() < 0.3:
+                t[rng.randrange(1, n_points)] = t[0]
+            self.swipes.append((x, y, t))
+        self.swipes.append(([], [], []))
+
+    def test_matches_reference(self):
+        key_centers = get_key_centers_array(self.grid['keys'])
+        for x, y, t in self.swipes:
+            self.assertEqual(monotoniacally_increases(t), 
+                             monotoniacally_increases_reference(t))
+            expected = points_not_too_far_reference(x, y, self.grid['keys'], self.max_dist)
+            self.assertEqual(points_not_too_far(x, y, self.grid['keys'], self.max_dist), expected)
+            self.assertEqual(points_not_too_far(x, y, self.grid['keys'], self.max_dist, 
+                                                key_centers), expected)
+
+    def test_packed_swipes(self):
+        lens = [len(x) for x, _, _ in self.swipes]
+        offsets = np.concatenate([[0], np.cumsum(lens)])
+        X, Y, T = (np.concatenate([np.array(swipe[i], dtype=np.int64) for swipe in self.swipes])
+                   for i in range(3))
+        error_masks = get_swipes_error_masks(
+            X, Y, T, offsets, get_key_centers_array(self.grid['keys']), self.max_dist)
+        
+        expected_non_monotonic = [not monotoniacally_increases_reference(t) 
+                                  for _, _, t in self.swipes]
+        expected_too_far = [not points_not_too_far_reference(x, y, self.grid['keys'], self.max_dist)
+                            for x, y, _ in self.swipes]
+        self.assertEqual(error_masks['non_monotonic_timestamps'].tolist(), expected_non_monotonic)
+        self.assertEqual(error_masks['points_too_far'].tolist(), expected_too_far)
+        self.assertTrue(any(expected_non_monotonic) and any(expected_too_far))
+
+
+if __name__ == '__main__':
+    unittest.main()
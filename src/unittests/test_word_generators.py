@@ -0,0 +1,237 @@
+import sys; import os; sys.path.insert(1, os.path.join(os.getcwd(), "src"))
+
+
+import unittest
+import tempfile
+import random
+
+import torch
+
+from model import get_transformer_bigger_nearest_only__v3
+from ns_tokenizers import CharLevelTokenizerv2, ALL_CYRILLIC_LETTERS_ALPHABET_ORD
+from logit_processors import VocabularyLogitProcessor
+from word_generators_v2 import (
+    GreedyGenerator, BeamGenerator, BatchedBeamGenerator, GreedyGeneratorBatched,
+    EncoderMemory
+)
+
+
+N_KB_TOKENS = 36
+
+
+def get_test_vocab(n_words: int = 300, seed: int = 0):
+    rng = random.Random(seed)
+    vocab = list(ALL_CYRILLIC_LETTERS_ALPHABET_ORD)
+    for _ in range(n_words):
+        word_len = rng.randint(2, 8)
+        vocab.append(''.join(rng.choices(ALL_CYRILLIC_LETTERS_ALPHABET_ORD[:8], k=word_len)))
+    return vocab
+
+
+def get_test_tokenizer(vocab):
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', suffix='.txt', delete=False) as f:
+        f.write('\n'.join(vocab))
+    tokenizer = CharLevelTokenizerv2(f.name)
+    os.remove(f.name)
+    return tokenizer
+
+
+def get_test_model():
+    torch.manual_seed(0)
+    return get_transformer_bigger_nearest_only__v3('cpu')
+
+
+def get_test_swipes(n_swipes: int, seed: int = 0):
+    generator = torch.Generator().manual_seed(seed)
+    lengths = torch.randint(10, 40, (n_swipes,), generator=generator)
+    return [torch.randint(0, N_KB_TOKENS, (int(l),), generator=generator, dtype=torch.int32)
+            for l in lengths]
+
+
+def pad_swipes(swipes):
+    encoder_in = torch.nn.utils.rnn.pad_sequence(swipes, batch_first=False)
+    lengths = torch.tensor([len(s) for s in swipes])
+    pad_mask = torch.arange(encoder_in.size(0)).unsqueeze(0) >= lengths.unsqueeze(1)
+    return encoder_in, pad_mask
+
+
+class TestIncrementalDecoding(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.vocab = get_test_vocab()
+        self.tokenizer = get_test_tokenizer(self.vocab)
+        self.model = get_test_model()
+        self.swipes = get_test_swipes(4)
+
+    @torch.inference_mode()
+    def test_decode_incremental_matches_decode(self):
+        encoder_in, pad_mask = pad_swipes(self.swipes)
+        encoded = self.model.encode(encoder_in, pad_mask)
+        batch_size = len(self.swipes)
+        dec_in = torch.randint(0, 35, (8, batch_size), dtype=torch.int32)
+        full_logits = self.model.decode(dec_in, encoded, pad_mask, None)
+        cache = self.model.init_decoder_cache(encoded, pad_mask)
+        for i in range(len(dec_in)):
+            logits, cache = self.model.decode_incremental(dec_in[:i+1], cache)
+            self.assertTrue(torch.allclose(logits, full_logits[i], atol=1e-4))
+
+    @torch.inference_mode()
+    def test_reorder_with_rows_per_memory(self):
+        encoder_in, pad_mask = pad_swipes(self.swipes)
+        encoded = self.model.encode(encoder_in, pad_mask)
+        rows_per_memory = 3
+        n_rows = len(self.swipes) * rows_per_memory
+        dec_in = torch.randint(0, 35, (5, n_rows), dtype=torch.int32)
+        cache = self.model.init_decoder_cache(encoded, pad_mask, rows_per_memory)
+        for i in range(len(dec_in) - 1):
+            _, cache = self.model.decode_incremental(dec_in[:i+1], cache)
+        # Swap the first two rows of every swipe.
+        order = torch.arange(n_rows).view(-1, rows_per_memory)
+        order[:, [0, 1]] = order[:, [1, 0]]
+        order = order.view(-1)
+        logits, _ = self.model.decode_incremental(dec_in[:, order], cache.reorder(order))
+        full_logits = self.model.decode(
+            dec_in[:, order], encoded.repeat_interleave(rows_per_memory, dim=1),
+            pad_mask.repeat_interleave(rows_per_memory, dim=0), None)[-1]
+        self.assertTrue(torch.allclose(logits, full_logits, atol=1e-4))
+
+    def test_generators_with_and_without_cache_match(self):
+        for generator_ctor in (GreedyGenerator, BeamGenerator, BatchedBeamGenerator):
+            with_cache = generator_ctor(self.model, self.tokenizer, 'cpu', use_kv_cache=True)
+            without_cache = generator_ctor(self.model, self.tokenizer, 'cpu', use_kv_cache=False)
+            for swipe in self.swipes:
+                expected = without_cache(swipe, max_steps_n=10)
+                result = with_cache(swipe, max_steps_n=10)
+                self.assertEqual([w for _, w in expected], [w for _, w in result])
+
+    def test_greedy_batched_with_and_without_cache_match(self):
+        encoder_in, pad_mask = pad_swipes(self.swipes)
+        with_cache = GreedyGeneratorBatched(self.model, self.tokenizer, 'cpu', use_kv_cache=True)
+        without_cache = GreedyGeneratorBatched(self.model, self.tokenizer, 'cpu', use_kv_cache=False)
+        expected_tokens, expected_log_probs = without_cache(encoder_in, pad_mask, max_steps_n=10)
+        tokens, log_probs = with_cache(encoder_in, pad_mask, max_steps_n=10)
+        self.assertTrue(torch.equal(expected_tokens, tokens))
+        self.assertTrue(torch.allclose(expected_log_probs, log_probs, atol=1e-4))
+
+
+class TestGreedyGeneratorBatched(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.vocab = get_test_vocab()
+        self.tokenizer = get_test_tokenizer(self.vocab)
+        self.model = get_test_model()
+        self.swipes = get_test_swipes(6)
+        self.logit_processor = VocabularyLogitProcessor(
+            self.tokenizer, self.vocab, max_token_id=34)
+
+    def test_vocab_masking_matches_greedy_generator(self):
+        greedy_generator = GreedyGenerator(
+            self.model, self.tokenizer, 'cpu', self.logit_processor)
+        batched_generator = GreedyGeneratorBatched(
+            self.model, self.tokenizer, 'cpu', self.logit_processor)
+        encoder_in, pad_mask = pad_swipes(self.swipes)
+        tokens, log_probs = batched_generator(encoder_in, pad_mask, max_steps_n=10)
+        eos, pad = self.tokenizer.char_to_idx['<eos>'], self.tokenizer.char_to_idx['<pad>']
+        for i, swipe in enumerate(self.swipes):
+            expected_score, expected_word = greedy_generator(swipe, max_steps_n=10)[0]
+            word_tokens = [t for t in tokens[1:, i].tolist() if t not in (eos, pad)]
+            self.assertEqual(self.tokenizer.decode(word_tokens), expected_word)
+            self.assertIn(expected_word, self.vocab)
+            self.assertAlmostEqual(-float(log_probs[i]), expected_score, places=3)
+
+
+class TestBatchedBeamGenerator(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.vocab = get_test_vocab()
+        self.tokenizer = get_test_tokenizer(self.vocab)
+        self.model = get_test_model()
+        self.swipes = get_test_swipes(5)
+
+    def test_beamsize_one_matches_beam_generator(self):
+        beam_generator = BeamGenerator(self.model, self.tokenizer, 'cpu')
+        batched_generator = BatchedBeamGenerator(self.model, self.tokenizer, 'cpu')
+        for swipe in self.swipes:
+            expected = beam_generator(swipe, max_steps_n=10, beamsize=1)
+            result = batched_generator(swipe, max_steps_n=10, beamsize=1)
+            self.assertEqual([w for _, w in expected], [w for _, w in result])
+            self.assertAlmostEqual(expected[0][0], result[0][0], places=4)
+
+    def test_batch_matches_single_swipe(self):
+        generator = BatchedBeamGenerator(self.model, self.tokenizer, 'cpu')
+        encoder_in, pad_mask = pad_swipes(self.swipes)
+        batch_results = generator.generate_batch(
+            encoder_in, pad_mask, max_steps_n=10, return_hypotheses_n=4)
+        for swipe, batch_result in zip(self.swipes, batch_results):
+            single_result = generator(swipe, max_steps_n=10, return_hypotheses_n=4)
+            self.assertEqual([w for _, w in single_result], [w for _, w in batch_result])
+            for (s1, _), (s2, _) in zip(single_result, batch_result):
+                self.assertAlmostEqual(s1, s2, places=4)
+
+    def test_vocab_masking(self):
+        logit_processor = VocabularyLogitProcessor(self.tokenizer, self.vocab, max_token_id=34)
+        beam_generator = BeamGenerator(self.model, self.tokenizer, 'cpu', logit_processor)
+        generator = BatchedBeamGenerator(self.model, self.tokenizer, 'cpu', logit_processor)
+        encoder_in, pad_mask = pad_swipes(self.swipes)
+        batch_results = generator.generate_batch(encoder_in, pad_mask, max_steps_n=10)
+        vocab_set = set(self.vocab)
+        for swipe, batch_result in zip(self.swipes, batch_results):
+            self.assertTrue(all(word in vocab_set for _, word in batch_result))
+            expected = beam_generator(swipe, max_steps_n=10, beamsize=1)
+            result = generator(swipe, max_steps_n=10, beamsize=1)
+            self.assertEqual(expected[0][1], result[0][1])
+
+    def test_batch_with_and_without_cache_match(self):
+        logit_processor = VocabularyLogitProcessor(self.tokenizer, self.vocab, max_token_id=34)
+        encoder_in, pad_mask = pad_swipes(self.swipes)
+        for processor in (None, logit_processor):
+            with_cache, without_cache = (
+                BatchedBeamGenerator(self.model, self.tokenizer, 'cpu', processor, 
+                                     use_kv_cache=use_kv_cache)
+                for use_kv_cache in (True, False))
+            expected = without_cache.generate_batch(encoder_in, pad_mask, max_steps_n=10)
+            result = with_cache.generate_batch(encoder_in, pad_mask, max_steps_n=10)
+            for expected_swipe_result, swipe_result in zip(expected, result):
+                self.assertEqual([w for _, w in expected_swipe_result], 
+                                 [w for _, w in swipe_result])
+                for (s1, _), (s2, _) in zip(expected_swipe_result, swipe_result):
+                    self.assertAlmostEqual(s1, s2, places=4)
+
+    def test_scores_are_sorted(self):
+        generator = BatchedBeamGenerator(self.model, self.tokenizer, 'cpu')
+        result = generator(self.swipes[0], max_steps_n=10)
+        scores = [score for score, _ in result]
+        self.assertEqual(scores, sorted(scores))
+        self.assertGreater(len(result), 0)
+
+
+class TestEncoderMemoryInput(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tokenizer = get_test_tokenizer(get_test_vocab())
+        self.model = get_test_model()
+        self.swipes = get_test_swipes(4)
+
+    @torch.inference_mode()
+    def test_single_swipe_generators(self):
+        for generator_ctor in (GreedyGenerator, BeamGenerator, BatchedBeamGenerator):
+            generator = generator_ctor(self.model, self.tokenizer, 'cpu')
+            for swipe in self.swipes:
+                memory = self.model.encode(swipe.unsqueeze(1), None).squeeze(1)
+                expected = generator(swipe, max_steps_n=10)
+                result = generator(EncoderMemory(memory), max_steps_n=10)
+                self.assertEqual(expected, result)
+
+    @torch.inference_mode()
+    def test_batched_generators(self):
+        encoder_in, pad_mask = pad_swipes(self.swipes)
+        memory = EncoderMemory(self.model.encode(encoder_in, pad_mask))
+        for generator_ctor in (GreedyGeneratorBatched, BatchedBeamGenerator):
+            generator = generator_ctor(self.model, self.tokenizer, 'cpu')
+            expected = generator.generate_batch(encoder_in, pad_mask, max_steps_n=10)
+            result = generator.generate_batch(memory, pad_mask, max_steps_n=10)
+            self.assertEqual(expected, result)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 from typing import List, Tuple, Optional, Union
 from abc import ABC, abstractmethod
+from dataclasses import dataclass
 import heapq
 
 import torch
@@ -7,13 +8,29 @@ import torch.nn.functional as F
 from torch import Tensor
 
 from ns_tokenizers import CharLevelTokenizerv2
-from model import EncoderDecoderTransformerLike
-from logit_processors import LogitProcessor
+from model import EncoderDecoderTransformerLike, DecoderCache
+from logit_processors import LogitProcessor, StatefulLogitProcessor
 
 
-def _prepare_encoder_input(encoder_in: Union[Tensor, Tuple[Tensor, Tensor]], 
+@dataclass
+class EncoderMemory:
+    """
+    A precomputed output of model.encode() that can be passed to 
+    word generators instead of encoder_in: encoding is skipped.
+
+    memory: Tensor
+        Shape (curve_len, d_model) for a single swipe or 
+        (curve_len, batch_size, d_model) for a batch.
+    """
+    memory: Tensor
+
+
+def _prepare_encoder_input(encoder_in: Union[Tensor, Tuple[Tensor, Tensor], EncoderMemory], 
                            device: str, batch_first: bool
                            ) -> Tuple[Tensor, Tensor]:
+    if isinstance(encoder_in, EncoderMemory):
+        return EncoderMemory(_prepare_encoder_input(encoder_in.memory, device, batch_first))
+
     is_tensor = None
     if isinstance(encoder_in, Tensor):
         is_tensor = True
@@ -27,8 +44,10 @@ def _prepare_encoder_input(encoder_in: Union[Tensor, Tuple[Tensor, Tensor]],
     return encoder_in[0] if is_tensor else encoder_in
 
 
-def move_encoder_in_to_device(encoder_in: Union[Tensor, Tuple[Tensor, Tensor]], 
+def move_encoder_in_to_device(encoder_in: Union[Tensor, Tuple[Tensor, Tensor], EncoderMemory], 
                               device: str) -> Tuple[Tensor, Tensor]:
+    if isinstance(encoder_in, EncoderMemory):
+        return EncoderMemory(encoder_in.memory.to(device))
     if isinstance(encoder_in, Tensor):
         return encoder_in.to(device)
     return tuple(el.to(device) for el in encoder_in)
@@ -37,17 +56,56 @@ def move_encoder_in_to_device(encoder_in: Union[Tensor, Tuple[Tensor, Tensor]],
 class WordGenerator(ABC):
     def __init__(self, model: EncoderDecoderTransformerLike, 
                  tokenizer: CharLevelTokenizerv2, device,
-                 logit_processor: Optional[LogitProcessor] = None):
+                 logit_processor: Optional[LogitProcessor] = None,
+                 use_kv_cache: bool = True):
+        """
+        Arguments:
+        ----------
+        use_kv_cache: bool
+            If True, model.decode_incremental() is used: only the last
+            token is passed through the decoder layers on each step.
+            Otherwise the whole prefix is decoded on each step.
+        """
         self.model = model
         self.tokenizer = tokenizer
         self.device = torch.device(device)
         self.model.to(self.device)
         self.eos_token_id = tokenizer.char_to_idx['<eos>']
         self.logit_processor = logit_processor
+        self.use_kv_cache = use_kv_cache
     
     def switch_model(self, model: EncoderDecoderTransformerLike):
         self.model = model
 
+    def _encode(self, encoder_in: Union[Tensor, Tuple[Tensor, Tensor], EncoderMemory],
+                encoder_in_pad_mask: Optional[Tensor]) -> Tensor:
+        if isinstance(encoder_in, EncoderMemory):
+            return encoder_in.memory
+        return self.model.encode(encoder_in, encoder_in_pad_mask)
+
+    def _init_decoder_cache(self, encoded: Tensor, 
+                            encoder_in_pad_mask: Optional[Tensor] = None,
+                            rows_per_memory: int = 1) -> Optional[DecoderCache]:
+        if not self.use_kv_cache:
+            return None
+        return self.model.init_decoder_cache(encoded, encoder_in_pad_mask, rows_per_memory)
+
+    def _decode_next_token_logits(self, dec_in: Tensor, encoded: Tensor,
+                                  cache: Optional[DecoderCache],
+                                  encoder_in_pad_mask: Optional[Tensor] = None,
+                                  dec_in_pad_mask: Optional[Tensor] = None,
+                                  ) -> Tuple[Tensor, Optional[DecoderCache]]:
+        """
+        Returns logits for the token following `dec_in` of 
+        shape (batch_size, n_classes) and the updated cache. 
+        If `cache` is None, the whole `dec_in` is decoded.
+        """
+        if cache is not None:
+            return self.model.decode_incremental(dec_in, cache)
+        next_tokens_logits = self.model.decode(
+            dec_in, encoded, encoder_in_pad_mask, dec_in_pad_mask)[-1]
+        return next_tokens_logits, None
+
     @abstractmethod
     def __call__(self, xyt, kb_tokens, max_steps_n, 
                  *args, **kwargs) -> List[Tuple[float, str]]:
@@ -63,12 +121,14 @@ class GreedyGenerator(WordGenerator):
         log_prob = 0.0
         
         encoder_in = _prepare_encoder_input(encoder_in, self.device, False)
-        encoded = self.model.encode(encoder_in, None)
+        encoded = self._encode(encoder_in, None)
+        cache = self._init_decoder_cache(encoded)
 
         for _ in range(max_steps_n):
-            dec_in_char_seq = torch.tensor(tokens).unsqueeze_(BATCH_SIZE_DIM)
-            next_tokens_logits: torch.Tensor = self.model.decode(
-                dec_in_char_seq, encoded, None, None).squeeze_(BATCH_SIZE_DIM)[-1]
+            dec_in_char_seq = torch.tensor(tokens, device=self.device).unsqueeze_(BATCH_SIZE_DIM)
+            next_tokens_logits, cache = self._decode_next_token_logits(
+                dec_in_char_seq, encoded, cache)
+            next_tokens_logits = next_tokens_logits.squeeze_(0)
             if self.logit_processor:
                 next_tokens_logits = self.logit_processor.process(
                     next_tokens_logits, tokens)
@@ -129,7 +189,13 @@ class BeamGenerator(WordGenerator):
 
         encoder_in = _prepare_encoder_input(encoder_in, self.device, False)
 
-        encoded = self.model.encode(encoder_in, None)
+        encoded = self._encode(encoder_in, None)
+
+        # A decoder cache of a hypothesis contains all its tokens except 
+        # for the last one. Thus it's the cache of the parent hypothesis
+        # after it was decoded. The caches are not modified in place,
+        # so all children share the parent's cache.
+        prefix_to_cache = {tuple(tokens[:-1]): self._init_decoder_cache(encoded)}
 
         while len(partial_hypotheses) > 0:
             cur_partial_score, cur_partial_hypothesis = heapq.heappop(partial_hypotheses)
@@ -140,9 +206,11 @@ class BeamGenerator(WordGenerator):
             word_pad_mask = None
             curve_pad_mask = None
 
-            
-            next_tokens_logits = self.model.decode(
-                dec_in_char_seq, encoded, curve_pad_mask, word_pad_mask).transpose_(0, 1)[0, -1]
+            cache = prefix_to_cache[tuple(cur_partial_hypothesis[:-1])]
+            next_tokens_logits, cache = self._decode_next_token_logits(
+                dec_in_char_seq, encoded, cache, curve_pad_mask, word_pad_mask)
+            next_tokens_logits = next_tokens_logits[0]
+            prefix_to_cache[tuple(cur_partial_hypothesis)] = cache
             if self.logit_processor:
                 next_tokens_logits = self.logit_processor.process(
                     next_tokens_logits, cur_partial_hypothesis)
@@ -197,9 +265,24 @@ class BeamGenerator(WordGenerator):
 # * produces exactly the same results as GreedyGenerator
 # * is more efficient (it's batched :) )
 # GreedyGeneratorBatched Cons:
-# * Doesn't support vocab masking yet
 # * Has a different interface
 class GreedyGeneratorBatched(WordGenerator):    
+    def _apply_logit_processor(self, logits: Tensor, dec_in_token_ids: Tensor,
+                               rows: Tensor, processor_states: Optional[Tensor]
+                               ) -> Tensor:
+        """
+        Masks logits of given `rows` in place. If the logit processor 
+        is stateful the whole batch is processed with one operation.
+        """
+        if processor_states is not None:
+            logits[rows] = self.logit_processor.process_batch(
+                logits[rows], processor_states[rows])
+            return logits
+        for row in rows.tolist():
+            logits[row] = self.logit_processor.process(
+                logits[row], dec_in_token_ids[:, row].tolist())
+        return logits
+
     @torch.inference_mode()
     def _generate(self, encoder_in, encoder_in_pad_mask: torch.Tensor, 
                   max_steps_n=35) -> List[Tuple[float, str]]:
@@ -218,20 +301,31 @@ class GreedyGeneratorBatched(WordGenerator):
         pad_token_id = self.tokenizer.char_to_idx['<pad>']
       
         encoder_in = move_encoder_in_to_device(encoder_in, self.device)
-        encoder_in_pad_mask.to(self.device)
-        encoded = self.model.encode(encoder_in, encoder_in_pad_mask)
+        encoder_in_pad_mask = encoder_in_pad_mask.to(self.device)
+        encoded = self._encode(encoder_in, encoder_in_pad_mask)
+        cache = self._init_decoder_cache(encoded, encoder_in_pad_mask)
+
+        processor_states = None
+        if isinstance(self.logit_processor, StatefulLogitProcessor):
+            processor_states = self.logit_processor.get_initial_states(batch_size, self.device)
 
         for _ in range(max_steps_n):
             # decoder_output.shape = char_seq_len x batch_size x n_tokens
 
             tgt_pad_mask = (dec_in_token_ids == pad_token_id).T
 
-            next_tokens_logits = self.model.decode(
-                dec_in_token_ids, encoded, encoder_in_pad_mask, tgt_pad_mask)[-1]  # shape = batch_size x n_tokens 
+            next_tokens_logits, cache = self._decode_next_token_logits(
+                dec_in_token_ids, encoded, cache, 
+                encoder_in_pad_mask, tgt_pad_mask)  # shape = batch_size x n_tokens 
             
-            # next_tokens_logits = self._mask_out_unallowed_ids(
-            #     dec_in_char_seq.squeeze(BATCH_SIZE_DIM).tolist(),
-            #     next_tokens_logits)
+            unfinished_indices = torch.nonzero(~sequence_finish_statuses, as_tuple=True)[0]
+
+            # Finished sequences are not masked: all their 
+            # continuations are unallowed which would lead to NaNs.
+            if self.logit_processor:
+                next_tokens_logits = self._apply_logit_processor(
+                    next_tokens_logits, dec_in_token_ids, 
+                    unfinished_indices, processor_states)
 
             # ! Note !  We don't really need to perform softmax since argmax would be the same.
             # It's only needed to return proper log probabilities (that can be used to output probabilities).
@@ -243,10 +337,13 @@ class GreedyGeneratorBatched(WordGenerator):
 
             # Our model never predict <pad> and actually, pad_oken_id is out of range of model's output.
             # Thus we need to add log_probs only for unfinishedsequences
-            unfinished_indices = torch.nonzero(~sequence_finish_statuses, as_tuple=True)[0]
             log_probs[unfinished_indices] += next_tokens_logproba[unfinished_indices, next_tokens[unfinished_indices]]
 
             dec_in_token_ids = torch.cat([dec_in_token_ids, next_tokens.unsqueeze(char_seq_len_dim)], dim=char_seq_len_dim)
+
+            if processor_states is not None:
+                processor_states = self.logit_processor.update_states(
+                    processor_states, next_tokens)
           
             sequence_finish_statuses |= next_tokens == eos_token_id
             if sequence_finish_statuses.all():
@@ -257,9 +354,195 @@ class GreedyGeneratorBatched(WordGenerator):
     def __call__(self, encoder_in, encoder_in_pad_mask, max_steps_n=35) -> List[Tuple[float, str]]:
         return self._generate(encoder_in, encoder_in_pad_mask, max_steps_n)
 
+    def generate_batch(self, encoder_in, encoder_in_pad_mask: Tensor,
+                       max_steps_n=35) -> List[List[Tuple[float, str]]]:
+        """
+        Same as GreedyGenerator.__call__ for every swipe in a batch:
+        i-th element of the output is [(-log_prob, word)] for the i-th swipe.
+        """
+        token_ids, log_probs = self._generate(encoder_in, encoder_in_pad_mask, max_steps_n)
+        pad_token_id = self.tokenizer.char_to_idx['<pad>']
+        results = []
+        for swipe_token_ids, log_prob in zip(token_ids.T.tolist(), log_probs.tolist()):
+            swipe_token_ids = [t for t in swipe_token_ids if t != pad_token_id]
+            # Like in GreedyGenerator the last token is dropped 
+            # even if it's not <eos> (max_steps_n is reached).
+            word = self.tokenizer.decode(swipe_token_ids[1:-1])
+            results.append([(-log_prob, word)])
+        return results
+
+
+
+class BatchedBeamGenerator(WordGenerator):
+    """
+    Beam search that decodes all hypotheses of all swipes
+    in a batch with a single decoder call per step.
+
+    Unlike BeamGenerator (that pops hypotheses from a heap one by one)
+    the search is synchronous: at step `i` every live hypothesis
+    has exactly `i + 1` tokens. Each swipe owns `beamsize` slots;
+    a slot with `-inf` log probability is dead. Scoring is the same
+    as in BeamGenerator: score = -log_prob / len(hypothesis)**normalization_factor.
+
+    `__call__` has the same interface as BeamGenerator.__call__ and
+    processes a single swipe. `generate_batch` processes a padded batch.
+    """
+    def _apply_logit_processor(self, logits: Tensor, tokens: Tensor,
+                               alive_rows: Tensor, 
+                               processor_states: Optional[Tensor]) -> Tensor:
+        # logits.shape = (n_rows, n_classes)
+        # tokens.shape = (chars_seq_len, n_rows)
+        if processor_states is not None:
+            return self.logit_processor.process_batch(logits, processor_states)
+        for row in alive_rows.tolist():
+            logits[row] = self.logit_processor.process(logits[row], tokens[:, row].tolist())
+        return logits
+
+    @torch.inference_mode()
+    def generate_batch(self,
+                       encoder_in,
+                       encoder_in_pad_mask: Optional[Tensor],
+                       max_steps_n=35,
+                       return_hypotheses_n: Optional[int] = None,
+                       beamsize=6,
+                       normalization_factor=0.5,
+                       ) -> List[List[Tuple[float, str]]]:
+        """
+        Arguments:
+        ----------
+        encoder_in: Union[Tensor, Tuple[Tensor, Tensor]]
+            Batched encoder input (batch dim is 1) like the one
+            returned by CollateFnV2 with batch_first=False.
+        encoder_in_pad_mask: Optional[Tensor]
+            Shape (batch_size, curve_len). May be None if batch_size == 1.
+
+        Returns:
+        --------
+        List where i-th element is a list of tuples (score, text) for
+        the i-th swipe. See BeamGenerator.__call__ for details.
+        """
+        encoder_in = move_encoder_in_to_device(encoder_in, self.device)
+        if encoder_in_pad_mask is not None:
+            encoder_in_pad_mask = encoder_in_pad_mask.to(self.device)
+        encoded = self._encode(encoder_in, encoder_in_pad_mask)
+
+        batch_size = encoded.size(1)
+        n_rows = batch_size * beamsize
+        sos_token_id = self.tokenizer.char_to_idx['<sos>']
+
+        # Row `b * beamsize + j` is the j-th slot of the b-th swipe.
+        cache = self._init_decoder_cache(encoded, encoder_in_pad_mask, beamsize)
+        rows_encoded, rows_pad_mask = None, None
+        if cache is None:
+            rows_encoded = encoded.repeat_interleave(beamsize, dim=1)
+            if encoder_in_pad_mask is not None:
+                rows_pad_mask = encoder_in_pad_mask.repeat_interleave(beamsize, dim=0)
+
+        tokens = torch.full((1, n_rows), sos_token_id, dtype=torch.int32, device=self.device)
+        log_probs = torch.full((batch_size, beamsize), float('-inf'), device=self.device)
+        log_probs[:, 0] = 0
+
+        # Stateful logit processors handle all rows at once.
+        processor_states = None
+        if isinstance(self.logit_processor, StatefulLogitProcessor):
+            processor_states = self.logit_processor.get_initial_states(n_rows, self.device)
+
+        final_hypotheses = [[] for _ in range(batch_size)]
+
+        for step in range(max_steps_n):
+            dead_rows_mask = log_probs.view(-1) == float('-inf')
+            if dead_rows_mask.all():
+                break
+
+            alive_rows = torch.nonzero(~dead_rows_mask, as_tuple=True)[0]
+            if cache is None:
+                # The whole prefix is decoded at each step, 
+                # so only the alive rows are passed to the decoder.
+                alive_logits, _ = self._decode_next_token_logits(
+                    tokens[:, alive_rows], rows_encoded[:, alive_rows], None,
+                    None if rows_pad_mask is None else rows_pad_mask[alive_rows])
+                # Dead rows are masked out after log_softmax.
+                next_tokens_logits = alive_logits.new_zeros((n_rows, alive_logits.size(1)))
+                next_tokens_logits[alive_rows] = alive_logits
+            else:
+                next_tokens_logits, cache = self._decode_next_token_logits(
+                    tokens, None, cache)  # (n_rows, n_classes)
+            if self.logit_processor:
+                next_tokens_logits = self._apply_logit_processor(
+                    next_tokens_logits, tokens, alive_rows, processor_states)
+            next_tokens_logproba = F.log_softmax(next_tokens_logits, dim=-1)
+            next_tokens_logproba.masked_fill_(dead_rows_mask.unsqueeze(1), float('-inf'))
+
+            # Same as in BeamGenerator: each hypothesis is expanded
+            # with its `beamsize` best continuations.
+            topk_continuations = next_tokens_logproba.topk(beamsize, dim=-1)
+            candidate_log_probs = (log_probs.view(-1, 1) + topk_continuations.values
+                                   ).view(batch_size, beamsize * beamsize)
+            candidate_tokens = topk_continuations.indices.view(batch_size, beamsize * beamsize)
+
+            # Hypothesis length includes <sos>
+            new_length = step + 2
+            is_final = candidate_tokens == self.eos_token_id
+            if step + 1 >= max_steps_n:
+                is_final.fill_(True)
+            is_final &= candidate_log_probs != float('-inf')
+
+            for b, candidate_idx in torch.nonzero(is_final).tolist():
+                parent_row = b * beamsize + candidate_idx // beamsize
+                hypothesis = tokens[:, parent_row].tolist() + [int(candidate_tokens[b, candidate_idx])]
+                score = -float(candidate_log_probs[b, candidate_idx]) / new_length**normalization_factor
+                final_hypotheses[b].append((score, hypothesis))
+
+            # All hypotheses of a step have the same length, thus the best
+            # normalized scores correspond to the best log probabilities.
+            candidate_log_probs.masked_fill_(is_final, float('-inf'))
+            log_probs, best_candidates = candidate_log_probs.topk(beamsize, dim=-1)
+
+            parent_rows = (best_candidates // beamsize
+                           + torch.arange(batch_size, device=self.device).unsqueeze(1) * beamsize).view(-1)
+            next_tokens = candidate_tokens.gather(1, best_candidates).view(1, -1).to(tokens.dtype)
+            tokens = torch.cat([tokens[:, parent_rows], next_tokens], dim=0)
+            if cache is not None:
+                cache = cache.reorder(parent_rows)
+            if processor_states is not None:
+                processor_states = self.logit_processor.update_states(
+                    processor_states[parent_rows], next_tokens[0])
+
+        results = []
+        for swipe_final_hypotheses in final_hypotheses:
+            result = [(score, self.tokenizer.decode(hypothesis[1:-1]))
+                      for score, hypothesis in swipe_final_hypotheses]
+            result.sort()
+            results.append(result if return_hypotheses_n is None else result[:return_hypotheses_n])
+        return results
+
+    def __call__(self,
+                 encoder_in,
+                 max_steps_n=35,
+                 return_hypotheses_n: Optional[int] = None,
+                 beamsize=6,
+                 normalization_factor=0.5,
+                 ) -> List[Tuple[float, str]]:
+        encoder_in = _prepare_encoder_input(encoder_in, self.device, False)
+        return self.generate_batch(
+            encoder_in, None, max_steps_n, return_hypotheses_n,
+            beamsize, normalization_factor)[0]
+
 
 
 GENERATOR_CTORS_DICT = {
     "greedy": GreedyGenerator,
-    "beam": BeamGenerator
+    "beam": BeamGenerator,
+    "beam_batched": BatchedBeamGenerator,
+}
+
+
+# Generators with `generate_batch(encoder_in, encoder_in_pad_mask, **call_kwargs)`
+# method. A key is present only if the batched generator produces the same 
+# results as the generator with this key in GENERATOR_CTORS_DICT.
+# "beam" is absent: BatchedBeamGenerator is a synchronous search that may
+# return different hypotheses than BeamGenerator when beamsize > 1.
+BATCHED_GENERATOR_CTORS_DICT = {
+    "greedy": GreedyGeneratorBatched,
+    "beam_batched": BatchedBeamGenerator,
 }